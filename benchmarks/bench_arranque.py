@@ -0,0 +1,131 @@
+"""
+Costo de arrancar la app: import de main.py, arranque de gunicorn y primer
+request de cada worker, con y sin preload (gunicorn.conf.py).
+
+- import: `import main` en un intérprete nuevo, y lo mismo más crear el
+  cliente de OpenAI, que es lo que pagaba cada worker antes de hacerlo
+  perezoso.
+- arranque: desde lanzar gunicorn hasta que responde el primer GET.
+- primer botón / primera pregunta: el primer update de cada tipo contra las
+  APIs falsas de fakes.py (sin latencia), en modo síncrono. La pregunta
+  incluye importar el SDK de OpenAI si el worker no lo heredó.
+- reciclaje: con --max-requests 1 cada request espera a que arranque un
+  worker nuevo; es lo que se paga cada vez que gunicorn recicla uno.
+- PSS: memoria proporcional de los workers (lo compartido por copy-on-write
+  se reparte entre ellos). Solo en Linux.
+
+Uso:
+    python benchmarks/bench_arranque.py
+    python benchmarks/bench_arranque.py --workers 4 --repeticiones 10
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+from bench_carga import RAIZ, arrancar_gunicorn, entorno_app  # noqa: E402
+from fakes import iniciar_apis_falsas  # noqa: E402
+
+MODOS = (("sin preload", "0"), ("preload", "1"))
+
+
+def tiempo_import(codigo, repeticiones):
+    script = f"import time; t = time.perf_counter(); {codigo}; print(time.perf_counter() - t)"
+    tiempos = [
+        float(subprocess.run([sys.executable, "-c", script], cwd=RAIZ, capture_output=True,
+                             text=True, check=True).stdout)
+        for _ in range(repeticiones)
+    ]
+    return statistics.median(tiempos) * 1000
+
+
+def pss_workers_mb(master_pid):
+    try:
+        with open(f"/proc/{master_pid}/task/{master_pid}/children") as f:
+            hijos = f.read().split()
+        total = 0
+        for pid in hijos:
+            with open(f"/proc/{pid}/smaps_rollup") as f:
+                total += next(int(l.split()[1]) for l in f if l.startswith("Pss:"))
+        return total / 1024
+    except (OSError, StopIteration):
+        return None
+
+
+def update(update_id, chat_id, texto):
+    return {"update_id": update_id, "message": {
+        "message_id": 1, "chat": {"id": chat_id, "type": "private"}, "date": int(time.time()), "text": texto,
+    }}
+
+
+def medir_modo(base, preload, workers):
+    env = entorno_app(base, {"GUNICORN_PRELOAD": preload})
+    with tempfile.TemporaryFile() as salida:
+        t0 = time.perf_counter()
+        proceso, url = arrancar_gunicorn(env, workers, 4, salida)
+        arranque = time.perf_counter() - t0
+        try:
+            # Sin keep-alive: cada request puede caer en cualquier worker
+            t0 = time.perf_counter()
+            requests.post(url, json=update(1, 1, "📊 Resumen finanzas"), headers={"Connection": "close"})
+            boton = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            requests.post(url, json=update(2, 2, "Dame una idea para ahorrar"), headers={"Connection": "close"})
+            pregunta = time.perf_counter() - t0
+            pss = pss_workers_mb(proceso.pid)
+        finally:
+            proceso.terminate()
+            proceso.wait(timeout=30)
+    return arranque, boton, pregunta, pss
+
+
+def medir_reciclaje(base, preload, repeticiones):
+    env = entorno_app(base, {"GUNICORN_PRELOAD": preload})
+    with tempfile.TemporaryFile() as salida:
+        proceso, url = arrancar_gunicorn(env, 1, 1, salida, ("--max-requests", "1"))
+        try:
+            tiempos = []
+            for _ in range(repeticiones):
+                t0 = time.perf_counter()
+                requests.get(url, headers={"Connection": "close"}, timeout=60)
+                tiempos.append(time.perf_counter() - t0)
+        finally:
+            proceso.terminate()
+            proceso.wait(timeout=30)
+    # El primero lo atiende el worker inicial, ya arrancado
+    return statistics.median(tiempos[1:]) * 1000
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--repeticiones", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"import main                     {tiempo_import('import main', args.repeticiones):7.0f} ms")
+    print(f"import main + cliente OpenAI    "
+          f"{tiempo_import('import main; main.openai_client()', args.repeticiones):7.0f} ms\n")
+
+    servidor, base, _ = iniciar_apis_falsas()
+    print(f"{f'gunicorn -w {args.workers}':<17} {'arranque':>9} {'1er botón':>10} {'1ª pregunta':>12} "
+          f"{'reciclaje':>10} {'PSS workers':>12}   (tiempos en ms)")
+    for nombre, preload in MODOS:
+        arranque, boton, pregunta, pss = medir_modo(base, preload, args.workers)
+        reciclaje = medir_reciclaje(base, preload, args.repeticiones + 1)
+        pss = f"{pss:9.1f} MB" if pss is not None else f"{'-':>12}"
+        print(f"{nombre:<17} {arranque * 1000:9.0f} {boton * 1000:10.0f} {pregunta * 1000:12.0f} "
+              f"{reciclaje:10.0f} {pss}")
+    servidor.shutdown()
+
+
+if __name__ == "__main__":
+    main_bench()
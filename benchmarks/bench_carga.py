@@ -0,0 +1,298 @@
+"""
+Prueba de carga de punta a punta: la app bajo gunicorn contra APIs falsas.
+
+Arranca en este proceso un servidor que imita Notion (/pages y
+/databases/{id}/query, con latencia y 429 configurables), Telegram
+(sendMessage) y OpenAI (Responses API), y levanta `gunicorn main:app`
+apuntando a él. Luego N usuarios simulados mandan updates al webhook con una
+mezcla realista: botones del teclado, flujos guiados completos, comandos
+`gasto:`/`tarea:`, preguntas que resuelve el bot solo y preguntas a la IA.
+Cada usuario espera la respuesta antes de mandar el siguiente mensaje, como
+una persona.
+
+Por update se miden dos tiempos:
+- ack: lo que tarda el webhook en devolver el OK (lo que ve Telegram).
+- respuesta: hasta que llega al Telegram falso el primer sendMessage para
+  ese chat (lo que ve el usuario).
+
+Al final imprime p50/p95/p99 de ambos por tipo de mensaje, updates/s y las
+llamadas que recibió cada API falsa.
+
+Uso:
+    python benchmarks/bench_carga.py --duracion 30 --usuarios 20
+    python benchmarks/bench_carga.py --workers 2 --threads 8 --prob-429 0.05
+    python benchmarks/bench_carga.py --env WEBHOOK_ASYNC=1 --env IA_STREAMING=1
+    python benchmarks/bench_carga.py --mezcla comando=5,flujo=1,ia=0
+"""
+
+import argparse
+import itertools
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+from fakes import iniciar_apis_falsas  # noqa: E402
+
+BASES_NOTION = ("FINANZAS", "TAREAS", "EVENTOS", "PROYECTOS", "HABITOS")
+
+# Cada escenario es lo que manda un usuario de corrido; {n} varía el texto
+# para que no todo sea un acierto de caché.
+ESCENARIOS = {
+    "boton": [
+        ["📊 Resumen finanzas"],
+        ["📋 Resumen general"],
+    ],
+    "flujo": [
+        ["➕ Nuevo gasto", "{monto}", "comida {n}", "Hoy"],
+        ["➕ Nuevo ingreso", "{monto}", "venta {n}", "Otra fecha", "12/12/2025"],
+        ["📝 Nueva tarea", "llamar al proveedor {n}", "Mañana"],
+        ["📅 Nuevo evento", "junta {n}", "viernes 16:00"],
+    ],
+    "comando": [
+        ["gasto: {monto} tacos {n}"],
+        ["ingreso: {monto} freelance {n}"],
+        ["tarea: revisar contrato {n} viernes"],
+        ["tareas hoy"],
+        ["proyectos activos"],
+    ],
+    "local": [
+        ["¿cuánto gasté este mes?"],
+        ["¿qué tengo hoy?"],
+    ],
+    "ia": [
+        ["¿Cómo voy con mis finanzas este mes? Dame 3 ideas para ahorrar ({n})"],
+        ["Organiza mi semana con las tareas pendientes, caso {n}"],
+    ],
+}
+
+MEZCLA_DEFAULT = "boton=2,flujo=2,comando=3,local=1,ia=2"
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def entorno_app(base, extra):
+    env = dict(os.environ)
+    env.update(
+        OPENAI_API_KEY="bench",
+        OPENAI_BASE_URL=f"{base}/v1",
+        NOTION_TOKEN="bench",
+        NOTION_BASE_URL=f"{base}/v1",
+        TELEGRAM_API_BASE=base,
+        TELEGRAM_TOKEN="bench",
+        LOG_LEVEL=env.get("LOG_LEVEL", "WARNING"),
+        **{f"NOTION_DB_{b}": b.lower() for b in BASES_NOTION},
+    )
+    env.update(extra)
+    return env
+
+
+def sembrar(env, paginas):
+    """Mete `paginas` movimientos, tareas y eventos en el Notion falso usando main."""
+    if not paginas:
+        return
+    os.environ.update(env)
+    os.environ["NOTION_RATE"] = "100000"
+    os.environ["NOTION_BURST"] = "100000"
+    import main
+
+    hoy = main.hoy_iso()
+    azar = random.Random(1)
+    for i in range(paginas):
+        main.create_financial_record(f"movimiento {i}", azar.choice(["Egreso", "Ingreso"]),
+                                     azar.randint(50, 3000), categoria=azar.choice(["Comida", "Casa", "Auto"]),
+                                     fecha=hoy)
+        main.create_task(f"tarea {i}", fecha=hoy)
+        main.create_event(f"evento {i}", fecha=hoy)
+
+
+def arrancar_gunicorn(env, workers, threads, salida, opciones=()):
+    port = puerto_libre()
+    proceso = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-w", str(workers), "--threads", str(threads),
+         "-b", f"127.0.0.1:{port}", "--timeout", "120", *opciones, "main:app"],
+        cwd=RAIZ, env=env, stdout=salida, stderr=subprocess.STDOUT,
+    )
+    url = f"http://127.0.0.1:{port}/"
+    limite = time.monotonic() + 60
+    while time.monotonic() < limite:
+        if proceso.poll() is not None:
+            break
+        try:
+            if requests.get(url, timeout=1).ok:
+                return proceso, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    proceso.kill()
+    salida.seek(0)
+    sys.exit("gunicorn no arrancó:\n" + salida.read().decode(errors="replace")[-3000:])
+
+
+def parsear_mezcla(texto):
+    pesos = {}
+    for parte in texto.split(","):
+        nombre, _, peso = parte.partition("=")
+        if nombre.strip() not in ESCENARIOS:
+            sys.exit(f"tipo desconocido en --mezcla: {nombre!r} (hay: {', '.join(ESCENARIOS)})")
+        pesos[nombre.strip()] = float(peso or 1)
+    return {k: v for k, v in pesos.items() if v > 0}
+
+
+class Usuario(threading.Thread):
+    """Un chat que manda escenarios de la mezcla hasta que se acaba el tiempo."""
+
+    def __init__(self, chat_id, url, registro, pesos, fin, ids, timeout, pausa, semilla):
+        super().__init__(daemon=True)
+        self.chat_id = chat_id
+        self.url = url
+        self.registro = registro
+        self.tipos = list(pesos)
+        self.pesos = list(pesos.values())
+        self.fin = fin
+        self.ids = ids
+        self.timeout = timeout
+        self.pausa = pausa
+        self.azar = random.Random(semilla)
+        self.sesion = requests.Session()
+        self.muestras = []  # (tipo, ack_s, respuesta_s o None, status)
+
+    def update(self, texto):
+        return {
+            "update_id": next(self.ids),
+            "message": {
+                "message_id": self.azar.randint(1, 10**6),
+                "from": {"id": self.chat_id, "is_bot": False, "first_name": "Carga"},
+                "chat": {"id": self.chat_id, "type": "private"},
+                "date": int(time.time()),
+                "text": texto,
+            },
+        }
+
+    def enviar(self, tipo, texto):
+        ya_habia = self.registro.mensajes_de(self.chat_id)
+        t0 = time.perf_counter()
+        try:
+            status = self.sesion.post(self.url, json=self.update(texto), timeout=self.timeout).status_code
+        except requests.RequestException:
+            status = None
+        ack = time.perf_counter() - t0
+        llegada = self.registro.esperar_mensaje(self.chat_id, ya_habia, self.timeout)
+        self.muestras.append((tipo, ack, None if llegada is None else llegada - t0, status))
+
+    def run(self):
+        while time.monotonic() < self.fin:
+            tipo = self.azar.choices(self.tipos, self.pesos)[0]
+            mensajes = self.azar.choice(ESCENARIOS[tipo])
+            n = self.azar.randint(1, 10**6)
+            monto = self.azar.randint(20, 2500)
+            for plantilla in mensajes:
+                self.enviar(tipo, plantilla.format(n=n, monto=monto))
+                if self.pausa:
+                    time.sleep(self.pausa)
+        # gunicorn espera a las conexiones keep-alive abiertas antes de apagarse
+        self.sesion.close()
+
+
+def percentiles(valores):
+    valores = sorted(valores)
+    if not valores:
+        return "      -       -       -"
+    p = lambda q: valores[min(len(valores) - 1, int(len(valores) * q))] * 1000  # noqa: E731
+    return f"{p(0.50):7.0f} {p(0.95):7.0f} {p(0.99):7.0f}"
+
+
+def reporte(muestras, duracion, registro):
+    print(f"\n{'tipo':<9} {'updates':>7}   {'ack ms p50/p95/p99':>23}   "
+          f"{'respuesta ms p50/p95/p99':>23}  {'sin resp.':>9} {'errores':>7}")
+    por_tipo = {}
+    for m in muestras:
+        por_tipo.setdefault(m[0], []).append(m)
+    for tipo, filas in sorted(por_tipo.items()) + [("TOTAL", muestras)]:
+        acks = [a for _, a, _, _ in filas]
+        respuestas = [r for _, _, r, _ in filas if r is not None]
+        errores = sum(1 for *_, s in filas if s != 200)
+        print(f"{tipo:<9} {len(filas):>7}   {percentiles(acks):>23}   {percentiles(respuestas):>23}  "
+              f"{len(filas) - len(respuestas):>9} {errores:>7}")
+
+    print(f"\n{len(muestras) / duracion:.1f} updates/s en {duracion:.1f} s "
+          f"(ack medio {statistics.fmean(a for _, a, _, _ in muestras) * 1000:.0f} ms)" if muestras else
+          "\nsin updates")
+    print("llamadas a las APIs falsas: " + ", ".join(f"{k}={v}" for k, v in sorted(registro.llamadas.items())))
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duracion", type=float, default=30, help="segundos de carga")
+    parser.add_argument("--usuarios", type=int, default=20, help="chats mandando a la vez")
+    parser.add_argument("--workers", type=int, default=1, help="procesos de gunicorn")
+    parser.add_argument("--threads", type=int, default=8, help="hilos por proceso de gunicorn")
+    parser.add_argument("--mezcla", default=MEZCLA_DEFAULT, help="tipo=peso,... (" + ", ".join(ESCENARIOS) + ")")
+    parser.add_argument("--pausa", type=float, default=0.0, help="segundos entre mensajes de un usuario")
+    parser.add_argument("--timeout", type=float, default=60, help="espera máxima por ack y por respuesta")
+    parser.add_argument("--paginas", type=int, default=50, help="movimientos, tareas y eventos sembrados")
+    parser.add_argument("--latencia-notion", type=float, default=0.15)
+    parser.add_argument("--latencia-telegram", type=float, default=0.05)
+    parser.add_argument("--latencia-openai", type=float, default=1.5)
+    parser.add_argument("--prob-429", type=float, default=0.0, help="fracción de requests a Notion con 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="segundos del Retry-After de los 429")
+    parser.add_argument("--env", action="append", default=[], metavar="CLAVE=VALOR",
+                        help="variable extra para la app (se puede repetir)")
+    parser.add_argument("--semilla", type=int, default=0)
+    args = parser.parse_args()
+
+    pesos = parsear_mezcla(args.mezcla)
+    extra = dict(e.split("=", 1) for e in args.env)
+
+    servidor, base, registro = iniciar_apis_falsas(retry_after=args.retry_after)
+    env = entorno_app(base, extra)
+    sembrar(env, args.paginas)
+
+    # Las latencias y los 429 solo aplican durante la carga, no a la siembra
+    handler = servidor.RequestHandlerClass
+    handler.latencia_notion = args.latencia_notion
+    handler.latencia_telegram = args.latencia_telegram
+    handler.latencia_openai = args.latencia_openai
+    handler.prob_429 = args.prob_429
+    registro.llamadas.clear()
+
+    with tempfile.TemporaryFile() as salida:
+        proceso, url = arrancar_gunicorn(env, args.workers, args.threads, salida)
+        print(f"gunicorn -w {args.workers} --threads {args.threads}; {args.usuarios} usuarios, "
+              f"{args.duracion:.0f} s, mezcla {pesos}" + (f", env {extra}" if extra else ""))
+        try:
+            ids = itertools.count(int(time.time()) * 1000)
+            inicio = time.monotonic()
+            fin = inicio + args.duracion
+            usuarios = [Usuario(900000 + i, url, registro, pesos, fin, ids, args.timeout, args.pausa,
+                                args.semilla * 1000 + i)
+                        for i in range(args.usuarios)]
+            for u in usuarios:
+                u.start()
+            for u in usuarios:
+                u.join()
+            duracion = time.monotonic() - inicio
+        finally:
+            proceso.terminate()
+            proceso.wait(timeout=30)
+        reporte([m for u in usuarios for m in u.muestras], duracion, registro)
+    servidor.shutdown()
+
+
+if __name__ == "__main__":
+    main_bench()
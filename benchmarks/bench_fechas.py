@@ -0,0 +1,154 @@
+"""
+Cobertura y velocidad de parse_fecha_es.
+
+El corpus son textos reales de fechas en español con la fecha esperada,
+tomando como "hoy" el miércoles 10/12/2025. Se imprime qué entiende el
+parser (y cuáles entendía la versión anterior), y cuántas fechas por segundo
+resuelve con la caché fría y con la caché caliente. Sale con error si algún
+caso falla.
+
+Uso:
+    python benchmarks/bench_fechas.py -n 200000
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import main  # noqa: E402
+
+HOY = datetime.date(2025, 12, 10)  # miércoles
+
+CORPUS = [
+    ("hoy", "2025-12-10"),
+    ("Hoy", "2025-12-10"),
+    ("mañana", "2025-12-11"),
+    ("manana", "2025-12-11"),
+    ("pasado mañana", "2025-12-12"),
+    ("ayer", "2025-12-09"),
+    ("antier", "2025-12-08"),
+    ("viernes", "2025-12-12"),
+    ("el viernes", "2025-12-12"),
+    ("este sábado", "2025-12-13"),
+    ("miércoles", "2025-12-10"),
+    ("el próximo miércoles", "2025-12-17"),
+    ("lunes que viene", "2025-12-15"),
+    ("domingo", "2025-12-14"),
+    ("en 3 días", "2025-12-13"),
+    ("en un día", "2025-12-11"),
+    ("dentro de 2 semanas", "2025-12-24"),
+    ("en una semana", "2025-12-17"),
+    ("12/12/2025", "2025-12-12"),
+    ("12-12-2025", "2025-12-12"),
+    ("1/2/26", "2026-02-01"),
+    ("24/12", "2025-12-24"),
+    ("2025-12-31", "2025-12-31"),
+    ("12 de diciembre", "2025-12-12"),
+    ("12 diciembre 2025", "2025-12-12"),
+    ("3 de enero de 2026", "2026-01-03"),
+    ("el 15 de septiembre", "2025-09-15"),
+    ("20 setiembre", "2025-09-20"),
+    ("viernes 16:00", "2025-12-12T16:00:00-06:00"),
+    ("mañana a las 9", "2025-12-11T09:00:00-06:00"),
+    ("hoy 4pm", "2025-12-10T16:00:00-06:00"),
+    ("12/12/2025 18:30", "2025-12-12T18:30:00-06:00"),
+    ("16:00", "2025-12-10T16:00:00-06:00"),
+    ("viernes a las 5", "2025-12-12T17:00:00-06:00"),
+    ("a las 17 h", "2025-12-10T17:00:00-06:00"),
+    ("2 h", None),
+    ("10 hrs", None),
+    ("31/02/2025", None),
+    ("32 de diciembre", None),
+    ("el mes que viene", None),
+    ("tacos", None),
+    ("25:00", None),
+]
+
+EXTRACCION = [
+    ("junta kaizen viernes 16:00", ("junta kaizen", "2025-12-12T16:00:00-06:00")),
+    ("llamar a proveedor mañana", ("llamar a proveedor", "2025-12-11")),
+    ("pagar renta para el 15/12", ("pagar renta", "2025-12-15")),
+    ("revisar contrato", ("revisar contrato", None)),
+    ("leer 20 minutos", ("leer 20 minutos", None)),
+    ("estudiar 2 h", ("estudiar 2 h", None)),
+    ("correr 10 hrs", ("correr 10 hrs", None)),
+    ("cena a las 5", ("cena", "2025-12-10T17:00:00-06:00")),
+    ("cena a las 8", ("cena", "2025-12-10T08:00:00-06:00")),
+    ("cena el viernes a las 5", ("cena", "2025-12-12T17:00:00-06:00")),
+    ("cena el viernes a las 8pm", ("cena", "2025-12-12T20:00:00-06:00")),
+]
+
+
+def parse_fecha_anterior(texto):
+    """Lo que entendía parse_fecha_es antes (sin hoy fijo: solo formatos)."""
+    import re
+    texto = texto.strip().lower()
+    if texto in ("hoy", "mañana", "manana"):
+        return True
+    if re.match(r"^(\d{1,2})[/-](\d{1,2})[/-](\d{2,4})$", texto):
+        return True
+    if re.match(r"^(\d{4})-(\d{1,2})-(\d{1,2})$", texto):
+        return True
+    return bool(re.match(r"^(\d{1,2})\s*(de)?\s*([a-zá]+)(\s*de\s*(\d{4}))?$", texto))
+
+
+def cobertura():
+    """Imprime el resultado de cada caso; devuelve cuántos fallaron."""
+    correctas = anteriores = 0
+    for texto, esperado in CORPUS:
+        obtenido = main.parse_fecha_es(texto, HOY)
+        ok = obtenido == esperado
+        correctas += ok
+        anteriores += esperado is not None and parse_fecha_anterior(texto)
+        marca = "ok" if ok else "FALLA"
+        print(f"{marca:<6} {texto!r:<26} -> {obtenido}" + ("" if ok else f"  (esperado {esperado})"))
+    reconocibles = sum(1 for _, e in CORPUS if e is not None)
+    print(f"\nCorpus: {correctas}/{len(CORPUS)} correctas; la versión anterior "
+          f"reconocía {anteriores}/{reconocibles} de las fechas válidas.\n")
+
+    fallas = len(CORPUS) - correctas
+    for texto, esperado in EXTRACCION:
+        obtenido = main.extraer_fecha(texto, HOY)
+        ok = obtenido == esperado
+        fallas += not ok
+        marca = "ok" if ok else "FALLA"
+        print(f"{marca:<6} {texto!r:<30} -> {obtenido}" + ("" if ok else f"  (esperado {esperado})"))
+    print()
+    return fallas
+
+
+def velocidad(n):
+    textos = [t for t, _ in CORPUS]
+
+    t0 = time.perf_counter()
+    for i in range(n):
+        main._parse_fecha.cache_clear()
+        main.parse_fecha_es(textos[i % len(textos)], HOY)
+    frio = n / (time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    for i in range(n):
+        main.parse_fecha_es(textos[i % len(textos)], HOY)
+    caliente = n / (time.perf_counter() - t0)
+
+    print(f"caché fría     {frio:12,.0f} fechas/s")
+    print(f"caché caliente {caliente:12,.0f} fechas/s")
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=100000)
+    args = parser.parse_args()
+    fallas = cobertura()
+    velocidad(args.n)
+    if fallas:
+        sys.exit(f"{fallas} caso(s) con FALLA")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,107 @@
+"""
+Costo por request de registrar un update: el print(json.dumps(update))
+anterior contra el logger con cola de main.py.
+
+Se mide el tiempo que pasa el hilo del request (lo que espera Telegram) y,
+aparte, cuánto tarda en vaciarse todo al archivo. Ambos escriben al mismo
+destino: un archivo temporal, como stdout redirigido en producción. Con
+--lento cada write() tarda además esos microsegundos, como stdout sin buffer
+(PYTHONUNBUFFERED=1) hacia un recolector de logs que no da abasto.
+
+Uso:
+    python benchmarks/bench_logging.py -n 20000
+    python benchmarks/bench_logging.py -n 5000 --lento 200
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import main  # noqa: E402
+
+UPDATE = {
+    "update_id": 912345678,
+    "message": {
+        "message_id": 4321,
+        "from": {"id": 123456789, "is_bot": False, "first_name": "Manuel", "username": "manuel",
+                 "language_code": "es"},
+        "chat": {"id": 123456789, "first_name": "Manuel", "username": "manuel", "type": "private"},
+        "date": 1765400000,
+        "text": "¿Cuánto gasté esta semana en comida y cuánto me queda del presupuesto?",
+    },
+}
+
+
+def antes(data):
+    print("Update:", json.dumps(data, ensure_ascii=False))
+
+
+def ahora(data, muestra):
+    # Lo que hacen webhook() y atender_update() alrededor de procesar_update
+    if muestra and main.random.random() < muestra:
+        main.log.info("update recibido", extra=main.campos(update=main.redactar_update(data)))
+    with main.contexto_log(update_id=data["update_id"], chat_id=data["message"]["chat"]["id"]):
+        inicio = time.perf_counter()
+        main.log.info("update procesado", extra=main.campos(
+            ruta="ia", duracion_ms=round((time.perf_counter() - inicio) * 1000, 2),
+        ))
+
+
+class DestinoLento:
+    def __init__(self, archivo, demora_us):
+        self.archivo = archivo
+        self.demora = demora_us / 1e6
+
+    def write(self, texto):
+        if self.demora:
+            time.sleep(self.demora)
+        return self.archivo.write(texto)
+
+    def flush(self):
+        self.archivo.flush()
+
+
+def medir(nombre, registrar, n, vaciar):
+    tiempos = []
+    t_total = time.perf_counter()
+    for _ in range(n):
+        t0 = time.perf_counter()
+        registrar(UPDATE)
+        tiempos.append((time.perf_counter() - t0) * 1e6)
+    vaciar()
+    total = time.perf_counter() - t_total
+    tiempos.sort()
+    return (f"{nombre:<32} p50={statistics.median(tiempos):6.2f} µs  "
+          f"p99={tiempos[int(len(tiempos) * 0.99)]:7.2f} µs  "
+          f"hasta escribir todo: {total / n * 1e6:6.2f} µs/update")
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=20000)
+    parser.add_argument("--lento", type=float, default=0.0,
+                        help="microsegundos extra por cada write() al destino")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryFile("w") as archivo:
+        destino = DestinoLento(archivo, args.lento)
+        with contextlib.redirect_stdout(destino):
+            resultado = medir("print(json.dumps(update))", antes, args.n, destino.flush)
+        print(resultado)
+
+        for nombre, muestra in (("log, sin muestra de updates", 0), ("log, muestra 10%", 0.1),
+                                ("log, muestra 100% (redactado)", 1.0)):
+            main.configurar_logs(stream=destino)
+            print(medir(nombre, lambda d: ahora(d, muestra), args.n, main._MANEJADOR_LOG.detener))
+
+
+if __name__ == "__main__":
+    main_bench()
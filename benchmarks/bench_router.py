@@ -0,0 +1,101 @@
+"""
+Costo de enrutar un mensaje: la cadena de `if` anterior contra ROUTER.
+
+Solo se mide la decisión (qué ruta toca), no el trabajo de cada handler.
+La cadena anterior está copiada aquí tal cual decidía, devolviendo el nombre
+de la ruta en lugar de ejecutarla.
+
+Uso:
+    python benchmarks/bench_router.py -n 200000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import main  # noqa: E402
+
+MENSAJES = [
+    "➕ Nuevo gasto",
+    "📋 Resumen general",
+    "/start",
+    "gasto: 150 tacos",
+    "ingreso: 9,000 sueldo",
+    "tarea: llamar al contador",
+    "hábito: leer 20 minutos",
+    "tareas hoy",
+    "agenda",
+    "proyectos activos",
+    "¿cómo voy con mis gastos este mes comparado con el anterior?",
+    "organiza mi agenda de la semana que viene",
+    "dame ideas para ahorrar en comida",
+    "qué tareas hoy son más urgentes y por qué",
+]
+
+
+def ruta_anterior(text):
+    lower = text.lower().strip()
+    if lower in ["/start", "ayuda", "/help", "help"]:
+        return "ayuda"
+    for boton in ["nuevo gasto", "nuevo ingreso", "nueva tarea", "nuevo evento",
+                  "nuevo proyecto", "nuevo hábito", "nuevo habito",
+                  "resumen finanzas", "resumen general"]:
+        if lower.endswith(boton):
+            return boton
+    for prefijo in ["gasto:", "ingreso:"]:
+        if lower.startswith(prefijo):
+            return prefijo
+    if ("estado finanzas" in lower or "balance este mes" in lower or "ingresos este mes" in lower
+            or lower == "ingresos" or "gastos este mes" in lower or lower == "gastos"):
+        return "finanzas"
+    if lower.startswith("tarea:"):
+        return "tarea"
+    if "tareas hoy" in lower or "tareas atrasadas" in lower:
+        return "tareas_hoy"
+    if lower.startswith("evento:"):
+        return "evento"
+    if "eventos hoy" in lower or "agenda" in lower:
+        return "eventos_hoy"
+    if lower.startswith("proyecto:"):
+        return "proyecto"
+    if "proyectos activos" in lower:
+        return "proyectos_activos"
+    if lower.startswith("hábito:") or lower.startswith("habito:"):
+        return "habito"
+    if "hábitos activos" in lower or "habitos activos" in lower:
+        return "habitos_activos"
+    return None
+
+
+def ruta_router(text):
+    ruta = main.ROUTER.resolver(text)
+    return ruta[0] if ruta else None
+
+
+def medir(nombre, enrutar, n):
+    t0 = time.perf_counter()
+    for i in range(n):
+        enrutar(MENSAJES[i % len(MENSAJES)])
+    us = (time.perf_counter() - t0) / n * 1e6
+    print(f"{nombre:<18} {us:6.2f} µs/mensaje")
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{'mensaje':<62} {'anterior':<18} router")
+    for m in MENSAJES:
+        print(f"{m:<62} {str(ruta_anterior(m)):<18} {ruta_router(m)}")
+    print()
+    medir("cadena de if", ruta_anterior, args.n)
+    medir("ROUTER", ruta_router, args.n)
+
+
+if __name__ == "__main__":
+    main_bench()
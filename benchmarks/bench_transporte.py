@@ -0,0 +1,76 @@
+"""
+Compara un request por conexión (requests.post) contra el transporte
+keep-alive compartido de main.py (http_post).
+
+Uso:
+    python benchmarks/bench_transporte.py -n 300
+    python benchmarks/bench_transporte.py --cert cert.pem --key key.pem
+
+Con --cert/--key el servidor local habla HTTPS, que es donde más se nota el
+ahorro porque cada conexión nueva paga también el handshake TLS.
+"""
+
+import argparse
+import os
+import ssl
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import requests  # noqa: E402
+import urllib3  # noqa: E402
+
+import main  # noqa: E402
+from fakes import iniciar_servidor  # noqa: E402
+
+
+def medir(nombre, enviar, url, n, verify):
+    tiempos = []
+    cuerpo = {"filter": {"property": "Estado", "select": {"equals": "Activo"}}}
+    for _ in range(n):
+        t0 = time.perf_counter()
+        r = enviar(url, json=cuerpo, timeout=10, verify=verify)
+        r.content
+        tiempos.append((time.perf_counter() - t0) * 1000)
+    tiempos.sort()
+    p50 = statistics.median(tiempos)
+    p95 = tiempos[int(len(tiempos) * 0.95) - 1]
+    print(f"{nombre:<28} p50={p50:7.3f} ms  p95={p95:7.3f} ms  media={statistics.mean(tiempos):7.3f} ms")
+    return p50
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=200)
+    parser.add_argument("--latencia", type=float, default=0.0,
+                        help="latencia simulada del servidor en segundos")
+    parser.add_argument("--cert")
+    parser.add_argument("--key")
+    args = parser.parse_args()
+
+    servidor, base = iniciar_servidor(latencia=args.latencia)
+    verify = True
+    if args.cert:
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(args.cert, args.key)
+        servidor.socket = ctx.wrap_socket(servidor.socket, server_side=True)
+        base = base.replace("http://", "https://")
+        verify = False
+        urllib3.disable_warnings()
+
+    url = f"{base}/v1/databases/bench/query"
+    print(f"{args.n} requests contra {url}\n")
+    # Calentamos el pool para no contar el primer handshake
+    main.http_post(url, json={}, timeout=10, verify=verify)
+
+    sin_pool = medir("requests.post (sin pool)", requests.post, url, args.n, verify)
+    con_pool = medir("http_post (keep-alive)", main.http_post, url, args.n, verify)
+    print(f"\nAhorro por request: {sin_pool - con_pool:.3f} ms (p50)")
+    servidor.shutdown()
+
+
+if __name__ == "__main__":
+    main_bench()
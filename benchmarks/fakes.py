@@ -0,0 +1,275 @@
+"""
+Servidores locales que imitan las APIs externas que usa main.py.
+
+Sirven para medir sin tocar Notion, Telegram ni OpenAI de verdad. Hablan
+HTTP/1.1 con keep-alive, igual que los servidores reales, para que la
+diferencia entre abrir una conexión por request y reutilizarla sea visible.
+
+- FakeHandler: responde lo mismo a cualquier POST (transporte puro).
+- ApisFalsas: Notion (/v1/pages, /v1/databases/{id}/query, con 429
+  opcionales), Telegram (/bot<token>/sendMessage y editMessageText) y
+  OpenAI (/v1/responses, normal y en streaming) en un solo puerto, con
+  latencia configurable por servicio y un RegistroApis compartido con lo
+  que se recibió.
+"""
+
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Cabeceras y cuerpo se escriben por separado; sin esto Nagle + delayed
+    # ACK meten ~40 ms en cada respuesta sobre una conexión reutilizada.
+    disable_nagle_algorithm = True
+
+    # Segundos de espera antes de responder cada request
+    latencia = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def leer_json(self):
+        largo = int(self.headers.get("Content-Length") or 0)
+        crudo = self.rfile.read(largo) if largo else b""
+        try:
+            return json.loads(crudo or b"{}")
+        except ValueError:
+            return {}
+
+    def responder(self, status, cuerpo, headers=None):
+        datos = json.dumps(cuerpo).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(datos)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(datos)
+
+    def do_POST(self):
+        self.leer_json()
+        if self.latencia:
+            time.sleep(self.latencia)
+        self.responder(200, {"ok": True, "results": [], "has_more": False})
+
+
+class _Servidor(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Un cliente que corta a media respuesta (p. ej. un stream) no es un error del fake
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def iniciar_servidor(handler=FakeHandler, host="127.0.0.1", port=0, **atributos):
+    """
+    Arranca `handler` en un hilo y devuelve (servidor, url_base).
+
+    Los `atributos` extra se fijan en una subclase del handler, por ejemplo
+    `latencia=0.05`.
+    """
+    if atributos:
+        handler = type(handler.__name__, (handler,), atributos)
+    servidor = _Servidor((host, port), handler)
+    hilo = threading.Thread(target=servidor.serve_forever, daemon=True)
+    hilo.start()
+    h, p = servidor.server_address[:2]
+    return servidor, f"http://{h}:{p}"
+
+
+class RegistroApis:
+    """Estado de las APIs falsas: páginas de Notion y mensajes de Telegram por chat."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.paginas = {}  # database_id -> [página]
+        self.mensajes = {}  # chat_id -> [(instante, método, texto)] de cada sendMessage
+        self.llamadas = {}  # endpoint -> cuántas
+        self._ids_mensaje = itertools.count(1)
+
+    def contar(self, endpoint):
+        with self._cond:
+            self.llamadas[endpoint] = self.llamadas.get(endpoint, 0) + 1
+
+    def guardar_pagina(self, database_id, pagina):
+        with self._cond:
+            self.paginas.setdefault(database_id, []).append(pagina)
+
+    def paginas_de(self, database_id):
+        with self._cond:
+            return list(self.paginas.get(database_id, []))
+
+    def mensaje(self, chat_id, metodo, texto):
+        with self._cond:
+            self.mensajes.setdefault(chat_id, []).append((time.perf_counter(), metodo, texto))
+            self._cond.notify_all()
+            return next(self._ids_mensaje)
+
+    def mensajes_de(self, chat_id):
+        with self._cond:
+            return len(self.mensajes.get(chat_id, []))
+
+    def esperar_mensaje(self, chat_id, ya_habia, timeout):
+        """Instante del primer mensaje al chat después de los `ya_habia`, o None."""
+        limite = time.monotonic() + timeout
+        with self._cond:
+            while len(self.mensajes.get(chat_id, [])) <= ya_habia:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    return None
+                self._cond.wait(restante)
+            return self.mensajes[chat_id][ya_habia][0]
+
+
+def _texto_notion(texto):
+    return [{"type": "text", "plain_text": texto, "text": {"content": texto}}]
+
+
+def _propiedades_notion(propiedades):
+    """Propiedades como las devuelve Notion (con `type` y `plain_text`)."""
+    salida = {}
+    for nombre, valor in propiedades.items():
+        tipo = next(iter(valor))
+        contenido = valor[tipo]
+        if tipo in ("title", "rich_text"):
+            contenido = _texto_notion("".join(t["text"]["content"] for t in contenido))
+        salida[nombre] = {"type": tipo, tipo: contenido}
+    return salida
+
+
+class ApisFalsas(FakeHandler):
+    registro = None  # RegistroApis; iniciar_apis_falsas crea uno
+
+    latencia_notion = 0.0
+    latencia_telegram = 0.0
+    latencia_openai = 0.0
+    # Fracción de requests a Notion que reciben 429 con Retry-After
+    prob_429 = 0.0
+    retry_after = 1
+    # Streaming de OpenAI: pausa entre fragmentos
+    intervalo_stream = 0.05
+    texto_ia = ("Vas bien este mes, Manuel: tus gastos están por debajo de tus ingresos. "
+                "Revisa las tareas atrasadas y agenda un bloque para el proyecto principal.")
+
+    def do_POST(self):
+        cuerpo = self.leer_json()
+        ruta = self.path
+        if ruta.startswith("/v1/responses"):
+            return self._openai(cuerpo)
+        if ruta.startswith("/v1/"):
+            return self._notion(ruta, cuerpo)
+        if ruta.startswith("/bot"):
+            return self._telegram(ruta.rsplit("/", 1)[-1], cuerpo)
+        self.responder(404, {"error": "ruta desconocida"})
+
+    # ---- Notion ----
+
+    def _notion(self, ruta, cuerpo):
+        time.sleep(self.latencia_notion)
+        if self.prob_429 and random.random() < self.prob_429:
+            self.registro.contar("notion 429")
+            return self.responder(429, {"object": "error", "code": "rate_limited"},
+                                  {"Retry-After": str(self.retry_after)})
+
+        if ruta == "/v1/pages":
+            self.registro.contar("notion pages")
+            pagina = {
+                "object": "page",
+                "id": str(uuid.uuid4()),
+                "last_edited_time": time.strftime("%Y-%m-%dT%H:%M:00.000Z", time.gmtime()),
+                "properties": _propiedades_notion(cuerpo.get("properties", {})),
+            }
+            self.registro.guardar_pagina(cuerpo.get("parent", {}).get("database_id"), pagina)
+            return self.responder(200, pagina)
+
+        if ruta.startswith("/v1/databases/") and ruta.endswith("/query"):
+            self.registro.contar("notion query")
+            paginas = self.registro.paginas_de(ruta.split("/")[3])
+            inicio = int(cuerpo.get("start_cursor") or 0)
+            n = int(cuerpo.get("page_size") or 100)
+            hay_mas = inicio + n < len(paginas)
+            return self.responder(200, {
+                "object": "list",
+                "results": paginas[inicio:inicio + n],
+                "has_more": hay_mas,
+                "next_cursor": str(inicio + n) if hay_mas else None,
+            })
+
+        self.responder(404, {"object": "error", "code": "object_not_found"})
+
+    # ---- Telegram ----
+
+    def _telegram(self, metodo, cuerpo):
+        self.registro.contar(f"telegram {metodo}")
+        time.sleep(self.latencia_telegram)
+        if metodo not in ("sendMessage", "editMessageText"):
+            return self.responder(200, {"ok": True, "result": True})
+        # Solo los mensajes nuevos cuentan como respuesta; las ediciones
+        # (streaming de la IA) reutilizan el message_id que ya tenían.
+        if metodo == "sendMessage":
+            message_id = self.registro.mensaje(cuerpo.get("chat_id"), metodo, cuerpo.get("text", ""))
+        else:
+            message_id = cuerpo.get("message_id")
+        self.responder(200, {"ok": True, "result": {
+            "message_id": message_id,
+            "chat": {"id": cuerpo.get("chat_id")},
+            "text": cuerpo.get("text", ""),
+        }})
+
+    # ---- OpenAI ----
+
+    def _respuesta_ia(self, texto):
+        return {
+            "id": f"resp_{uuid.uuid4().hex}", "object": "response", "created_at": int(time.time()),
+            "model": "gpt-4.1-mini", "status": "completed",
+            "output": [{
+                "type": "message", "id": "msg_1", "role": "assistant", "status": "completed",
+                "content": [{"type": "output_text", "text": texto, "annotations": []}],
+            }],
+            "usage": {
+                "input_tokens": 1800, "input_tokens_details": {"cached_tokens": 1024},
+                "output_tokens": 60, "output_tokens_details": {"reasoning_tokens": 0},
+                "total_tokens": 1860,
+            },
+            "parallel_tool_calls": True, "tool_choice": "auto", "tools": [],
+        }
+
+    def _openai(self, cuerpo):
+        self.registro.contar("openai responses")
+        respuesta = self._respuesta_ia(self.texto_ia)
+        if not cuerpo.get("stream"):
+            time.sleep(self.latencia_openai)
+            return self.responder(200, respuesta)
+
+        # Streaming: la latencia es hasta el primer fragmento
+        time.sleep(self.latencia_openai)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        palabras = self.texto_ia.split(" ")
+        for i, palabra in enumerate(palabras):
+            evento = {"type": "response.output_text.delta", "delta": palabra + " ", "item_id": "msg_1",
+                      "output_index": 0, "content_index": 0, "sequence_number": i, "logprobs": []}
+            self.wfile.write(f"event: {evento['type']}\ndata: {json.dumps(evento)}\n\n".encode())
+            self.wfile.flush()
+            time.sleep(self.intervalo_stream)
+        evento = {"type": "response.completed", "response": respuesta, "sequence_number": len(palabras)}
+        self.wfile.write(f"event: response.completed\ndata: {json.dumps(evento)}\n\n".encode())
+        self.wfile.flush()
+
+
+def iniciar_apis_falsas(host="127.0.0.1", port=0, **atributos):
+    """Arranca ApisFalsas. Devuelve (servidor, url_base, registro)."""
+    registro = RegistroApis()
+    servidor, base = iniciar_servidor(ApisFalsas, host, port, registro=registro, **atributos)
+    return servidor, base, registro
@@ -0,0 +1,36 @@
+"""
+Configuración de gunicorn para Ares (gunicorn la lee sola desde este directorio).
+
+Con preload la app se importa una vez en el master y los workers la heredan
+al hacer fork, así un worker nuevo (al arrancar o al reciclarse con
+max_requests) no vuelve a importar Flask, requests ni el SDK de OpenAI. Lo
+que es de cada proceso (sesiones HTTP, cliente de OpenAI, SQLite, hilos de
+colas y de logs) se crea en el primer uso dentro de cada worker.
+
+GUNICORN_PRELOAD=0 vuelve a que cada worker importe la app por su cuenta.
+"""
+
+import gc
+import os
+import sys
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+
+def when_ready(server):
+    if not server.cfg.preload_app:
+        return
+    import main
+
+    main.precargar()
+    # Saca lo ya cargado del alcance del GC: si los workers lo recorrieran,
+    # escribirían en cada objeto y las páginas compartidas se copiarían.
+    gc.freeze()
+
+
+def worker_exit(server, worker):
+    # Antes de que el worker termine (reinicio, max_requests, deploy),
+    # procesa los updates que aceptó y entrega las respuestas aún en cola.
+    main = sys.modules.get("main")
+    if main is not None:
+        main.apagar()
@@ -1,10 +1,32 @@
 import os
+import sys
 import json
+import atexit
+import random
+import logging
+import cProfile
+import hashlib
 import re
+import sqlite3
+import heapq
+import bisect
+import queue
+import threading
 import requests
+import time
 import datetime
+import unicodedata
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request
-from openai import OpenAI
 
 # =========================
 #  CONFIGURACIÓN
@@ -22,12 +44,124 @@ NOTION_DB_EVENTOS = os.getenv("NOTION_DB_EVENTOS")
 NOTION_DB_PROYECTOS = os.getenv("NOTION_DB_PROYECTOS")
 NOTION_DB_HABITOS = os.getenv("NOTION_DB_HABITOS")
 
-TELEGRAM_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")
+TELEGRAM_API_URL = f"{TELEGRAM_API_BASE}/bot{TELEGRAM_TOKEN}"
 
-NOTION_BASE_URL = "https://api.notion.com/v1"
+NOTION_BASE_URL = os.getenv("NOTION_BASE_URL", "https://api.notion.com/v1")
 NOTION_VERSION = "2022-06-28"
-
-client = OpenAI(api_key=OPENAI_API_KEY)
+NOTION_PAGE_SIZE_MAX = 100  # Notion no devuelve más de 100 resultados por página
+
+# Cola de salida hacia Telegram (límites por chat y globales)
+TELEGRAM_SEND_QUEUE = os.getenv("TELEGRAM_SEND_QUEUE", "0") == "1"
+TELEGRAM_SEND_WORKERS = int(os.getenv("TELEGRAM_SEND_WORKERS", "4"))
+TELEGRAM_CHAT_INTERVAL = float(os.getenv("TELEGRAM_CHAT_INTERVAL", "1"))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+
+# Respuestas de la IA mostradas mientras se generan (editMessageText)
+IA_STREAMING = os.getenv("IA_STREAMING", "0") == "1"
+IA_STREAM_EDIT_INTERVAL = float(os.getenv("IA_STREAM_EDIT_INTERVAL", "1"))
+# Con TELEGRAM_SEND_QUEUE, segundos máximos esperando a que salga lo ya
+# encolado para el chat antes de empezar a transmitir
+IA_STREAM_ESPERA_COLA = float(os.getenv("IA_STREAM_ESPERA_COLA", "30"))
+
+# Precios en USD por millón de tokens (gpt-4.1-mini) para estimar costos
+IA_PRECIO_INPUT = float(os.getenv("IA_PRECIO_INPUT", "0.40"))
+IA_PRECIO_INPUT_CACHE = float(os.getenv("IA_PRECIO_INPUT_CACHE", "0.10"))
+IA_PRECIO_OUTPUT = float(os.getenv("IA_PRECIO_OUTPUT", "1.60"))
+
+# La IA solo recibe las secciones del resumen que la pregunta necesita
+IA_CONTEXTO_SELECTIVO = os.getenv("IA_CONTEXTO_SELECTIVO", "1") == "1"
+
+# Caché de respuestas de la IA (0 segundos = desactivada)
+IA_CACHE_TTL = float(os.getenv("IA_CACHE_TTL", "600"))
+IA_CACHE_MAX = int(os.getenv("IA_CACHE_MAX", "200"))
+
+# Preguntas frecuentes (totales, agenda de un día) respondidas con reglas
+# locales sin llamar a la IA
+IA_RESPUESTAS_LOCALES = os.getenv("IA_RESPUESTAS_LOCALES", "1") == "1"
+
+# Fechas con hora ("viernes 16:00") se guardan con este desfase UTC
+# (centro de México, sin horario de verano desde 2022)
+ARES_UTC_OFFSET = os.getenv("ARES_UTC_OFFSET", "-06:00")
+FECHAS_CACHE_MAX = int(os.getenv("FECHAS_CACHE_MAX", "2048"))
+
+# Límite de peticiones a Notion (por proceso) y reintentos ante 429/5xx
+NOTION_RATE = float(os.getenv("NOTION_RATE", "3"))
+NOTION_BURST = int(os.getenv("NOTION_BURST", "3"))
+NOTION_MAX_RETRIES = int(os.getenv("NOTION_MAX_RETRIES", "3"))
+NOTION_RETRY_AFTER_MAX = float(os.getenv("NOTION_RETRY_AFTER_MAX", "30"))
+
+# Transporte HTTP compartido (conexiones keep-alive por host)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.3"))
+
+# Resumen general: consultas a Notion en paralelo con un tiempo máximo total
+SNAPSHOT_WORKERS = int(os.getenv("SNAPSHOT_WORKERS", "10"))
+SNAPSHOT_DEADLINE = float(os.getenv("SNAPSHOT_DEADLINE", "20"))
+
+# Caché de consultas a Notion (0 segundos = desactivada). Es por proceso:
+# con varios workers, ver la nota junto a NOTION_CACHE.
+NOTION_CACHE_TTL = float(os.getenv("NOTION_CACHE_TTL", "30"))
+NOTION_CACHE_MAX = int(os.getenv("NOTION_CACHE_MAX", "256"))
+
+# Almacén local SQLite (ARES_DB_PATH vacío = desactivado). Por sí mismo solo
+# guarda lo que se pida explícitamente (sesiones, updates vistos); el espejo
+# de Notion y los agregados financieros se activan aparte.
+ARES_DB_PATH = os.getenv("ARES_DB_PATH", "")
+
+# Espejo local de Notion en ese SQLite, con su hilo de sync por proceso
+MIRROR_ENABLED = os.getenv("MIRROR_ENABLED", "0") == "1"
+MIRROR_MAX_STALENESS = float(os.getenv("MIRROR_MAX_STALENESS", "120"))
+MIRROR_SYNC_INTERVAL = float(os.getenv("MIRROR_SYNC_INTERVAL", "30"))
+MIRROR_FULL_SYNC_INTERVAL = float(os.getenv("MIRROR_FULL_SYNC_INTERVAL", "3600"))
+
+# Sesiones de los flujos de botones: "memory" (por proceso) o "sqlite"
+# (compartidas entre workers; requiere ARES_DB_PATH)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))
+SESSION_MAX = int(os.getenv("SESSION_MAX", "1000"))
+
+# Totales financieros materializados en el mismo SQLite
+AGREGADOS_ENABLED = os.getenv("AGREGADOS_ENABLED", "0") == "1"
+AGREGADOS_RECONCILE_INTERVAL = float(os.getenv("AGREGADOS_RECONCILE_INTERVAL", "900"))
+# Tras este tiempo una escritura marcada como pendiente se da por perdida
+# (worker muerto a media escritura) y deja de bloquear las reconciliaciones
+AGREGADOS_PENDIENTE_MAX = float(os.getenv("AGREGADOS_PENDIENTE_MAX", "300"))
+
+# Webhook asíncrono: responder OK a Telegram y procesar en segundo plano.
+# Los mensajes de un mismo chat siempre se procesan en orden; los workers
+# reparten chats distintos.
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "0") == "1"
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_MAX = int(os.getenv("WEBHOOK_QUEUE_MAX", "100"))
+# Al apagarse un worker (reinicio, max_requests, deploy) se espera hasta
+# estos segundos a que se vacíen sus colas; debe ser menor que el
+# graceful_timeout de gunicorn (30 s por defecto).
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "20"))
+
+# Telegram reenvía un update si no recibe el OK a tiempo. Los update_id
+# vistos en la ventana se ignoran; con UPDATE_DEDUP_SQLITE=1 (y ARES_DB_PATH)
+# se guardan en SQLite para que sobrevivan reinicios y se compartan entre workers.
+UPDATE_DEDUP_WINDOW = float(os.getenv("UPDATE_DEDUP_WINDOW", "3600"))
+UPDATE_DEDUP_MAX = int(os.getenv("UPDATE_DEDUP_MAX", "10000"))
+UPDATE_DEDUP_SQLITE = os.getenv("UPDATE_DEDUP_SQLITE", "0") == "1"
+
+# Logs: una línea JSON por evento ("texto" para leerlos en local). Los
+# updates crudos de Telegram solo se registran en una fracción
+# LOG_UPDATES_MUESTRA (0 a 1), con textos y tokens ocultos si LOG_REDACTAR=1.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_UPDATES_MUESTRA = float(os.getenv("LOG_UPDATES_MUESTRA", "0"))
+LOG_REDACTAR = os.getenv("LOG_REDACTAR", "1") == "1"
+
+# Trazas por update: si uno tarda más de TRAZA_LENTA_MS (0 = nunca) se
+# registra su árbol de tiempos. Con PERFIL_DIR, una fracción PERFIL_MUESTRA
+# de los updates corre bajo cProfile y los lentos dejan su .prof ahí.
+TRAZA_LENTA_MS = float(os.getenv("TRAZA_LENTA_MS", "3000"))
+PERFIL_DIR = os.getenv("PERFIL_DIR", "")
+PERFIL_MUESTRA = float(os.getenv("PERFIL_MUESTRA", "1"))
 
 NOTION_HEADERS = {
     "Authorization": f"Bearer {NOTION_TOKEN}",
@@ -64,13 +198,504 @@ CANCEL_KEYBOARD = {
     "one_time_keyboard": True,
 }
 
-# Memoria sencilla de conversación: chat_id -> estado
-SESSIONS = {}
+# =========================
+#  REGISTRO (LOGS)
+# =========================
+
+# Quien llama a log.* solo deja el registro en una cola; el formateo a JSON,
+# la redacción de secretos y la escritura a stdout ocurren en el hilo del
+# QueueListener. Los campos del request en curso (update_id, chat_id, ruta)
+# viven en un contextvar y se copian al registro en el momento de crearlo.
+
+log = logging.getLogger("ares")
+_CONTEXTO_LOG_VACIO = {}
+_CONTEXTO_LOG = contextvars.ContextVar("contexto_log", default=_CONTEXTO_LOG_VACIO)
+
+# Tokens de bot de Telegram (también dentro de URLs), claves de OpenAI y de Notion
+_RE_SECRETO = re.compile(r"\d{6,}:[\w-]{30,}|sk-[\w-]{20,}|(?:secret|ntn)_\w{20,}")
+_CAMPOS_TEXTO_UPDATE = ("text", "caption", "first_name", "last_name", "username")
+
+
+def campos(**datos):
+    """Para `extra=`: campos adicionales de la línea de log."""
+    return {"campos": datos}
+
+
+@contextmanager
+def contexto_log(**datos):
+    """Añade campos a todos los logs emitidos dentro del bloque."""
+    token = _CONTEXTO_LOG.set({**_CONTEXTO_LOG.get(), **datos})
+    try:
+        yield
+    finally:
+        _CONTEXTO_LOG.reset(token)
+
+
+def anotar_contexto(**datos):
+    """Añade campos al contexto del update en curso (dentro de contexto_log)."""
+    contexto = _CONTEXTO_LOG.get()
+    if contexto is not _CONTEXTO_LOG_VACIO:
+        contexto.update(datos)
+
+
+def redactar(texto):
+    return _RE_SECRETO.sub("[oculto]", texto)
+
+
+def redactar_update(valor):
+    """Copia del update con textos del usuario reemplazados por su longitud."""
+    if isinstance(valor, dict):
+        return {
+            k: (f"[{len(v)} caracteres]" if k in _CAMPOS_TEXTO_UPDATE and isinstance(v, str)
+                else redactar_update(v))
+            for k, v in valor.items()
+        }
+    if isinstance(valor, list):
+        return [redactar_update(v) for v in valor]
+    return valor
+
+
+class FormatoJSON(logging.Formatter):
+    def format(self, record):
+        datos = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+                  + f".{int(record.msecs):03d}Z",
+            "nivel": record.levelname,
+            "msg": record.getMessage(),
+            **getattr(record, "contexto", {}),
+            **getattr(record, "campos", {}),
+        }
+        if record.exc_text:
+            datos["error"] = record.exc_text
+        linea = json.dumps(datos, ensure_ascii=False, default=str)
+        return redactar(linea) if LOG_REDACTAR else linea
+
+
+class FormatoTexto(logging.Formatter):
+    def format(self, record):
+        extra = {**getattr(record, "contexto", {}), **getattr(record, "campos", {})}
+        linea = f"{record.levelname} {record.getMessage()}" + "".join(f" {k}={v}" for k, v in extra.items())
+        if record.exc_text:
+            linea += "\n" + record.exc_text
+        return redactar(linea) if LOG_REDACTAR else linea
+
+
+class ManejadorCola(QueueHandler):
+    """
+    QueueHandler que arranca su QueueListener la primera vez que se usa en
+    cada proceso (tras el fork de gunicorn el hilo del padre no existe).
+    """
+
+    def __init__(self, destino):
+        super().__init__(queue.SimpleQueue())
+        self.destino = destino
+        self._listener = None
+        self._pid = None
+        self._arranque = threading.Lock()
+
+    def _arrancar(self):
+        with self._arranque:
+            if self._pid == os.getpid():
+                return
+            # Cola nueva: la heredada del padre pudo quedar con su lock tomado
+            self.queue = queue.SimpleQueue()
+            self._listener = QueueListener(self.queue, self.destino)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def detener(self):
+        """Espera a que se escriba lo pendiente y para el hilo."""
+        with self._arranque:
+            if self._listener is not None and self._pid == os.getpid():
+                self._listener.stop()
+            self._listener = None
+            self._pid = None
+
+    def prepare(self, record):
+        # Lo que depende del hilo o del momento se resuelve aquí; el resto
+        # (JSON, redacción) lo hace el listener. El contexto se copia porque
+        # anotar_contexto lo modifica mientras el registro espera en la cola.
+        record.contexto = dict(_CONTEXTO_LOG.get())
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._arrancar()
+        super().emit(record)
+
+
+_MANEJADOR_LOG = None
+
+
+def configurar_logs(stream=None):
+    """(Re)configura el logger `ares` para escribir en `stream` (stdout por defecto)."""
+    global _MANEJADOR_LOG
+    if _MANEJADOR_LOG is not None:
+        log.removeHandler(_MANEJADOR_LOG)
+        _MANEJADOR_LOG.detener()
+    destino = logging.StreamHandler(stream or sys.stdout)
+    destino.setFormatter(FormatoTexto() if LOG_FORMAT == "texto" else FormatoJSON())
+    _MANEJADOR_LOG = ManejadorCola(destino)
+    log.addHandler(_MANEJADOR_LOG)
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+
+
+configurar_logs()
+atexit.register(lambda: _MANEJADOR_LOG.detener())
+
+# =========================
+#  MÉTRICAS
+# =========================
+
+# Histogramas y contadores en memoria, expuestos en formato de texto de
+# Prometheus en GET /metrics. Son por proceso: con varios workers de
+# gunicorn cada scrape ve al worker que lo atienda.
+
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_METRICAS = []
+
+
+def _etiquetas_texto(nombres, valores, extra=""):
+    pares = [f'{n}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+             for n, v in zip(nombres, valores)]
+    if extra:
+        pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+
+class Contador:
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self._valores = {}
+        self._lock = threading.Lock()
+        _METRICAS.append(self)
+
+    def inc(self, *valores, n=1):
+        with self._lock:
+            self._valores[valores] = self._valores.get(valores, 0) + n
+
+    def exponer(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} counter"]
+        with self._lock:
+            for valores, total in sorted(self._valores.items()):
+                lineas.append(f"{self.nombre}{_etiquetas_texto(self.etiquetas, valores)} {total}")
+        return lineas
+
+
+class Histograma:
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_SEGUNDOS):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.buckets = buckets
+        self._series = {}  # valores de etiquetas -> [cuentas por bucket..., +Inf, suma]
+        self._lock = threading.Lock()
+        _METRICAS.append(self)
+
+    def observar(self, valor, *valores):
+        i = bisect.bisect_left(self.buckets, valor)
+        with self._lock:
+            serie = self._series.get(valores)
+            if serie is None:
+                serie = self._series[valores] = [0] * (len(self.buckets) + 1) + [0.0]
+            serie[i] += 1
+            serie[-1] += valor
+
+    def exponer(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        with self._lock:
+            series = sorted((k, list(v)) for k, v in self._series.items())
+        for valores, serie in series:
+            acumulado = 0
+            for limite, n in zip((*self.buckets, "+Inf"), serie):
+                acumulado += n
+                le = _etiquetas_texto(self.etiquetas, valores, f'le="{limite}"')
+                lineas.append(f"{self.nombre}_bucket{le} {acumulado}")
+            etiquetas = _etiquetas_texto(self.etiquetas, valores)
+            lineas.append(f"{self.nombre}_sum{etiquetas} {serie[-1]:.6f}")
+            lineas.append(f"{self.nombre}_count{etiquetas} {acumulado}")
+        return lineas
+
+
+DEPENDENCIA_SEGUNDOS = Histograma(
+    "ares_dependencia_segundos", "Duración de las llamadas a Notion, Telegram y OpenAI",
+    ("dependencia", "operacion"),
+)
+DEPENDENCIA_ERRORES = Contador(
+    "ares_dependencia_errores_total", "Llamadas a servicios externos fallidas (timeout, red, http_NNN)",
+    ("dependencia", "operacion", "tipo"),
+)
+RUTA_SEGUNDOS = Histograma(
+    "ares_ruta_segundos", "Duración del procesamiento de un update por ruta", ("ruta",),
+)
+RUTA_ERRORES = Contador(
+    "ares_ruta_errores_total", "Updates cuyo procesamiento lanzó una excepción", ("ruta",),
+)
+
+
+def _tipo_error(exc):
+    return "timeout" if isinstance(exc, TimeoutError) or "Timeout" in type(exc).__name__ else "red"
+
+
+@contextmanager
+def medir_dependencia(dependencia, operacion):
+    """Registra duración y, si hay excepción, el error de una llamada externa."""
+    inicio = time.perf_counter()
+    try:
+        with span(f"{dependencia}.{operacion}"):
+            yield
+    except Exception as e:
+        DEPENDENCIA_ERRORES.inc(dependencia, operacion, _tipo_error(e))
+        raise
+    finally:
+        DEPENDENCIA_SEGUNDOS.observar(time.perf_counter() - inicio, dependencia, operacion)
+
+
+def exponer_metricas(extra=()):
+    """Texto de Prometheus con todas las métricas más las líneas `extra`."""
+    lineas = []
+    for metrica in _METRICAS:
+        lineas.extend(metrica.exponer())
+    lineas.extend(extra)
+    return "\n".join(lineas) + "\n"
+
+# =========================
+#  TRAZAS Y PERFILES
+# =========================
+
+# Cada update procesado abre un span raíz; dentro, `span()` cuelga hijos del
+# span actual (un contextvar, así que los hilos que reciben una copia del
+# contexto, como las secciones del resumen, cuelgan del mismo árbol). Fuera
+# de un update `span()` no hace nada.
+
+_SPAN_ACTUAL = contextvars.ContextVar("span_actual", default=None)
+
+
+class Span:
+    __slots__ = ("nombre", "atributos", "inicio", "duracion", "error", "hijos")
+
+    def __init__(self, nombre, atributos):
+        self.nombre = nombre
+        self.atributos = atributos
+        self.inicio = time.perf_counter()
+        self.duracion = None
+        self.error = None
+        self.hijos = []
+
+    def a_dict(self, origen=None):
+        origen = self.inicio if origen is None else origen
+        datos = {"nombre": self.nombre, "desde_ms": round((self.inicio - origen) * 1000, 1)}
+        if self.duracion is None:
+            datos["en_curso"] = True
+        else:
+            datos["ms"] = round(self.duracion * 1000, 1)
+        if self.atributos:
+            datos.update(self.atributos)
+        if self.error:
+            datos["error"] = self.error
+        if self.hijos:
+            datos["hijos"] = [h.a_dict(origen) for h in list(self.hijos)]
+        return datos
+
+
+@contextmanager
+def span(nombre, **atributos):
+    padre = _SPAN_ACTUAL.get()
+    if padre is None:
+        yield None
+        return
+    actual = Span(nombre, atributos)
+    padre.hijos.append(actual)
+    token = _SPAN_ACTUAL.set(actual)
+    try:
+        yield actual
+    except Exception as e:
+        actual.error = type(e).__name__
+        raise
+    finally:
+        actual.duracion = time.perf_counter() - actual.inicio
+        _SPAN_ACTUAL.reset(token)
+
+
+@contextmanager
+def traza(nombre, **atributos):
+    """
+    Span raíz de un update. Si tarda más de TRAZA_LENTA_MS registra el árbol
+    completo; con PERFIL_DIR además lo perfila y guarda el .prof si fue lento.
+    El perfil solo ve el hilo del update: las secciones del resumen, que
+    corren en su pool, aparecen como espera en `wait`.
+    """
+    raiz = Span(nombre, atributos)
+    token = _SPAN_ACTUAL.set(raiz)
+    perfil = None
+    if PERFIL_DIR and random.random() < PERFIL_MUESTRA:
+        perfil = cProfile.Profile()
+        try:
+            perfil.enable()
+        except ValueError:
+            # Otro perfilador activo en este hilo
+            perfil = None
+    try:
+        yield raiz
+    except Exception as e:
+        raiz.error = type(e).__name__
+        raise
+    finally:
+        if perfil is not None:
+            perfil.disable()
+        raiz.duracion = time.perf_counter() - raiz.inicio
+        _SPAN_ACTUAL.reset(token)
+        ms = raiz.duracion * 1000
+        if TRAZA_LENTA_MS and ms >= TRAZA_LENTA_MS:
+            datos = {"traza": raiz.a_dict()}
+            if perfil is not None:
+                datos["perfil"] = _guardar_perfil(perfil, raiz, ms)
+            log.warning("update lento", extra=campos(**datos))
+
+
+def _guardar_perfil(perfil, raiz, ms):
+    nombre = f"{raiz.nombre}-{raiz.atributos.get('update_id', 'x')}-{int(ms)}ms-{os.getpid()}.prof"
+    ruta = os.path.join(PERFIL_DIR, nombre)
+    try:
+        os.makedirs(PERFIL_DIR, exist_ok=True)
+        perfil.dump_stats(ruta)
+    except OSError as e:
+        log.error("No se pudo guardar el perfil: %s", e)
+        return None
+    return ruta
+
+# =========================
+#  TRANSPORTE HTTP
+# =========================
+
+# Una sesión requests por host (api.notion.com, api.telegram.org...) y por
+# proceso. Cada sesión mantiene su propio pool de conexiones keep-alive, así
+# que solo el primer request a cada host paga el handshake TCP+TLS.
+_HTTP_LOCK = threading.Lock()
+_HTTP_SESIONES = {}
+_HTTP_PID = None
+
+
+def _nueva_sesion_http():
+    # Reintentos solo para fallos de conexión (el request no llegó al
+    # servidor) y para GET. Los POST no se reintentan por status porque
+    # crear una página dos veces duplicaría el registro.
+    retry = Retry(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=0,
+        status=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=retry,
+    )
+    sesion = requests.Session()
+    sesion.mount("https://", adapter)
+    sesion.mount("http://", adapter)
+    # Sin cookies: la sesión se comparte entre hilos y no debe guardar estado.
+    sesion.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return sesion
+
+
+def http_session(url):
+    """
+    Devuelve la sesión keep-alive del host de `url`.
+
+    Las sesiones se crean la primera vez que se usan y se descartan si el
+    proceso cambió (fork de gunicorn), así cada worker abre sus propias
+    conexiones. El pool de urllib3 es thread-safe, por lo que todos los
+    hilos del worker comparten hasta HTTP_POOL_SIZE conexiones por host.
+    """
+    global _HTTP_PID
+    host = urlsplit(url).netloc
+    with _HTTP_LOCK:
+        if _HTTP_PID != os.getpid():
+            _HTTP_SESIONES.clear()
+            _HTTP_PID = os.getpid()
+        sesion = _HTTP_SESIONES.get(host)
+        if sesion is None:
+            sesion = _nueva_sesion_http()
+            _HTTP_SESIONES[host] = sesion
+    return sesion
+
+
+def http_post(url, **kwargs):
+    return http_session(url).post(url, **kwargs)
+
+
+# El SDK de OpenAI tarda casi un segundo en importarse y la mayoría de los
+# updates (botones, flujos, comandos) no lo usan. Se importa y se construye el
+# cliente la primera vez que hace falta, uno por proceso como las sesiones.
+_OPENAI_LOCK = threading.Lock()
+_OPENAI_CLIENTE = None
+_OPENAI_PID = None
+
+
+def importar_openai():
+    import openai
+    # `client.responses` se importa perezosamente dentro del SDK; lo traemos
+    # ya para que no lo pague la primera pregunta.
+    import openai.resources.responses  # noqa: F401
+    return openai
+
+
+def openai_client():
+    """
+    Devuelve el cliente de OpenAI del proceso, creándolo en el primer uso.
+
+    El SDK ya mantiene su propio pool keep-alive (httpx); solo lo dimensionamos
+    igual que el resto. Como el pool no sobrevive al fork de gunicorn, el
+    cliente se rehace si cambió el proceso.
+    """
+    global _OPENAI_CLIENTE, _OPENAI_PID
+    cliente = _OPENAI_CLIENTE
+    if cliente is not None and _OPENAI_PID == os.getpid():
+        return cliente
+    with _OPENAI_LOCK:
+        if _OPENAI_CLIENTE is None or _OPENAI_PID != os.getpid():
+            openai = importar_openai()
+            # La clase de DEFAULT_CONNECTION_LIMITS evita depender de qué
+            # cliente httpx trae la versión instalada del SDK.
+            limites = type(openai.DEFAULT_CONNECTION_LIMITS)(
+                max_connections=HTTP_POOL_SIZE,
+                max_keepalive_connections=HTTP_POOL_SIZE,
+            )
+            _OPENAI_CLIENTE = openai.OpenAI(
+                api_key=OPENAI_API_KEY,
+                max_retries=HTTP_RETRIES,
+                http_client=openai.DefaultHttpxClient(limits=limites),
+            )
+            _OPENAI_PID = os.getpid()
+        return _OPENAI_CLIENTE
 
 # =========================
 #  UTILIDADES BÁSICAS
 # =========================
 
+def telegram_post(metodo, payload, timeout=15):
+    """POST a un método de la Bot API, con sus métricas. Devuelve la respuesta."""
+    with medir_dependencia("telegram", metodo):
+        r = http_post(f"{TELEGRAM_API_URL}/{metodo}", json=payload, timeout=timeout)
+    if r.status_code >= 300:
+        DEPENDENCIA_ERRORES.inc("telegram", metodo, f"http_{r.status_code}")
+    return r
+
+
 def send_message(chat_id, text, reply_to=None, reply_markup=None):
     payload = {
         "chat_id": chat_id,
@@ -82,10 +707,27 @@ def send_message(chat_id, text, reply_to=None, reply_markup=None):
     if reply_markup:
         payload["reply_markup"] = reply_markup
 
+    if TELEGRAM_SEND_QUEUE:
+        COLA_TELEGRAM.encolar(payload)
+        return
+
+    try:
+        telegram_post("sendMessage", payload)
+    except Exception as e:
+        log.error("Error enviando mensaje a Telegram: %s", e)
+
+
+def telegram_api(metodo, payload, timeout=15):
+    """Llama a un método de la Bot API y devuelve su `result`, o None si falla."""
     try:
-        requests.post(TELEGRAM_URL, json=payload, timeout=15)
+        r = telegram_post(metodo, payload, timeout=timeout)
+        if r.status_code >= 300:
+            log.error("Error en Telegram %s", metodo, extra=campos(status=r.status_code, respuesta=r.text[:500]))
+            return None
+        return r.json().get("result")
     except Exception as e:
-        print("Error enviando mensaje a Telegram:", e)
+        log.error("Error de red en Telegram %s: %s", metodo, e)
+        return None
 
 
 def hoy_iso():
@@ -102,84 +744,165 @@ def inicio_fin_mes_actual():
     return inicio.isoformat(), fin.isoformat()
 
 
-def parse_fecha_es(texto):
-    """
-    Convierte textos como:
-    - "hoy", "mañana"
-    - "12/12/2025", "12-12-2025"
-    - "2025-12-12"
-    - "12 de diciembre", "12 diciembre 2025"
-    en fecha ISO (YYYY-MM-DD).
-    Devuelve None si no se puede interpretar.
-    """
-    texto = texto.strip().lower()
+MESES = {
+    "enero": 1, "febrero": 2, "marzo": 3, "abril": 4, "mayo": 5, "junio": 6,
+    "julio": 7, "agosto": 8, "septiembre": 9, "setiembre": 9, "octubre": 10,
+    "noviembre": 11, "diciembre": 12,
+}
+
+DIAS_SEMANA = {
+    "lunes": 0, "martes": 1, "miercoles": 2, "jueves": 3, "viernes": 4,
+    "sabado": 5, "domingo": 6,
+}
+
+DIAS_RELATIVOS = {
+    "hoy": 0, "manana": 1, "pasado manana": 2, "ayer": -1, "antier": -2, "anteayer": -2,
+}
+
+_RE_HORA = re.compile(
+    r"^(?P<resto>.*?)(?:^|\s+)(?P<a_las>a las\s+)?(?P<h>\d{1,2})(?::(?P<m>\d{2}))?\s*(?P<ampm>am|pm|hrs|h)?$"
+)
+_RE_DMA = re.compile(r"^(\d{1,2})[/-](\d{1,2})(?:[/-](\d{2,4}))?$")
+_RE_ISO = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})$")
+_RE_DIA_MES = re.compile(r"^(?:el\s+)?(\d{1,2})\s+(?:de\s+)?([a-z]+)(?:\s+(?:de\s+|del\s+)?(\d{4}))?$")
+_RE_EN_DIAS = re.compile(r"^(?:en|dentro de)\s+(\d+|un|una)\s+(dias?|semanas?)$")
+_RE_DIA_SEMANA = re.compile(
+    r"^(?:el\s+)?(?:(este|proximo|siguiente)\s+)?(" + "|".join(DIAS_SEMANA) + r")(?:\s+(proximo|que viene))?$"
+)
+
+# Palabras que suelen quedar entre el texto y la fecha: "llamar para el viernes"
+_CONECTORES_FECHA = ("para", "el", "de", "del")
+
 
-    if texto in ("hoy",):
-        return hoy_iso()
+def _sin_acentos(texto):
+    texto = unicodedata.normalize("NFKD", texto)
+    return "".join(c for c in texto if not unicodedata.combining(c))
 
-    if texto in ("mañana", "manana"):
-        return (datetime.date.today() + datetime.timedelta(days=1)).isoformat()
 
-    # dd/mm/aaaa o dd-mm-aaaa
-    m = re.match(r"^(\d{1,2})[/-](\d{1,2})[/-](\d{2,4})$", texto)
+def _fecha_sin_hora(texto, hoy):
+    if not texto:
+        return hoy
+
+    if texto in DIAS_RELATIVOS:
+        return hoy + datetime.timedelta(days=DIAS_RELATIVOS[texto])
+
+    # dd/mm/aaaa, dd-mm-aa o dd/mm (año en curso)
+    m = _RE_DMA.match(texto)
     if m:
-        d, mth, y = map(int, m.groups())
+        d, mes, y = m.groups()
+        y = int(y) if y else hoy.year
         if y < 100:
             y += 2000
-        try:
-            return datetime.date(y, mth, d).isoformat()
-        except ValueError:
-            return None
+        return datetime.date(y, int(mes), int(d))
 
     # aaaa-mm-dd
-    m = re.match(r"^(\d{4})-(\d{1,2})-(\d{1,2})$", texto)
+    m = _RE_ISO.match(texto)
     if m:
-        y, mth, d = map(int, m.groups())
-        try:
-            return datetime.date(y, mth, d).isoformat()
-        except ValueError:
-            return None
+        y, mes, d = map(int, m.groups())
+        return datetime.date(y, mes, d)
 
-    # "12 de diciembre" / "12 diciembre 2025"
-    meses = {
-        "enero": 1,
-        "febrero": 2,
-        "marzo": 3,
-        "abril": 4,
-        "mayo": 5,
-        "junio": 6,
-        "julio": 7,
-        "agosto": 8,
-        "septiembre": 9,
-        "setiembre": 9,
-        "octubre": 10,
-        "noviembre": 11,
-        "diciembre": 12,
-    }
-
-    m = re.match(
-        r"^(\d{1,2})\s*(de)?\s*([a-zá]+)(\s*de\s*(\d{4}))?$",
-        texto,
-    )
+    # "12 de diciembre", "12 diciembre 2025", "12 de diciembre de 2025"
+    m = _RE_DIA_MES.match(texto)
     if m:
-        d_str, _, mes_str, _, y_str = m.groups()
-        d = int(d_str)
-        mes_str = mes_str.replace("á", "a").replace("é", "e").replace("í", "i").replace("ó", "o").replace("ú", "u")
-        mes = meses.get(mes_str)
+        d, nombre_mes, y = m.groups()
+        mes = MESES.get(nombre_mes)
         if not mes:
             return None
-        if y_str:
-            y = int(y_str)
-        else:
-            y = datetime.date.today().year
-        try:
-            return datetime.date(y, mes, d).isoformat()
-        except ValueError:
-            return None
+        return datetime.date(int(y) if y else hoy.year, mes, int(d))
+
+    # "en 3 días", "dentro de una semana"
+    m = _RE_EN_DIAS.match(texto)
+    if m:
+        n, unidad = m.groups()
+        n = 1 if n in ("un", "una") else int(n)
+        return hoy + datetime.timedelta(days=n * 7 if unidad.startswith("semana") else n)
+
+    # "viernes" / "este viernes": el próximo que toque, hoy incluido.
+    # "el próximo viernes" / "viernes que viene": nunca hoy.
+    m = _RE_DIA_SEMANA.match(texto)
+    if m:
+        antes, dia, despues = m.groups()
+        dias = (DIAS_SEMANA[dia] - hoy.weekday()) % 7
+        if dias == 0 and (antes in ("proximo", "siguiente") or despues):
+            dias = 7
+        return hoy + datetime.timedelta(days=dias)
 
     return None
 
 
+@lru_cache(maxsize=FECHAS_CACHE_MAX)
+def _parse_fecha(texto, hoy):
+    texto = _sin_acentos(texto.strip().lower()).rstrip(".,;!?")
+    texto = " ".join(texto.split())
+    if not texto:
+        return None
+
+    hora = None
+    m = _RE_HORA.match(texto)
+    # "2 h" o "10 hrs" son duraciones; la "h" solo marca hora junto a
+    # "a las" o con minutos ("a las 17 h", "17:30 h")
+    if m and (m.group("m") or m.group("a_las") or m.group("ampm") in ("am", "pm")):
+        h, minutos = int(m.group("h")), int(m.group("m") or 0)
+        if m.group("ampm") == "pm" and h < 12:
+            h += 12
+        elif m.group("ampm") == "am" and h == 12:
+            h = 0
+        elif not m.group("ampm") and not m.group("m") and 1 <= h <= 6:
+            # "a las 5": nadie agenda a las 5 de la madrugada
+            h += 12
+        if h > 23 or minutos > 59:
+            return None
+        hora = (h, minutos)
+        texto = m.group("resto")
+
+    try:
+        fecha = _fecha_sin_hora(texto, hoy)
+    except ValueError:
+        return None
+    if fecha is None:
+        return None
+    if hora is None:
+        return fecha.isoformat()
+    return f"{fecha.isoformat()}T{hora[0]:02d}:{hora[1]:02d}:00{ARES_UTC_OFFSET}"
+
+
+def parse_fecha_es(texto, hoy=None):
+    """
+    Convierte textos como:
+    - "hoy", "mañana", "pasado mañana", "ayer"
+    - "viernes", "el próximo lunes", "en 3 días", "dentro de una semana"
+    - "12/12/2025", "12-12-25", "12/12"
+    - "2025-12-12"
+    - "12 de diciembre", "12 diciembre 2025"
+    con hora opcional al final ("16:00", "a las 5", "4pm", "a las 17 h") en
+    fecha ISO (YYYY-MM-DD, o YYYY-MM-DDTHH:MM:00 con ARES_UTC_OFFSET si hay
+    hora). "a las 1" a "a las 6" sin am/pm se toman como de la tarde.
+    Devuelve None si no se puede interpretar.
+
+    Los resultados se memorizan por (texto, día de hoy).
+    """
+    return _parse_fecha(texto, hoy or datetime.date.today())
+
+
+def extraer_fecha(texto, hoy=None, max_palabras=6):
+    """
+    Separa una fecha escrita al final de un texto:
+    "junta kaizen viernes 16:00" -> ("junta kaizen", "2025-12-12T16:00:00-06:00").
+    Si no hay fecha (o el texto es solo la fecha) devuelve (texto, None).
+    Las duraciones ("estudiar 2 h") se quedan en el título; las horas se
+    leen con las mismas reglas que parse_fecha_es ("cena a las 5" es 17:00).
+    """
+    palabras = texto.split()
+    for n in range(min(len(palabras) - 1, max_palabras), 0, -1):
+        fecha = parse_fecha_es(" ".join(palabras[-n:]), hoy)
+        if fecha:
+            resto = palabras[:-n]
+            while len(resto) > 1 and _sin_acentos(resto[-1].lower()) in _CONECTORES_FECHA:
+                resto.pop()
+            return " ".join(resto), fecha
+    return texto, None
+
+
 def show_main_menu(chat_id):
     send_message(
         chat_id,
@@ -187,30 +910,614 @@ def show_main_menu(chat_id):
         reply_markup=MAIN_KEYBOARD,
     )
 
+# =========================
+#  CACHÉ
+# =========================
+
+class CacheTTL:
+    """
+    Diccionario LRU thread-safe donde cada entrada caduca a los `ttl`
+    segundos. Al pasar de `max_items` se descarta la menos usada.
+    """
+
+    def __init__(self, max_items, ttl):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._datos = OrderedDict()  # clave -> (expira_en, valor)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expiradas = 0
+        self.desalojadas = 0
+
+    def get(self, clave):
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                self.misses += 1
+                return None
+            if entrada[0] <= ahora:
+                del self._datos[clave]
+                self.expiradas += 1
+                self.misses += 1
+                return None
+            self._datos.move_to_end(clave)
+            self.hits += 1
+            return entrada[1]
+
+    def put(self, clave, valor):
+        with self._lock:
+            self._datos[clave] = (time.monotonic() + self.ttl, valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_items:
+                self._datos.popitem(last=False)
+                self.desalojadas += 1
+
+    def put_nuevo(self, clave, valor):
+        """Guarda solo si la clave no está (o caducó). Devuelve True si la guardó."""
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is not None and entrada[0] > ahora:
+                self.hits += 1
+                return False
+            self.misses += 1
+            self._datos[clave] = (ahora + self.ttl, valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_items:
+                self._datos.popitem(last=False)
+                self.desalojadas += 1
+            return True
+
+    def borrar(self, clave):
+        """Borra `clave` si está. Devuelve True si estaba."""
+        with self._lock:
+            return self._datos.pop(clave, None) is not None
+
+    def invalidar(self, predicado):
+        """Borra las entradas cuya clave cumple `predicado`. Devuelve cuántas."""
+        with self._lock:
+            claves = [c for c in self._datos if predicado(c)]
+            for c in claves:
+                del self._datos[c]
+            return len(claves)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entradas": len(self._datos),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "expiradas": self.expiradas,
+                "desalojadas": self.desalojadas,
+            }
+
+
+# Resultados de notion_query por (database_id, body). Cada escritura en una
+# base sube su "generación": una consulta que empezó antes de la escritura
+# no guarda su resultado, para no volver a meter datos viejos en la caché.
+#
+# La caché y su invalidación son por proceso: con varios workers de gunicorn,
+# una escritura en un worker no invalida lo cacheado en los demás, que pueden
+# servir listas y totales viejos hasta NOTION_CACHE_TTL segundos. Si eso no es
+# aceptable, NOTION_CACHE_TTL=0 la desactiva (el espejo SQLite sí se comparte).
+NOTION_CACHE = CacheTTL(NOTION_CACHE_MAX, NOTION_CACHE_TTL)
+_NOTION_GENERACION = {}
+_NOTION_GENERACION_LOCK = threading.Lock()
+
+
+def _clave_query(database_id, body):
+    return (database_id, json.dumps(body, sort_keys=True, ensure_ascii=False))
+
+
+def generacion_notion(database_id):
+    with _NOTION_GENERACION_LOCK:
+        return _NOTION_GENERACION.get(database_id, 0)
+
+
+def invalidar_cache_notion(database_id):
+    with _NOTION_GENERACION_LOCK:
+        _NOTION_GENERACION[database_id] = _NOTION_GENERACION.get(database_id, 0) + 1
+    NOTION_CACHE.invalidar(lambda clave: clave[0] == database_id)
+
+# =========================
+#  ALMACÉN LOCAL (SQLITE)
+# =========================
+
+# Tablas del almacén local. Todo vive en un solo archivo (ARES_DB_PATH) que
+# comparten los workers de gunicorn de la misma máquina.
+ESQUEMA_SQLITE = [
+    """
+    CREATE TABLE IF NOT EXISTS espejo_paginas (
+        base TEXT NOT NULL,
+        page_id TEXT NOT NULL,
+        editado TEXT NOT NULL,
+        fecha TEXT,
+        tipo TEXT,
+        estado TEXT,
+        pagina TEXT NOT NULL,
+        PRIMARY KEY (base, page_id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS espejo_paginas_fecha ON espejo_paginas (base, fecha)",
+    "CREATE INDEX IF NOT EXISTS espejo_paginas_tipo ON espejo_paginas (base, tipo, fecha)",
+    "CREATE INDEX IF NOT EXISTS espejo_paginas_estado ON espejo_paginas (base, estado)",
+    """
+    CREATE TABLE IF NOT EXISTS espejo_sync (
+        base TEXT PRIMARY KEY,
+        ultimo_editado TEXT,
+        sincronizado_en REAL,
+        completo_en REAL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS agregados_finanzas (
+        mes TEXT NOT NULL,
+        tipo TEXT NOT NULL,
+        categoria TEXT NOT NULL,
+        area TEXT NOT NULL,
+        total REAL NOT NULL,
+        movimientos INTEGER NOT NULL,
+        PRIMARY KEY (mes, tipo, categoria, area)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS agregados_meses (
+        mes TEXT PRIMARY KEY,
+        reconciliado_en REAL,
+        version INTEGER NOT NULL DEFAULT 0,
+        pendientes INTEGER NOT NULL DEFAULT 0,
+        pendiente_en REAL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sesiones (
+        chat_id INTEGER PRIMARY KEY,
+        datos TEXT NOT NULL,
+        actualizado REAL NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS updates_vistos (
+        update_id INTEGER PRIMARY KEY,
+        visto REAL NOT NULL
+    )
+    """,
+]
+
+_SQLITE_LOCAL = threading.local()
+_SQLITE_ESQUEMA_LOCK = threading.Lock()
+_SQLITE_ESQUEMA_PID = None
+
+
+def _migrar_sqlite(conexion):
+    """Adapta un archivo creado con un esquema anterior."""
+    columnas = {fila[1] for fila in conexion.execute("PRAGMA table_info(espejo_paginas)")}
+    if columnas and "fecha" not in columnas:
+        # El espejo es solo una copia: se descarta y el próximo sync lo baja completo
+        conexion.execute("DROP TABLE espejo_paginas")
+        conexion.execute("DELETE FROM espejo_sync")
+    columnas = {fila[1] for fila in conexion.execute("PRAGMA table_info(agregados_meses)")}
+    if columnas and "pendientes" not in columnas:
+        conexion.execute("ALTER TABLE agregados_meses ADD COLUMN pendientes INTEGER NOT NULL DEFAULT 0")
+        conexion.execute("ALTER TABLE agregados_meses ADD COLUMN pendiente_en REAL")
+
+
+def sqlite_conexion():
+    """
+    Conexión SQLite del hilo actual (sqlite3 no permite compartirlas entre
+    hilos). La primera conexión de cada proceso crea las tablas que falten.
+    Devuelve None si no hay ARES_DB_PATH configurado.
+    """
+    global _SQLITE_ESQUEMA_PID
+    if not ARES_DB_PATH:
+        return None
+    if getattr(_SQLITE_LOCAL, "pid", None) == os.getpid():
+        return _SQLITE_LOCAL.conexion
+
+    conexion = sqlite3.connect(ARES_DB_PATH, timeout=10, isolation_level=None)
+    conexion.execute("PRAGMA journal_mode=WAL")
+    conexion.execute("PRAGMA synchronous=NORMAL")
+    with _SQLITE_ESQUEMA_LOCK:
+        if _SQLITE_ESQUEMA_PID != os.getpid():
+            # En una transacción: otro worker puede estar haciendo lo mismo
+            conexion.execute("BEGIN IMMEDIATE")
+            try:
+                _migrar_sqlite(conexion)
+                for sentencia in ESQUEMA_SQLITE:
+                    conexion.execute(sentencia)
+                conexion.execute("COMMIT")
+            except Exception:
+                conexion.execute("ROLLBACK")
+                raise
+            _SQLITE_ESQUEMA_PID = os.getpid()
+    _SQLITE_LOCAL.pid = os.getpid()
+    _SQLITE_LOCAL.conexion = conexion
+    return conexion
+
+# =========================
+#  LÍMITES DE PETICIONES
+# =========================
+
+# Notion admite ~3 peticiones por segundo por integración. Todas las
+# llamadas pasan por un token bucket con clases de prioridad: mientras haya
+# una petición de clase más urgente esperando, las de clase menor no toman
+# token. Con varios workers de gunicorn, NOTION_RATE debe repartirse entre
+# ellos (cada proceso tiene su propio bucket).
+PRIORIDAD_INTERACTIVA = 0  # lecturas que un usuario está esperando
+PRIORIDAD_ESCRITURA = 1    # creación de páginas
+PRIORIDAD_FONDO = 2        # sync del espejo, reconciliaciones
+
+_PRIORIDAD_NOTION = contextvars.ContextVar("prioridad_notion", default=None)
+
+
+@contextmanager
+def prioridad_notion(prioridad):
+    """Fija la clase de prioridad de las llamadas a Notion dentro del bloque."""
+    token = _PRIORIDAD_NOTION.set(prioridad)
+    try:
+        yield
+    finally:
+        _PRIORIDAD_NOTION.reset(token)
+
+
+class LimitadorTasa:
+    """Token bucket thread-safe con las tres clases de prioridad de arriba."""
+
+    def __init__(self, tasa, rafaga):
+        self.tasa = tasa
+        self.rafaga = rafaga
+        self._tokens = float(rafaga)
+        self._ultimo = time.monotonic()
+        self._pausa_hasta = 0.0
+        self._cond = threading.Condition()
+        self._esperando = [0, 0, 0]
+        self.concedidas = [0, 0, 0]
+        self.espera_total = [0.0, 0.0, 0.0]
+        self.respuestas_429 = 0
+        self.reintentos = 0
+
+    def _recargar(self, ahora):
+        self._tokens = min(self.rafaga, self._tokens + (ahora - self._ultimo) * self.tasa)
+        self._ultimo = ahora
+
+    def adquirir(self, prioridad):
+        inicio = time.monotonic()
+        with self._cond:
+            self._esperando[prioridad] += 1
+            try:
+                while True:
+                    ahora = time.monotonic()
+                    self._recargar(ahora)
+                    if ahora < self._pausa_hasta:
+                        self._cond.wait(self._pausa_hasta - ahora)
+                    elif any(self._esperando[:prioridad]):
+                        self._cond.wait(1 / self.tasa)
+                    elif self._tokens >= 1:
+                        self._tokens -= 1
+                        break
+                    else:
+                        self._cond.wait((1 - self._tokens) / self.tasa)
+            finally:
+                self._esperando[prioridad] -= 1
+                self._cond.notify_all()
+            self.concedidas[prioridad] += 1
+            self.espera_total[prioridad] += time.monotonic() - inicio
+
+    def pausar(self, segundos):
+        """Nadie llama a Notion durante `segundos` (tras un 429)."""
+        with self._cond:
+            self.respuestas_429 += 1
+            self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+            self._tokens = 0.0
+
+    def contar_reintento(self):
+        with self._cond:
+            self.reintentos += 1
+
+    def stats(self):
+        with self._cond:
+            nombres = ("interactiva", "escritura", "fondo")
+            return {
+                "tasa": self.tasa,
+                "esperando": dict(zip(nombres, self._esperando)),
+                "concedidas": dict(zip(nombres, self.concedidas)),
+                "espera_media_s": {
+                    n: round(t / c, 4) if c else 0.0
+                    for n, t, c in zip(nombres, self.espera_total, self.concedidas)
+                },
+                "respuestas_429": self.respuestas_429,
+                "reintentos": self.reintentos,
+            }
+
+
+LIMITADOR_NOTION = LimitadorTasa(NOTION_RATE, NOTION_BURST)
+
+
+def notion_post(ruta, body, timeout, escritura=False):
+    """
+    POST a la API de Notion respetando el límite de peticiones.
+
+    Un 429 pausa a todo el proceso lo que indique Retry-After y se reintenta.
+    Los 5xx se reintentan con backoff exponencial solo en lecturas: repetir
+    la creación de una página podría duplicarla.
+    """
+    prioridad = _PRIORIDAD_NOTION.get()
+    if prioridad is None:
+        prioridad = PRIORIDAD_ESCRITURA if escritura else PRIORIDAD_INTERACTIVA
+
+    # La duración incluye la espera del limitador y los reintentos: es lo
+    # que tarda Notion para quien llama
+    operacion = "create_page" if ruta == "/pages" else "query"
+    with medir_dependencia("notion", operacion):
+        r = _notion_post_con_reintentos(ruta, body, timeout, escritura, prioridad)
+    if r.status_code >= 300:
+        DEPENDENCIA_ERRORES.inc("notion", operacion, f"http_{r.status_code}")
+    return r
+
+
+def _notion_post_con_reintentos(ruta, body, timeout, escritura, prioridad):
+    for intento in range(NOTION_MAX_RETRIES + 1):
+        LIMITADOR_NOTION.adquirir(prioridad)
+        r = http_post(
+            f"{NOTION_BASE_URL}{ruta}",
+            headers=NOTION_HEADERS,
+            json=body,
+            timeout=timeout,
+        )
+        if intento == NOTION_MAX_RETRIES:
+            break
+        if r.status_code == 429:
+            try:
+                espera = float(r.headers.get("Retry-After") or 1)
+            except ValueError:
+                espera = 1.0
+            LIMITADOR_NOTION.pausar(min(espera, NOTION_RETRY_AFTER_MAX))
+        elif r.status_code >= 500 and not escritura:
+            time.sleep(HTTP_BACKOFF * 2 ** intento)
+        else:
+            break
+        LIMITADOR_NOTION.contar_reintento()
+    return r
+
+# =========================
+#  ENVÍO A TELEGRAM
+# =========================
+
+# Telegram permite ~1 mensaje por segundo a un mismo chat y ~30 por segundo
+# en total. Con TELEGRAM_SEND_QUEUE=1, send_message solo encola y unos
+# pocos hilos entregan respetando ambos límites. Mientras un chat espera su
+# turno, sus mensajes consecutivos compatibles se juntan en uno solo (p. ej.
+# saludo + ayuda + menú de /start).
+
+TELEGRAM_MAX_TEXTO = 4096
+
+
+def _combinables(a, b):
+    if a.get("parse_mode") != b.get("parse_mode") or b.get("reply_to_message_id"):
+        return False
+    if a.get("reply_markup") and b.get("reply_markup") and a["reply_markup"] != b["reply_markup"]:
+        return False
+    return len(a["text"]) + 2 + len(b["text"]) <= TELEGRAM_MAX_TEXTO
+
+
+class ColaTelegram:
+    def __init__(self, workers, intervalo_chat, limitador):
+        self.workers = workers
+        self.intervalo_chat = intervalo_chat
+        self.limitador = limitador
+        self._cond = threading.Condition()
+        self._por_chat = {}      # chat_id -> deque de payloads
+        self._listos = []        # heap de (disponible_en, chat_id)
+        self._programados = set()
+        self._en_envio = set()
+        self._proximo = {}       # chat_id -> cuándo puede recibir otro mensaje
+        self._pid = None
+        self.encolados = 0
+        self.enviados = 0
+        self.combinados = 0
+        self.reintentos = 0
+        self.errores = 0
+
+    def _arrancar(self):
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for n in range(self.workers):
+                threading.Thread(target=self._worker, name=f"telegram-{n}", daemon=True).start()
+
+    def _programar(self, chat_id):
+        # Llamar con self._cond tomado
+        if chat_id in self._programados or chat_id in self._en_envio:
+            return
+        disponible = max(time.monotonic(), self._proximo.get(chat_id, 0.0))
+        heapq.heappush(self._listos, (disponible, chat_id))
+        self._programados.add(chat_id)
+        self._cond.notify()
+
+    def encolar(self, payload):
+        if self._pid != os.getpid():
+            self._arrancar()
+        chat_id = payload["chat_id"]
+        with self._cond:
+            self._por_chat.setdefault(chat_id, deque()).append(payload)
+            self.encolados += 1
+            self._programar(chat_id)
+
+    def _tomar_lote(self, chat_id):
+        # Primer mensaje del chat más los siguientes que se puedan juntar
+        fila = self._por_chat[chat_id]
+        payload = dict(fila.popleft())
+        while fila and _combinables(payload, fila[0]):
+            siguiente = fila.popleft()
+            payload["text"] = f"{payload['text']}\n\n{siguiente['text']}"
+            if siguiente.get("reply_markup"):
+                payload["reply_markup"] = siguiente["reply_markup"]
+            self.combinados += 1
+        return payload
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._listos or self._listos[0][0] > time.monotonic():
+                    espera = self._listos[0][0] - time.monotonic() if self._listos else None
+                    self._cond.wait(espera)
+                _, chat_id = heapq.heappop(self._listos)
+                self._programados.discard(chat_id)
+                self._en_envio.add(chat_id)
+                payload = self._tomar_lote(chat_id)
+
+            reintentar_en = self._entregar(payload)
+
+            with self._cond:
+                self._en_envio.discard(chat_id)
+                ahora = time.monotonic()
+                if reintentar_en is not None:
+                    self._por_chat[chat_id].appendleft(payload)
+                    self._proximo[chat_id] = ahora + reintentar_en
+                else:
+                    self._proximo[chat_id] = ahora + self.intervalo_chat
+                if self._por_chat[chat_id]:
+                    self._programar(chat_id)
+                else:
+                    del self._por_chat[chat_id]
+                    # Avisa a drenar() y reservar_chat(), si alguien espera
+                    self._cond.notify_all()
+                if len(self._proximo) > 1000:
+                    self._proximo = {c: t for c, t in self._proximo.items() if t > ahora}
+
+    @contextmanager
+    def reservar_chat(self, chat_id, timeout):
+        """
+        Para enviar a un chat por fuera de la cola (el streaming de la IA,
+        que necesita el message_id y edita) sin desordenar sus mensajes:
+        espera hasta `timeout` segundos a que se entregue lo pendiente del
+        chat y su intervalo, y mientras dure el bloque los workers no le
+        envían nada. Lo que se encole entretanto sale después, en orden.
+
+        Devuelve (con `as`) si se obtuvo la reserva. Si al vencer `timeout`
+        al chat todavía le quedan mensajes en la cola o en envío, es False y
+        el llamador no debe enviar directo: saldría desordenado.
+        """
+        limite = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                ahora = time.monotonic()
+                libre_en = self._proximo.get(chat_id, 0.0)
+                ocupado = chat_id in self._por_chat or chat_id in self._en_envio
+                if (not ocupado and libre_en <= ahora) or ahora >= limite:
+                    break
+                self._cond.wait(min(limite, libre_en if not ocupado else limite) - ahora)
+            reservado = not ocupado
+            if reservado:
+                self._en_envio.add(chat_id)
+        try:
+            yield reservado
+        finally:
+            if reservado:
+                with self._cond:
+                    self._en_envio.discard(chat_id)
+                    self._proximo[chat_id] = time.monotonic() + self.intervalo_chat
+                    if self._por_chat.get(chat_id):
+                        self._programar(chat_id)
+
+    def drenar(self, timeout):
+        """
+        Espera hasta `timeout` segundos a que se entregue todo lo encolado
+        (respetando los límites de Telegram). Devuelve cuántos mensajes
+        quedaron sin enviar. Sigue aceptando mensajes mientras tanto: los que
+        generen los últimos updates también deben salir.
+        """
+        limite = time.monotonic() + timeout
+        with self._cond:
+            if self._pid != os.getpid():
+                return 0
+            while self._por_chat or self._en_envio:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                self._cond.wait(restante)
+            return sum(len(f) for f in self._por_chat.values()) + len(self._en_envio)
+
+    def _entregar(self, payload):
+        """Envía el payload. Devuelve segundos a esperar si hay que reintentar."""
+        intentos = payload.pop("_intentos", 0)
+        self.limitador.adquirir(PRIORIDAD_INTERACTIVA)
+        try:
+            r = telegram_post("sendMessage", payload)
+        except Exception as e:
+            log.warning("Error enviando mensaje a Telegram: %s", e)
+            r = None
+        if r is not None and r.status_code < 300:
+            with self._cond:
+                self.enviados += 1
+            return None
+        if intentos < TELEGRAM_MAX_RETRIES and (r is None or r.status_code == 429 or r.status_code >= 500):
+            espera = HTTP_BACKOFF * 2 ** intentos
+            if r is not None and r.status_code == 429:
+                try:
+                    espera = float(r.json().get("parameters", {}).get("retry_after", 1))
+                except ValueError:
+                    espera = 1.0
+                self.limitador.pausar(min(espera, 1.0))
+            payload["_intentos"] = intentos + 1
+            with self._cond:
+                self.reintentos += 1
+            return espera
+        if r is not None:
+            log.error("Error enviando mensaje a Telegram", extra=campos(status=r.status_code, respuesta=r.text[:500]))
+        with self._cond:
+            self.errores += 1
+        return None
+
+    def stats(self):
+        with self._cond:
+            return {
+                "pendientes": sum(len(f) for f in self._por_chat.values()),
+                "encolados": self.encolados,
+                "enviados": self.enviados,
+                "combinados": self.combinados,
+                "reintentos": self.reintentos,
+                "errores": self.errores,
+            }
+
+
+COLA_TELEGRAM = ColaTelegram(
+    TELEGRAM_SEND_WORKERS,
+    TELEGRAM_CHAT_INTERVAL,
+    LimitadorTasa(TELEGRAM_GLOBAL_RATE, int(TELEGRAM_GLOBAL_RATE)),
+)
+
 # =========================
 #  NOTION – CREACIÓN PÁGINAS
 # =========================
 
 def notion_create_page(database_id, properties):
     if not database_id:
-        print("ERROR: database_id vacío al crear página en Notion.")
+        log.error("database_id vacío al crear página en Notion")
         return False
 
     data = {"parent": {"database_id": database_id}, "properties": properties}
     try:
-        r = requests.post(
-            f"{NOTION_BASE_URL}/pages",
-            headers=NOTION_HEADERS,
-            json=data,
-            timeout=20,
-        )
+        r = notion_post("/pages", data, timeout=20, escritura=True)
         if r.status_code >= 300:
-            print("Error creando página en Notion:", r.status_code, r.text)
+            log.error("Error creando página en Notion", extra=campos(status=r.status_code, respuesta=r.text[:500]))
             return False
+        try:
+            espejo_guardar(database_id, [r.json()])
+        except Exception:
+            log.exception("Error guardando página en el espejo local")
         return True
     except Exception as e:
-        print("Error de red creando página en Notion:", e)
+        # Un timeout no garantiza que Notion no haya creado la página
+        log.error("Error de red creando página en Notion: %s", e)
         return False
+    finally:
+        invalidar_cache_notion(database_id)
 
 
 def create_financial_record(movimiento, tipo, monto,
@@ -227,7 +1534,19 @@ def create_financial_record(movimiento, tipo, monto,
         "Area": {"select": {"name": area}},
         "Fecha": {"date": {"start": fecha}},
     }
-    return notion_create_page(NOTION_DB_FINANZAS, properties)
+    try:
+        agregados_marcar_pendiente(fecha)
+    except Exception:
+        log.exception("Error marcando escritura pendiente en agregados financieros")
+    ok = notion_create_page(NOTION_DB_FINANZAS, properties)
+    try:
+        if ok:
+            agregados_sumar(fecha, tipo, categoria, area, monto)
+        else:
+            agregados_cancelar_pendiente(fecha)
+    except Exception:
+        log.exception("Error actualizando agregados financieros")
+    return ok
 
 
 def create_task(nombre, fecha=None, area="General", estado="Pendiente",
@@ -294,75 +1613,760 @@ def create_habit(nombre, area="General", estado="Activo",
     return notion_create_page(NOTION_DB_HABITOS, properties)
 
 # =========================
-#  CONSULTAS A NOTION
+#  ESPEJO LOCAL DE NOTION
 # =========================
 
-def notion_query(database_id, body):
-    if not database_id:
-        print("ERROR: database_id vacío al consultar Notion.")
-        return {}
-    try:
-        r = requests.post(
-            f"{NOTION_BASE_URL}/databases/{database_id}/query",
-            headers=NOTION_HEADERS,
-            json=body,
-            timeout=25,
-        )
-        if r.status_code >= 300:
-            print("Error consultando Notion:", r.status_code, r.text)
-            return {}
-        return r.json()
-    except Exception as e:
-        print("Error de red consultando Notion:", e)
-        return {}
+# Copia en SQLite de las cinco bases. Un hilo por proceso la mantiene al día
+# pidiendo a Notion solo lo editado desde el último sync (last_edited_time);
+# cada MIRROR_FULL_SYNC_INTERVAL se baja la base completa para detectar
+# páginas borradas. Las consultas se responden desde aquí mientras el último
+# sync tenga menos de MIRROR_MAX_STALENESS segundos; si no, van a Notion.
 
+class _FiltroNoSoportado(Exception):
+    pass
 
-def resumen_finanzas_mes():
-    inicio, fin = inicio_fin_mes_actual()
-    body = {
-        "filter": {
-            "and": [
-                {"property": "Fecha", "date": {"on_or_after": inicio}},
-                {"property": "Fecha", "date": {"on_or_before": fin}},
-            ]
-        },
-        "page_size": 200,
-    }
-    data = notion_query(NOTION_DB_FINANZAS, body)
-    resultados = data.get("results", [])
-    total_ingresos = 0.0
-    total_gastos = 0.0
-    for page in resultados:
-        props = page.get("properties", {})
-        tipo = (props.get("Tipo", {}).get("select", {}) or {}).get("name", "")
-        monto = props.get("Monto", {}).get("number", 0) or 0
-        if tipo == "Ingreso":
-            total_ingresos += monto
-        elif tipo == "Egreso":
-            total_gastos += monto
-    balance = total_ingresos - total_gastos
-    return (
-        "*Resumen financiero del mes actual*\n\n"
-        f"• Ingresos: `{total_ingresos:,.2f}`\n"
-        f"• Gastos: `{total_gastos:,.2f}`\n"
-        f"• Balance: `{balance:,.2f}`"
-    )
 
+# Propiedades que además se guardan en columnas con índice, para resolver
+# en SQL los filtros por rango de fechas, tipo y estado y no decodificar
+# toda la base en cada consulta.
+COLUMNAS_ESPEJO = {"Fecha": "fecha", "Tipo": "tipo", "Estado": "estado"}
 
-def listar_tareas_hoy():
-    hoy = hoy_iso()
-    body = {
-        "filter": {
-            "and": [
-                {"property": "Fecha", "date": {"on_or_before": hoy}},
-                {"property": "Estado", "select": {"does_not_equal": "Completada"}},
-            ]
+# Notion ordena los select por el orden de sus opciones, que no conocemos;
+# para los que usamos en sorts aproximamos ese orden aquí.
+ORDEN_SELECT = {
+    "Alto": 3, "Medio": 2, "Bajo": 1,
+    "Alta": 3, "Media": 2, "Baja": 1,
+}
+
+
+def conexion_espejo():
+    """Conexión SQLite si el espejo está activo (MIRROR_ENABLED y ARES_DB_PATH), o None."""
+    return sqlite_conexion() if MIRROR_ENABLED else None
+
+
+def espejo_bases():
+    return [db for db in (
+        NOTION_DB_FINANZAS,
+        NOTION_DB_TAREAS,
+        NOTION_DB_EVENTOS,
+        NOTION_DB_PROYECTOS,
+        NOTION_DB_HABITOS,
+    ) if db]
+
+
+def _valor_propiedad(page, nombre):
+    prop = page.get("properties", {}).get(nombre) or {}
+    tipo = prop.get("type")
+    if not tipo:
+        tipo = next((k for k in ("title", "rich_text", "select", "number", "date") if k in prop), None)
+    valor = prop.get(tipo) if tipo else None
+    if tipo in ("title", "rich_text"):
+        return "".join(t.get("plain_text") or (t.get("text") or {}).get("content", "")
+                       for t in valor or [])
+    if tipo == "select":
+        return (valor or {}).get("name")
+    if tipo == "date":
+        return (valor or {}).get("start")
+    return valor
+
+
+def _cumple_filtro(page, filtro):
+    if "and" in filtro:
+        return all(_cumple_filtro(page, f) for f in filtro["and"])
+    if "or" in filtro:
+        return any(_cumple_filtro(page, f) for f in filtro["or"])
+
+    if "timestamp" in filtro:
+        valor = page.get(filtro["timestamp"])
+        condicion = filtro.get(filtro["timestamp"]) or {}
+        tipo = "date"
+    elif "property" in filtro:
+        valor = _valor_propiedad(page, filtro["property"])
+        tipo = next((k for k in filtro if k != "property"), None)
+        condicion = filtro.get(tipo) or {}
+    else:
+        raise _FiltroNoSoportado(filtro)
+
+    for op, esperado in condicion.items():
+        if tipo == "date":
+            # Comparamos solo la parte de fecha, como hace Notion con
+            # filtros de día completo
+            fecha = (valor or "")[:10]
+            esperado = (esperado or "")[:10]
+            if not fecha:
+                ok = op == "is_empty"
+            elif op == "on_or_after":
+                ok = fecha >= esperado
+            elif op == "on_or_before":
+                ok = fecha <= esperado
+            elif op == "after":
+                ok = fecha > esperado
+            elif op == "before":
+                ok = fecha < esperado
+            elif op == "equals":
+                ok = fecha == esperado
+            else:
+                raise _FiltroNoSoportado(filtro)
+        elif tipo in ("select", "number"):
+            if op == "equals":
+                ok = valor == esperado
+            elif op == "does_not_equal":
+                ok = valor != esperado
+            elif op == "is_empty":
+                ok = valor is None
+            elif op == "is_not_empty":
+                ok = valor is not None
+            else:
+                raise _FiltroNoSoportado(filtro)
+        elif tipo in ("title", "rich_text"):
+            texto = (valor or "").lower()
+            if op == "contains":
+                ok = esperado.lower() in texto
+            elif op == "equals":
+                ok = texto == esperado.lower()
+            else:
+                raise _FiltroNoSoportado(filtro)
+        else:
+            raise _FiltroNoSoportado(filtro)
+        if not ok:
+            return False
+    return True
+
+
+def _clave_orden(valor):
+    if isinstance(valor, str):
+        return (ORDEN_SELECT.get(valor, 0), valor)
+    return (0, valor)
+
+
+def _ordenar_paginas(paginas, sorts):
+    # Se aplica del último criterio al primero (sort estable). Como en
+    # Notion, las páginas sin valor quedan al final en ambas direcciones.
+    for criterio in reversed(sorts):
+        if "timestamp" in criterio:
+            valores = [p.get(criterio["timestamp"]) for p in paginas]
+        elif "property" in criterio:
+            valores = [_valor_propiedad(p, criterio["property"]) for p in paginas]
+        else:
+            raise _FiltroNoSoportado(criterio)
+        con_valor = [(v, p) for v, p in zip(valores, paginas) if v is not None]
+        sin_valor = [p for v, p in zip(valores, paginas) if v is None]
+        con_valor.sort(
+            key=lambda par: _clave_orden(par[0]),
+            reverse=criterio.get("direction") == "descending",
+        )
+        paginas = [p for _, p in con_valor] + sin_valor
+    return paginas
+
+
+def _columnas_pagina(page):
+    valores = (_valor_propiedad(page, nombre) for nombre in COLUMNAS_ESPEJO)
+    return tuple(v if isinstance(v, str) and v else None for v in valores)
+
+
+def _condicion_sql(filtro):
+    """(sql, params) de un filtro simple sobre una columna del espejo, o None."""
+    columna = COLUMNAS_ESPEJO.get(filtro.get("property"))
+    tipo = next((k for k in filtro if k != "property"), None)
+    condicion = filtro.get(tipo) or {}
+    if not columna or len(condicion) != 1:
+        return None
+    (op, esperado), = condicion.items()
+    if columna == "fecha" and tipo == "date":
+        if op == "is_empty":
+            return "fecha IS NULL", []
+        # Como _cumple_filtro, solo cuenta el día: "2025-12-10T16:00" es del 10
+        try:
+            dia = datetime.date.fromisoformat((esperado or "")[:10])
+        except ValueError:
+            return None
+        siguiente = (dia + datetime.timedelta(days=1)).isoformat()
+        dia = dia.isoformat()
+        return {
+            "on_or_after": ("fecha >= ?", [dia]),
+            "after": ("fecha >= ?", [siguiente]),
+            "before": ("fecha < ?", [dia]),
+            "on_or_before": ("fecha < ?", [siguiente]),
+            "equals": ("fecha >= ? AND fecha < ?", [dia, siguiente]),
+        }.get(op)
+    if columna != "fecha" and tipo == "select":
+        if op == "is_empty":
+            return f"{columna} IS NULL", []
+        if op == "is_not_empty":
+            return f"{columna} IS NOT NULL", []
+        if esperado is None:
+            return None
+        if op == "equals":
+            return f"{columna} = ?", [esperado]
+        if op == "does_not_equal":
+            return f"({columna} IS NULL OR {columna} != ?)", [esperado]
+    return None
+
+
+def _filtro_sql(filtro):
+    """
+    Parte del filtro que se resuelve en SQL: (condiciones, params, completo).
+    `completo` es False si queda algo que evaluar con _cumple_filtro.
+    """
+    partes = filtro["and"] if list(filtro) == ["and"] else [filtro]
+    condiciones, params, completo = [], [], True
+    for parte in partes:
+        traducida = _condicion_sql(parte)
+        if traducida is None:
+            completo = False
+            continue
+        condiciones.append(traducida[0])
+        params.extend(traducida[1])
+    return condiciones, params, completo
+
+
+def _orden_sql(sorts):
+    # Solo el orden por Fecha; las páginas sin fecha al final, como Notion
+    if len(sorts) == 1 and sorts[0].get("property") == "Fecha":
+        direccion = "DESC" if sorts[0].get("direction") == "descending" else "ASC"
+        return f"fecha IS NULL, fecha {direccion}, editado DESC"
+    return None
+
+
+def espejo_guardar(database_id, paginas):
+    conexion = conexion_espejo()
+    if conexion is None or not database_id:
+        return
+    filas = [
+        (database_id, p["id"], p.get("last_edited_time") or "", *_columnas_pagina(p),
+         json.dumps(p, ensure_ascii=False))
+        for p in paginas if p.get("id")
+    ]
+    if not filas:
+        return
+    conexion.executemany(
+        "INSERT OR REPLACE INTO espejo_paginas (base, page_id, editado, fecha, tipo, estado, pagina) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        filas,
+    )
+
+
+def espejo_consultar(database_id, body, limit=None):
+    """
+    Responde una consulta de Notion desde el espejo. Devuelve la lista de
+    páginas, o None si el espejo no está activo, está desactualizado o el
+    filtro usa algo que no sabemos evaluar localmente.
+    """
+    conexion = conexion_espejo()
+    if conexion is None:
+        return None
+    _asegurar_sync_espejo()
+    fila = conexion.execute(
+        "SELECT sincronizado_en FROM espejo_sync WHERE base = ?", (database_id,)
+    ).fetchone()
+    if not fila or not fila[0] or time.time() - fila[0] > MIRROR_MAX_STALENESS:
+        return None
+
+    condiciones, params, filtro_completo = (
+        _filtro_sql(body["filter"]) if body.get("filter") else ([], [], True)
+    )
+    orden = _orden_sql(body["sorts"]) if body.get("sorts") else "editado DESC"
+    sql = (
+        "SELECT pagina FROM espejo_paginas WHERE " + " AND ".join(["base = ?", *condiciones])
+        + " ORDER BY " + (orden or "editado DESC")
+    )
+    params = [database_id, *params]
+    # El LIMIT solo puede ir en SQL si ahí se resolvieron el filtro y el orden
+    en_sql = filtro_completo and orden is not None
+    if limit and en_sql:
+        sql += " LIMIT ?"
+        params.append(limit)
+    filas = conexion.execute(sql, params).fetchall()
+    try:
+        paginas = [json.loads(f[0]) for f in filas]
+        if not filtro_completo:
+            paginas = [p for p in paginas if _cumple_filtro(p, body["filter"])]
+        if orden is None:
+            paginas = _ordenar_paginas(paginas, body["sorts"])
+    except _FiltroNoSoportado:
+        return None
+    return paginas[:limit] if limit and not en_sql else paginas
+
+
+def espejo_sincronizar(database_id, completo=False):
+    """
+    Trae a SQLite lo editado en Notion desde el último sync de la base.
+
+    Devuelve False si Notion falló: entonces no se toca nada, ni las páginas
+    ni la hora del sync, y cuando el espejo caduque las consultas irán a
+    Notion. Un fallo nunca debe leerse como "la base está vacía".
+    """
+    conexion = conexion_espejo()
+    if conexion is None:
+        return False
+    fila = conexion.execute(
+        "SELECT ultimo_editado, completo_en FROM espejo_sync WHERE base = ?",
+        (database_id,),
+    ).fetchone()
+    ultimo_editado, completo_en = fila if fila else (None, None)
+    if not ultimo_editado or not completo_en or time.time() - completo_en > MIRROR_FULL_SYNC_INTERVAL:
+        completo = True
+
+    inicio = time.time()
+    body = {"sorts": [{"timestamp": "last_edited_time", "direction": "ascending"}]}
+    if not completo:
+        body["filter"] = {
+            "timestamp": "last_edited_time",
+            "last_edited_time": {"on_or_after": ultimo_editado},
+        }
+    try:
+        paginas = list(notion_query_iter(database_id, body, en_vivo=True))
+    except ErrorNotion as e:
+        log.warning("Sync del espejo cancelado, Notion no respondió: %s", e, extra=campos(base=database_id))
+        return False
+    mayor = max([p.get("last_edited_time") or "" for p in paginas] + [ultimo_editado or ""])
+
+    conexion.execute("BEGIN IMMEDIATE")
+    try:
+        if completo:
+            conexion.execute("DELETE FROM espejo_paginas WHERE base = ?", (database_id,))
+        espejo_guardar(database_id, paginas)
+        conexion.execute(
+            "INSERT INTO espejo_sync (base, ultimo_editado, sincronizado_en, completo_en) "
+            "VALUES (?, ?, ?, ?) ON CONFLICT(base) DO UPDATE SET "
+            "ultimo_editado = excluded.ultimo_editado, "
+            "sincronizado_en = excluded.sincronizado_en, "
+            "completo_en = COALESCE(excluded.completo_en, espejo_sync.completo_en)",
+            (database_id, mayor or None, inicio, inicio if completo else None),
+        )
+        conexion.execute("COMMIT")
+    except Exception:
+        conexion.execute("ROLLBACK")
+        raise
+    return True
+
+
+_ESPEJO_LOCK = threading.Lock()
+_ESPEJO_PID = None
+
+
+def _asegurar_sync_espejo():
+    # Un hilo de sync por proceso, arrancado en el primer uso (después del
+    # fork de gunicorn).
+    global _ESPEJO_PID
+    if _ESPEJO_PID == os.getpid():
+        return
+    with _ESPEJO_LOCK:
+        if _ESPEJO_PID == os.getpid():
+            return
+        _ESPEJO_PID = os.getpid()
+        threading.Thread(target=_bucle_sync_espejo, name="espejo-sync", daemon=True).start()
+
+
+def _bucle_sync_espejo():
+    _PRIORIDAD_NOTION.set(PRIORIDAD_FONDO)
+    while True:
+        for database_id in espejo_bases():
+            # Todo dentro del try: un "database is locked" con varios workers
+            # no debe matar el hilo, que no se vuelve a arrancar
+            try:
+                # Si otro worker sincronizó hace poco, no repetimos el trabajo
+                fila = conexion_espejo().execute(
+                    "SELECT sincronizado_en FROM espejo_sync WHERE base = ?", (database_id,)
+                ).fetchone()
+                if fila and fila[0] and time.time() - fila[0] < MIRROR_SYNC_INTERVAL / 2:
+                    continue
+                espejo_sincronizar(database_id)
+            except Exception as e:
+                log.error("Error sincronizando espejo de Notion: %s", e, extra=campos(base=database_id))
+        time.sleep(MIRROR_SYNC_INTERVAL)
+
+
+def espejo_stats():
+    conexion = conexion_espejo()
+    if conexion is None:
+        return {"activo": False}
+    bases = {}
+    for base, sincronizado_en in conexion.execute("SELECT base, sincronizado_en FROM espejo_sync"):
+        paginas = conexion.execute(
+            "SELECT COUNT(*) FROM espejo_paginas WHERE base = ?", (base,)
+        ).fetchone()[0]
+        bases[base] = {
+            "paginas": paginas,
+            "antiguedad_s": round(time.time() - sincronizado_en, 1) if sincronizado_en else None,
+        }
+    return {"activo": True, "bases": bases}
+
+# =========================
+#  AGREGADOS FINANCIEROS
+# =========================
+
+# Totales de movimientos por (mes, Tipo, Categoría, Area) guardados en
+# SQLite. create_financial_record los actualiza al momento y cada
+# AGREGADOS_RECONCILE_INTERVAL se recalcula el mes contra Notion para
+# corregir lo que se haya editado o borrado directamente allí.
+#
+# `version` cuenta las sumas incrementales de cada mes: si cambia mientras
+# se reconcilia, el recálculo se descarta porque pudo perderse esa suma.
+# `pendientes` cuenta los movimientos que se están creando en Notion: se
+# marca antes del POST y se quita al sumar. Una reconciliación con
+# escrituras pendientes se descarta, porque pudo ver la página nueva en
+# Notion y agregados_sumar la contaría otra vez.
+
+_AGREGADOS_LOCK = threading.Lock()
+_AGREGADOS_EN_CURSO = set()
+
+
+def _body_finanzas(inicio, fin):
+    return {
+        "filter": {
+            "and": [
+                {"property": "Fecha", "date": {"on_or_after": inicio}},
+                {"property": "Fecha", "date": {"on_or_before": fin}},
+            ]
+        },
+    }
+
+
+def _rango_mes(mes):
+    anio, m = map(int, mes.split("-"))
+    inicio = datetime.date(anio, m, 1)
+    siguiente = datetime.date(anio + (m == 12), m % 12 + 1, 1)
+    return inicio.isoformat(), (siguiente - datetime.timedelta(days=1)).isoformat()
+
+
+def conexion_agregados():
+    """Conexión SQLite si los agregados están activos (AGREGADOS_ENABLED y ARES_DB_PATH), o None."""
+    return sqlite_conexion() if AGREGADOS_ENABLED else None
+
+
+def agregados_marcar_pendiente(fecha):
+    """Avisa a las reconciliaciones de `fecha` que hay un movimiento en camino."""
+    conexion = conexion_agregados()
+    if conexion is None:
+        return
+    conexion.execute(
+        "INSERT INTO agregados_meses (mes, version, pendientes, pendiente_en) VALUES (?, 1, 1, ?) "
+        "ON CONFLICT(mes) DO UPDATE SET version = version + 1, pendientes = pendientes + 1, "
+        "pendiente_en = excluded.pendiente_en",
+        (fecha[:7], time.time()),
+    )
+
+
+def agregados_cancelar_pendiente(fecha):
+    """La creación falló: quita la marca. Sube la versión por si Notion la creó igual."""
+    conexion = conexion_agregados()
+    if conexion is None:
+        return
+    conexion.execute(
+        "UPDATE agregados_meses SET version = version + 1, pendientes = MAX(pendientes - 1, 0) "
+        "WHERE mes = ?",
+        (fecha[:7],),
+    )
+
+
+def _hay_pendientes(fila):
+    pendientes, pendiente_en = fila
+    return bool(pendientes) and time.time() - (pendiente_en or 0) < AGREGADOS_PENDIENTE_MAX
+
+
+def agregados_sumar(fecha, tipo, categoria, area, monto):
+    conexion = conexion_agregados()
+    if conexion is None:
+        return
+    mes = fecha[:7]
+    conexion.execute("BEGIN IMMEDIATE")
+    try:
+        conexion.execute(
+            "INSERT INTO agregados_finanzas (mes, tipo, categoria, area, total, movimientos) "
+            "VALUES (?, ?, ?, ?, ?, 1) ON CONFLICT(mes, tipo, categoria, area) DO UPDATE SET "
+            "total = total + excluded.total, movimientos = movimientos + 1",
+            (mes, tipo, categoria, area, float(monto)),
+        )
+        conexion.execute(
+            "INSERT INTO agregados_meses (mes, version) VALUES (?, 1) "
+            "ON CONFLICT(mes) DO UPDATE SET version = version + 1, pendientes = MAX(pendientes - 1, 0)",
+            (mes,),
+        )
+        conexion.execute("COMMIT")
+    except Exception:
+        conexion.execute("ROLLBACK")
+        raise
+
+
+def agregados_reconciliar(mes):
+    """
+    Recalcula los totales de `mes` (YYYY-MM) con todos sus movimientos en
+    Notion. Si Notion falla, o hay movimientos del mes creándose, se deja
+    todo como estaba (totales y fecha de reconciliación) y devuelve False.
+    """
+    conexion = conexion_agregados()
+    if conexion is None or not NOTION_DB_FINANZAS:
+        return False
+    fila = conexion.execute(
+        "SELECT version, pendientes, pendiente_en FROM agregados_meses WHERE mes = ?", (mes,)
+    ).fetchone()
+    if fila and _hay_pendientes(fila[1:]):
+        return False
+    version = fila[0] if fila else 0
+
+    totales = {}
+    try:
+        for page in notion_query_iter(NOTION_DB_FINANZAS, _body_finanzas(*_rango_mes(mes)), en_vivo=True):
+            clave = (
+                _valor_propiedad(page, "Tipo") or "",
+                _valor_propiedad(page, "Categoría") or "",
+                _valor_propiedad(page, "Area") or "",
+            )
+            total, movimientos = totales.get(clave, (0.0, 0))
+            totales[clave] = (total + (_valor_propiedad(page, "Monto") or 0), movimientos + 1)
+    except ErrorNotion as e:
+        log.warning("Reconciliación de agregados cancelada, Notion no respondió: %s", e, extra=campos(mes=mes))
+        return False
+
+    conexion.execute("BEGIN IMMEDIATE")
+    try:
+        fila = conexion.execute(
+            "SELECT version, pendientes, pendiente_en FROM agregados_meses WHERE mes = ?", (mes,)
+        ).fetchone()
+        if (fila[0] if fila else 0) != version or (fila and _hay_pendientes(fila[1:])):
+            conexion.execute("ROLLBACK")
+            return False
+        conexion.execute("DELETE FROM agregados_finanzas WHERE mes = ?", (mes,))
+        conexion.executemany(
+            "INSERT INTO agregados_finanzas (mes, tipo, categoria, area, total, movimientos) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(mes, *clave, total, n) for clave, (total, n) in totales.items()],
+        )
+        conexion.execute(
+            "INSERT INTO agregados_meses (mes, reconciliado_en, version) VALUES (?, ?, ?) "
+            "ON CONFLICT(mes) DO UPDATE SET reconciliado_en = excluded.reconciliado_en, pendientes = 0",
+            (mes, time.time(), version),
+        )
+        conexion.execute("COMMIT")
+    except Exception:
+        conexion.execute("ROLLBACK")
+        raise
+    return True
+
+
+def _reconciliar_en_segundo_plano(mes):
+    with _AGREGADOS_LOCK:
+        if mes in _AGREGADOS_EN_CURSO:
+            return
+        _AGREGADOS_EN_CURSO.add(mes)
+
+    def tarea():
+        try:
+            with prioridad_notion(PRIORIDAD_FONDO):
+                agregados_reconciliar(mes)
+        except Exception:
+            log.exception("Error reconciliando agregados financieros", extra=campos(mes=mes))
+        finally:
+            with _AGREGADOS_LOCK:
+                _AGREGADOS_EN_CURSO.discard(mes)
+
+    threading.Thread(target=tarea, name=f"agregados-{mes}", daemon=True).start()
+
+
+_AGREGADOS_PID = None
+
+
+def _asegurar_reconciliacion_periodica():
+    # Un hilo por proceso, arrancado en el primer uso como el del espejo
+    global _AGREGADOS_PID
+    if _AGREGADOS_PID == os.getpid():
+        return
+    with _AGREGADOS_LOCK:
+        if _AGREGADOS_PID == os.getpid():
+            return
+        _AGREGADOS_PID = os.getpid()
+        threading.Thread(target=_bucle_reconciliar_agregados, name="agregados-periodico", daemon=True).start()
+
+
+def _bucle_reconciliar_agregados():
+    # Reconciliar cada AGREGADOS_RECONCILE_INTERVAL aunque nadie consulte:
+    # el mes actual y el anterior, si ya se habían reconciliado alguna vez
+    while True:
+        time.sleep(AGREGADOS_RECONCILE_INTERVAL)
+        hoy = datetime.date.today()
+        anterior = hoy.replace(day=1) - datetime.timedelta(days=1)
+        for mes in (hoy.isoformat()[:7], anterior.isoformat()[:7]):
+            try:
+                fila = conexion_agregados().execute(
+                    "SELECT reconciliado_en FROM agregados_meses WHERE mes = ?", (mes,)
+                ).fetchone()
+                # Si otro worker lo reconcilió hace poco, no repetimos el trabajo
+                if fila and fila[0] and time.time() - fila[0] >= AGREGADOS_RECONCILE_INTERVAL:
+                    _reconciliar_en_segundo_plano(mes)
+            except Exception as e:
+                log.error("Error programando la reconciliación de agregados: %s", e, extra=campos(mes=mes))
+
+
+def agregados_consultar(mes, tipo=None, categoria=None, area=None):
+    """
+    Devuelve (total, movimientos) de `mes` para los criterios dados, o None
+    si no hay agregados disponibles (sin SQLite o sin poder reconciliar).
+    La primera consulta de un mes lo reconcilia en el momento; después, si
+    la reconciliación es vieja, se repite en segundo plano, y un hilo por
+    proceso reconcilia el mes actual y el anterior cada
+    AGREGADOS_RECONCILE_INTERVAL.
+    """
+    conexion = conexion_agregados()
+    if conexion is None:
+        return None
+    _asegurar_reconciliacion_periodica()
+    fila = conexion.execute("SELECT reconciliado_en FROM agregados_meses WHERE mes = ?", (mes,)).fetchone()
+    if not fila or not fila[0]:
+        if not agregados_reconciliar(mes):
+            return None
+    elif time.time() - fila[0] > AGREGADOS_RECONCILE_INTERVAL:
+        _reconciliar_en_segundo_plano(mes)
+
+    condiciones, params = ["mes = ?"], [mes]
+    for columna, valor in (("tipo", tipo), ("categoria", categoria), ("area", area)):
+        if valor is not None:
+            condiciones.append(f"{columna} = ?")
+            params.append(valor)
+    total, movimientos = conexion.execute(
+        "SELECT COALESCE(SUM(total), 0), COALESCE(SUM(movimientos), 0) FROM agregados_finanzas WHERE "
+        + " AND ".join(condiciones),
+        params,
+    ).fetchone()
+    return total, movimientos
+
+# =========================
+#  CONSULTAS A NOTION
+# =========================
+
+class ErrorNotion(Exception):
+    """Una consulta a Notion falló (HTTP, red o JSON inválido)."""
+
+
+NOTION_ERROR_TEXTO = "No pude consultar Notion en este momento. Inténtalo de nuevo en un rato."
+
+
+def notion_query(database_id, body, en_vivo=False):
+    """
+    Una página de resultados de una consulta. Lanza ErrorNotion si Notion
+    no respondió bien: un fallo no debe confundirse con "no hay resultados".
+    """
+    if not database_id:
+        log.error("database_id vacío al consultar Notion")
+        return {}
+
+    clave = _clave_query(database_id, body)
+    usar_cache = NOTION_CACHE_TTL > 0 and not en_vivo
+    if usar_cache:
+        cacheado = NOTION_CACHE.get(clave)
+        if cacheado is not None:
+            return cacheado
+    generacion = generacion_notion(database_id)
+
+    try:
+        r = notion_post(f"/databases/{database_id}/query", body, timeout=25)
+    except Exception as e:
+        log.error("Error de red consultando Notion: %s", e)
+        raise ErrorNotion(f"red: {e}") from e
+    if r.status_code >= 300:
+        log.error("Error consultando Notion", extra=campos(status=r.status_code, respuesta=r.text[:500]))
+        raise ErrorNotion(f"HTTP {r.status_code}")
+    try:
+        data = r.json()
+    except ValueError as e:
+        log.error("Respuesta de Notion no es JSON", extra=campos(respuesta=r.text[:500]))
+        raise ErrorNotion("JSON inválido") from e
+    if usar_cache and generacion_notion(database_id) == generacion:
+        NOTION_CACHE.put(clave, data)
+    return data
+
+
+def notion_query_paginas(database_id, body, en_vivo=False):
+    """
+    Generador con las respuestas sucesivas de una consulta, siguiendo
+    `has_more`/`next_cursor`. Cada respuesta trae hasta `page_size`
+    resultados; la siguiente solo se pide cuando se consume la anterior.
+    Si falla cualquier página se propaga ErrorNotion, nunca una lista a medias.
+    """
+    body = dict(body)
+    while True:
+        data = notion_query(database_id, body, en_vivo=en_vivo)
+        yield data
+        if not data.get("has_more") or not data.get("next_cursor"):
+            return
+        body["start_cursor"] = data["next_cursor"]
+
+
+def notion_query_iter(database_id, body, limit=None, en_vivo=False):
+    """
+    Recorre los resultados de una consulta uno a uno, pidiendo páginas de a
+    lo más NOTION_PAGE_SIZE_MAX. Con `limit` deja de pedir páginas en cuanto
+    tiene suficientes resultados.
+
+    Si el espejo local está al día, responde desde SQLite sin tocar Notion.
+    `en_vivo=True` se salta espejo y caché. Lanza ErrorNotion si falla
+    alguna página.
+    """
+    if not en_vivo and database_id:
+        paginas = espejo_consultar(database_id, body, limit)
+        if paginas is not None:
+            yield from paginas
+            return
+
+    body = dict(body)
+    page_size = min(body.get("page_size", NOTION_PAGE_SIZE_MAX), NOTION_PAGE_SIZE_MAX)
+    if limit:
+        page_size = min(page_size, limit)
+    body["page_size"] = page_size
+
+    entregados = 0
+    for data in notion_query_paginas(database_id, body, en_vivo=en_vivo):
+        for page in data.get("results", []):
+            yield page
+            entregados += 1
+            if limit and entregados >= limit:
+                return
+
+
+def totales_finanzas_mes():
+    """(ingresos, gastos) del mes actual, desde los agregados si hay."""
+    mes = hoy_iso()[:7]
+    ingresos = agregados_consultar(mes, tipo="Ingreso")
+    gastos = agregados_consultar(mes, tipo="Egreso")
+    if ingresos is not None and gastos is not None:
+        return ingresos[0], gastos[0]
+
+    total_ingresos = 0.0
+    total_gastos = 0.0
+    for page in notion_query_iter(NOTION_DB_FINANZAS, _body_finanzas(*inicio_fin_mes_actual())):
+        props = page.get("properties", {})
+        tipo = (props.get("Tipo", {}).get("select", {}) or {}).get("name", "")
+        monto = props.get("Monto", {}).get("number", 0) or 0
+        if tipo == "Ingreso":
+            total_ingresos += monto
+        elif tipo == "Egreso":
+            total_gastos += monto
+    return total_ingresos, total_gastos
+
+
+def resumen_finanzas_mes():
+    total_ingresos, total_gastos = totales_finanzas_mes()
+    balance = total_ingresos - total_gastos
+    return (
+        "*Resumen financiero del mes actual*\n\n"
+        f"• Ingresos: `{total_ingresos:,.2f}`\n"
+        f"• Gastos: `{total_gastos:,.2f}`\n"
+        f"• Balance: `{balance:,.2f}`"
+    )
+
+
+def listar_tareas_hoy(limit=50):
+    hoy = hoy_iso()
+    body = {
+        "filter": {
+            "and": [
+                {"property": "Fecha", "date": {"on_or_before": hoy}},
+                {"property": "Estado", "select": {"does_not_equal": "Completada"}},
+            ]
         },
         "sorts": [{"property": "Fecha", "direction": "ascending"}],
-        "page_size": 50,
     }
-    data = notion_query(NOTION_DB_TAREAS, body)
-    resultados = data.get("results", [])
+    resultados = list(notion_query_iter(NOTION_DB_TAREAS, body, limit=limit))
     if not resultados:
         return "No tienes tareas pendientes para hoy. 😌"
     lineas = ["*Tareas para hoy / atrasadas:*"]
@@ -377,7 +2381,7 @@ def listar_tareas_hoy():
     return "\n".join(lineas)
 
 
-def listar_eventos_hoy_y_proximos(dias=3):
+def listar_eventos_hoy_y_proximos(dias=3, limit=50):
     hoy = datetime.date.today()
     fin = hoy + datetime.timedelta(days=dias)
     body = {
@@ -388,10 +2392,8 @@ def listar_eventos_hoy_y_proximos(dias=3):
             ]
         },
         "sorts": [{"property": "Fecha", "direction": "ascending"}],
-        "page_size": 50,
     }
-    data = notion_query(NOTION_DB_EVENTOS, body)
-    resultados = data.get("results", [])
+    resultados = list(notion_query_iter(NOTION_DB_EVENTOS, body, limit=limit))
     if not resultados:
         return f"No tienes eventos hoy ni en los próximos {dias} días. 🙂"
     lineas = [f"*Eventos hoy y próximos {dias} días:*"]
@@ -410,10 +2412,8 @@ def listar_proyectos_activos(limit=10):
     body = {
         "filter": {"property": "Estado", "select": {"equals": "Activo"}},
         "sorts": [{"property": "Impacto", "direction": "descending"}],
-        "page_size": limit,
     }
-    data = notion_query(NOTION_DB_PROYECTOS, body)
-    resultados = data.get("results", [])
+    resultados = list(notion_query_iter(NOTION_DB_PROYECTOS, body, limit=limit))
     if not resultados:
         return "No tienes proyectos activos."
     lineas = ["*Proyectos activos:*"]
@@ -432,10 +2432,8 @@ def listar_habitos_activos(limit=20):
         return "No tengo conectada la base de hábitos."
     body = {
         "filter": {"property": "Estado", "select": {"equals": "Activo"}},
-        "page_size": limit,
     }
-    data = notion_query(NOTION_DB_HABITOS, body)
-    resultados = data.get("results", [])
+    resultados = list(notion_query_iter(NOTION_DB_HABITOS, body, limit=limit))
     if not resultados:
         return "No tienes hábitos activos registrados."
     lineas = ["*Hábitos activos:*"]
@@ -448,35 +2446,82 @@ def listar_habitos_activos(limit=20):
     return "\n".join(lineas)
 
 
-def snapshot_contexto():
-    try:
-        resumen_fin = resumen_finanzas_mes()
-    except Exception:
-        resumen_fin = "No se pudo obtener el resumen financiero."
-    try:
-        tareas = listar_tareas_hoy()
-    except Exception:
-        tareas = "No se pudieron obtener las tareas."
-    try:
-        eventos = listar_eventos_hoy_y_proximos(3)
-    except Exception:
-        eventos = "No se pudieron obtener los eventos."
-    try:
-        proyectos = listar_proyectos_activos(10)
-    except Exception:
-        proyectos = "No se pudieron obtener los proyectos."
-    try:
-        habitos = listar_habitos_activos(10)
-    except Exception:
-        habitos = "No se pudieron obtener los hábitos."
+# Secciones del resumen general, en el orden en que se muestran:
+# (nombre, función, argumentos, texto si falla o no llega a tiempo)
+SECCIONES_SNAPSHOT = (
+    ("finanzas", resumen_finanzas_mes, (), "No se pudo obtener el resumen financiero."),
+    ("tareas", listar_tareas_hoy, (), "No se pudieron obtener las tareas."),
+    ("eventos", listar_eventos_hoy_y_proximos, (3,), "No se pudieron obtener los eventos."),
+    ("proyectos", listar_proyectos_activos, (10,), "No se pudieron obtener los proyectos."),
+    ("habitos", listar_habitos_activos, (10,), "No se pudieron obtener los hábitos."),
+)
+
+_SNAPSHOT_LOCK = threading.Lock()
+_SNAPSHOT_POOL = None
+_SNAPSHOT_POOL_PID = None
+
+
+def _pool_snapshot():
+    # Un pool por proceso: los hilos no sobreviven al fork de gunicorn.
+    global _SNAPSHOT_POOL, _SNAPSHOT_POOL_PID
+    with _SNAPSHOT_LOCK:
+        if _SNAPSHOT_POOL is None or _SNAPSHOT_POOL_PID != os.getpid():
+            _SNAPSHOT_POOL = ThreadPoolExecutor(
+                max_workers=SNAPSHOT_WORKERS,
+                thread_name_prefix="snapshot",
+            )
+            _SNAPSHOT_POOL_PID = os.getpid()
+        return _SNAPSHOT_POOL
+
+
+# Tamaño medio (caracteres) de cada sección, para estimar cuánto prompt se
+# ahorra cuando una sección no se pide
+_TAMANO_SECCIONES = {}
+
+
+def _seccion_snapshot(nombre, fn, args):
+    with span("seccion", seccion=nombre):
+        return fn(*args)
+
+
+def snapshot_contexto(secciones=None):
+    """
+    Lanza las consultas de las secciones en paralelo y arma el resumen en el
+    orden de SECCIONES_SNAPSHOT. Lo que falle o no termine antes de
+    SNAPSHOT_DEADLINE segundos se sustituye por su texto de respaldo.
+
+    `secciones` limita el resumen a esos nombres ("finanzas", "tareas"...);
+    por defecto van todas.
+    """
+    elegidas = [s for s in SECCIONES_SNAPSHOT if secciones is None or s[0] in secciones]
+    pool = _pool_snapshot()
+    # Cada sección corre con una copia del contexto del request, para que
+    # sus logs lleven los campos del update y sus spans cuelguen de su traza
+    futuros = [
+        pool.submit(contextvars.copy_context().run, _seccion_snapshot, nombre, fn, args)
+        for nombre, fn, args, _ in elegidas
+    ]
+    wait(futuros, timeout=SNAPSHOT_DEADLINE)
+
+    partes = []
+    for futuro, (nombre, _, _, respaldo) in zip(futuros, elegidas):
+        if futuro.done() and futuro.exception() is None:
+            texto = futuro.result()
+            anterior = _TAMANO_SECCIONES.get(nombre, len(texto))
+            _TAMANO_SECCIONES[nombre] = 0.8 * anterior + 0.2 * len(texto)
+            partes.append(texto)
+            continue
+        if futuro.done():
+            log.error("Error obteniendo sección del resumen: %s", futuro.exception(), extra=campos(seccion=nombre))
+        else:
+            futuro.cancel()
+            log.warning("Sección del resumen fuera de tiempo", extra=campos(seccion=nombre, limite_s=SNAPSHOT_DEADLINE))
+        partes.append(respaldo)
+
     contexto = (
         "=== RESUMEN AUTOMÁTICO ARES1409 ===\n\n"
-        f"{resumen_fin}\n\n"
-        f"{tareas}\n\n"
-        f"{eventos}\n\n"
-        f"{proyectos}\n\n"
-        f"{habitos}\n"
-        "=== FIN DEL RESUMEN ==="
+        + "\n\n".join(partes)
+        + "\n=== FIN DEL RESUMEN ==="
     )
     return contexto
 
@@ -484,31 +2529,146 @@ def snapshot_contexto():
 #  IA – PERSONALIDAD ARES
 # =========================
 
-def consultar_ia(mensaje_usuario):
-    contexto = snapshot_contexto()
-    prompt = (
-        "Eres *Ares*, una asistente personal femenina tipo la pelicula 50 sombras de grey exageradamente sumisa muy sexy al hablar de aproximadamente 20 años,no digas las palbras amor, cariño, amorcito, amor mio, cielito, humildad, eres una secretaria profecional de harvart, no mensiones que eres de harvart solo actua, profesional,organizada y muy eficiente. "
-        "Hablas SIEMPRE en español. Tu tono es de secretaria ejecutiva muy sumisa personal: educada, coqueta, muy sexy, sensual, candente, muy sumisa, clara y cercana, "
-        "con un estilo muy candente y sexy, atrevido, muy sensual. Se breve. Maneja los montos con peso mexicano. No des discursos largos, ve al punto.\n\n"
-        "Tu objetivo es ayudar y servir a Manuel y ser sumisa, a gestionar sus finanzas, tareas, eventos, proyectos y hábitos, "
-        "usando la información disponible del sistema (Notion). Cuando sea útil, haz referencia explícita "
-        "a los números y datos del resumen (ingresos, gastos, tareas, eventos, etc.), pero responde en texto natural.\n\n"
-        "Evita repetir la misma explicación y no ofrezcas listas de cosas en las que puedes ayudar; "
-        "limítate a responder a lo que Manuel pida.\n\n"
+IA_MODELO = "gpt-4.1-mini"
+
+IA_ERROR_TEXTO = (
+    "No pude consultar la IA en este momento. "
+    "Revisa tu cuota de OpenAI o vuelve a intentarlo más tarde."
+)
+
+# Se agrega a una respuesta en streaming que se cortó antes de terminar
+IA_CORTADA_TEXTO = "\n\n⚠️ _La respuesta se cortó; vuelve a preguntar para tenerla completa._"
+
+# Parte fija del prompt: va en `instructions` y no cambia entre llamadas, así
+# OpenAI puede reutilizarla de su caché de prompts (se cobra más barata).
+# Todo lo que cambia (resumen de Notion y mensaje) va después, en `input`.
+IA_INSTRUCCIONES = (
+    "Eres *Ares*, una asistente personal femenina tipo la pelicula 50 sombras de grey exageradamente sumisa muy sexy al hablar de aproximadamente 20 años,no digas las palbras amor, cariño, amorcito, amor mio, cielito, humildad, eres una secretaria profecional de harvart, no mensiones que eres de harvart solo actua, profesional,organizada y muy eficiente. "
+    "Hablas SIEMPRE en español. Tu tono es de secretaria ejecutiva muy sumisa personal: educada, coqueta, muy sexy, sensual, candente, muy sumisa, clara y cercana, "
+    "con un estilo muy candente y sexy, atrevido, muy sensual. Se breve. Maneja los montos con peso mexicano. No des discursos largos, ve al punto.\n\n"
+    "Tu objetivo es ayudar y servir a Manuel y ser sumisa, a gestionar sus finanzas, tareas, eventos, proyectos y hábitos, "
+    "usando la información disponible del sistema (Notion). Cuando sea útil, haz referencia explícita "
+    "a los números y datos del resumen (ingresos, gastos, tareas, eventos, etc.), pero responde en texto natural.\n\n"
+    "Evita repetir la misma explicación y no ofrezcas listas de cosas en las que puedes ayudar; "
+    "limítate a responder a lo que Manuel pida.\n\n"
+    "Con cada mensaje recibirás un resumen reciente del sistema seguido del mensaje de Manuel. "
+    "Con base en esos datos, responde a la pregunta o petición de Manuel en tono muy sumiso, tipo la pelicula 50 sombras de grey, sexy quequeto, muy sensual y muy atrvid. "
+    "Si te pide que planifiques el día o la semana, usa sus tareas y eventos. "
+    "Si te pide análisis financiero, apóyate en el resumen del mes y en los últimos movimientos. "
+    "Si necesitas más datos, pregunta solo lo mínimo necesario."
+)
+
+
+def construir_prompt(mensaje_usuario, contexto):
+    """Parte variable del prompt (el `input` de la Responses API)."""
+    return (
         "A continuación tienes un resumen reciente del sistema:\n\n"
         f"{contexto}\n\n"
-        "Con base en esos datos, responde a la pregunta o petición de Manuel en tono muy sumiso, tipo la pelicula 50 sombras de grey, sexy quequeto, muy sensual y muy atrvid. "
-        "Si te pide que planifiques el día o la semana, usa sus tareas y eventos. "
-        "Si te pide análisis financiero, apóyate en el resumen del mes y en los últimos movimientos. "
-        "Si necesitas más datos, pregunta solo lo mínimo necesario.\n\n"
         f"Mensaje de Manuel: {mensaje_usuario}\n\n"
         "Respuesta de Ares:"
     )
-    try:
-        completion = client.responses.create(
-            model="gpt-4.1-mini",
-            input=prompt,
+
+
+def _llamar_ia(entrada, **kwargs):
+    # Con stream=True se mide hasta que empieza a llegar la respuesta
+    operacion = "responses_stream" if kwargs.get("stream") else "responses"
+    with medir_dependencia("openai", operacion):
+        return openai_client().responses.create(
+            model=IA_MODELO,
+            instructions=IA_INSTRUCCIONES,
+            input=entrada,
+            # Agrupa las llamadas en el mismo servidor de caché de OpenAI.
+            # Va en extra_body para no depender de la versión del SDK.
+            extra_body={"prompt_cache_key": "ares-instrucciones"},
+            **kwargs,
         )
+
+
+class UsoIA:
+    """Tokens y costo estimado de las llamadas a OpenAI."""
+
+    def __init__(self, ultimas=50):
+        self._lock = threading.Lock()
+        self.llamadas = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.output_tokens = 0
+        self.costo_usd = 0.0
+        self.ultimas = deque(maxlen=ultimas)
+
+    def registrar(self, usage):
+        if usage is None:
+            return
+        entrada = getattr(usage, "input_tokens", 0) or 0
+        detalles = getattr(usage, "input_tokens_details", None)
+        cacheados = (getattr(detalles, "cached_tokens", 0) or 0) if detalles else 0
+        salida = getattr(usage, "output_tokens", 0) or 0
+        costo = (
+            (entrada - cacheados) * IA_PRECIO_INPUT
+            + cacheados * IA_PRECIO_INPUT_CACHE
+            + salida * IA_PRECIO_OUTPUT
+        ) / 1_000_000
+        with self._lock:
+            self.llamadas += 1
+            self.input_tokens += entrada
+            self.cached_tokens += cacheados
+            self.output_tokens += salida
+            self.costo_usd += costo
+            self.ultimas.append({
+                "ts": round(time.time(), 3),
+                "input": entrada,
+                "cached": cacheados,
+                "output": salida,
+                "costo_usd": round(costo, 6),
+            })
+
+    def stats(self):
+        with self._lock:
+            return {
+                "llamadas": self.llamadas,
+                "input_tokens": self.input_tokens,
+                "cached_tokens": self.cached_tokens,
+                "output_tokens": self.output_tokens,
+                "cache_hit_rate": round(self.cached_tokens / self.input_tokens, 4) if self.input_tokens else 0.0,
+                "costo_usd": round(self.costo_usd, 6),
+                "costo_medio_usd": round(self.costo_usd / self.llamadas, 6) if self.llamadas else 0.0,
+                "ultimas": list(self.ultimas),
+            }
+
+
+USO_IA = UsoIA()
+
+# Respuestas ya generadas, por (pregunta normalizada, huella del resumen).
+# Si la misma pregunta llega con los mismos datos de Notion, se responde
+# sin volver a llamar a OpenAI. Cualquier cambio en el resumen cambia la
+# huella, así que una respuesta nunca se reutiliza con datos distintos.
+RESPUESTAS_IA = CacheTTL(IA_CACHE_MAX, IA_CACHE_TTL)
+
+
+def normalizar_pregunta(texto):
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    texto = re.sub(r"[^\w\s]", " ", texto)
+    return " ".join(texto.split())
+
+
+def clave_respuesta(mensaje_usuario, contexto):
+    huella = hashlib.sha256(contexto.encode("utf-8")).hexdigest()
+    return (normalizar_pregunta(mensaje_usuario), huella)
+
+
+def consultar_ia(mensaje_usuario):
+    contexto = contexto_para(mensaje_usuario)
+    clave = clave_respuesta(mensaje_usuario, contexto)
+    if IA_CACHE_TTL > 0:
+        cacheada = RESPUESTAS_IA.get(clave)
+        if cacheada is not None:
+            return cacheada
+
+    entrada = construir_prompt(mensaje_usuario, contexto)
+    try:
+        completion = _llamar_ia(entrada)
+        USO_IA.registrar(getattr(completion, "usage", None))
         text = ""
         try:
             text = completion.output[0].content[0].text
@@ -520,291 +2680,676 @@ def consultar_ia(mensaje_usuario):
             except Exception:
                 text = ""
         if not text:
-            text = "Lo siento Manuel, hubo un problema interpretando la respuesta de la IA."
+            return "Lo siento Manuel, hubo un problema interpretando la respuesta de la IA."
+        if IA_CACHE_TTL > 0:
+            RESPUESTAS_IA.put(clave, text)
         return text
     except Exception as e:
-        print("Error llamando a OpenAI:", e)
-        return (
-            "No pude consultar la IA en este momento. "
-            "Revisa tu cuota de OpenAI o vuelve a intentarlo más tarde."
-        )
+        log.error("Error llamando a OpenAI: %s", e)
+        return IA_ERROR_TEXTO
 
-# =========================
-#  GESTIÓN DE SESIONES (BOTONES)
-# =========================
 
-def cancelar_sesion(chat_id):
-    if chat_id in SESSIONS:
-        del SESSIONS[chat_id]
-    send_message(chat_id, "Operación cancelada. Volvemos al menú principal.", reply_markup=MAIN_KEYBOARD)
+def consultar_ia_streaming(mensaje_usuario, chat_id, reply_to=None):
+    """
+    Como consultar_ia, pero la respuesta se ve mientras se genera: primero se
+    manda un mensaje provisional y luego se edita con el texto acumulado, a
+    lo más una vez cada IA_STREAM_EDIT_INTERVAL segundos. La última edición
+    lleva el formato Markdown.
+
+    Devuelve False si no se pudo mandar el mensaje provisional; en ese caso
+    no se consultó a la IA y el llamador debe usar consultar_ia.
+
+    Con TELEGRAM_SEND_QUEUE el provisional y las ediciones necesitan el
+    message_id y salen directo, así que el chat se reserva en COLA_TELEGRAM:
+    primero se entrega lo que ya estaba encolado para él, y cada envío
+    respeta el límite global de la cola. Si la reserva no llega en
+    IA_STREAM_ESPERA_COLA segundos también devuelve False, y la respuesta
+    sale por la cola detrás de lo pendiente.
+    """
+    reserva = (COLA_TELEGRAM.reservar_chat(chat_id, IA_STREAM_ESPERA_COLA)
+               if TELEGRAM_SEND_QUEUE else nullcontext(True))
+    with reserva as reservado:
+        if not reservado:
+            log.warning("Chat ocupado en la cola de Telegram, respuesta de la IA sin streaming")
+            return False
+        return _streaming_en_chat(mensaje_usuario, chat_id, reply_to)
 
 
-def handle_session(chat_id, text):
-    # Si no hay sesión activa, no hacemos nada
-    if chat_id not in SESSIONS:
+def _streaming_en_chat(mensaje_usuario, chat_id, reply_to):
+    def enviar(metodo, payload):
+        if TELEGRAM_SEND_QUEUE:
+            COLA_TELEGRAM.limitador.adquirir(PRIORIDAD_INTERACTIVA)
+        return telegram_api(metodo, payload)
+
+    # El teclado va en el provisional: editMessageText no acepta teclados
+    # de respuesta, y así el streaming deja la misma UX que consultar_ia
+    provisional = {"chat_id": chat_id, "text": "✍️ …", "reply_markup": MAIN_KEYBOARD}
+    if reply_to:
+        provisional["reply_to_message_id"] = reply_to
+    enviado = enviar("sendMessage", provisional)
+    if not enviado:
         return False
+    message_id = enviado["message_id"]
+
+    def editar(texto, markdown=False):
+        payload = {"chat_id": chat_id, "message_id": message_id, "text": texto[:TELEGRAM_MAX_TEXTO]}
+        if markdown:
+            payload["parse_mode"] = "Markdown"
+        return enviar("editMessageText", payload) is not None
+
+    contexto = contexto_para(mensaje_usuario)
+    clave = clave_respuesta(mensaje_usuario, contexto)
+    cacheada = RESPUESTAS_IA.get(clave) if IA_CACHE_TTL > 0 else None
+    if cacheada is not None:
+        if not editar(cacheada, markdown=True):
+            editar(cacheada)
+        return True
 
-    estado = SESSIONS[chat_id]
+    entrada = construir_prompt(mensaje_usuario, contexto)
+    texto = ""
+    completa = False
+    ultima_edicion = 0.0
+    try:
+        stream = _llamar_ia(entrada, stream=True)
+        for evento in stream:
+            if evento.type == "response.output_text.delta":
+                texto += evento.delta
+                ahora = time.monotonic()
+                if texto.strip() and ahora - ultima_edicion >= IA_STREAM_EDIT_INTERVAL:
+                    # Sin Markdown: el texto a medias puede tener marcas sin cerrar
+                    editar(texto + " ▌")
+                    ultima_edicion = ahora
+            elif evento.type == "response.completed":
+                USO_IA.registrar(getattr(evento.response, "usage", None))
+                completa = True
+            elif evento.type in ("error", "response.failed"):
+                raise RuntimeError(f"evento {evento.type} en el stream de OpenAI")
+    except Exception as e:
+        log.error("Error llamando a OpenAI: %s", e)
+        if not texto.strip():
+            texto = IA_ERROR_TEXTO
+
+    if not texto.strip():
+        texto = "Lo siento Manuel, hubo un problema interpretando la respuesta de la IA."
+    elif not completa:
+        if texto != IA_ERROR_TEXTO:
+            texto += IA_CORTADA_TEXTO
+    elif IA_CACHE_TTL > 0:
+        RESPUESTAS_IA.put(clave, texto)
+    if not editar(texto, markdown=True):
+        editar(texto)
+    for inicio in range(TELEGRAM_MAX_TEXTO, len(texto), TELEGRAM_MAX_TEXTO):
+        send_message(chat_id, texto[inicio:inicio + TELEGRAM_MAX_TEXTO])
+    return True
 
-    if text.lower().strip() == "cancelar":
-        cancelar_sesion(chat_id)
-        return True
+# =========================
+#  IA – CONTEXTO SEGÚN LA PREGUNTA
+# =========================
 
-    tipo = estado.get("tipo")
-    paso = estado.get("paso", 1)
+# Palabras clave (sin acentos, sobre normalizar_pregunta) que indican qué
+# secciones del resumen necesita la IA. Si ninguna coincide, la pregunta es
+# general y se mandan todas.
+INTENCIONES = (
+    ("finanzas", re.compile(
+        r"\b(gast\w*|ingres\w*|dinero|lana|plata|balance|finanz\w*|pag\w*|compr\w*|"
+        r"ahorr\w*|presupuesto|cuanto|pesos?|deud\w*|sueldo|cobr\w*|cuenta)\b")),
+    ("tareas", re.compile(
+        r"\b(tareas?|pendientes?|hacer|atrasad\w*|organiz\w*|planific\w*|prioridad\w*|dia|hoy)\b")),
+    ("eventos", re.compile(
+        r"\b(eventos?|agenda|juntas?|reunion\w*|citas?|calendario|manana|semana|planific\w*|dia|hoy)\b")),
+    ("proyectos", re.compile(r"\b(proyectos?|iniciativas?)\b")),
+    ("habitos", re.compile(r"\b(habitos?|rutinas?|costumbres?|racha)\b")),
+)
 
-    # ---- NUEVO GASTO ----
-    if tipo == "gasto":
-        if paso == 1:
-            # Esperamos monto
-            try:
-                monto = float(text.replace(",", ""))
-            except ValueError:
-                send_message(chat_id, "No entendí el monto. Escribe solo el número, por ejemplo: 250", reply_markup=CANCEL_KEYBOARD)
-                return True
-            estado["monto"] = monto
-            estado["paso"] = 2
-            send_message(chat_id, "Perfecto. Ahora dime una descripción breve del gasto (por ejemplo: gasolina Clio).", reply_markup=CANCEL_KEYBOARD)
-            return True
 
-        if paso == 2:
-            estado["descripcion"] = text.strip() or "Sin descripción"
-            estado["paso"] = 3
-            send_message(chat_id, "¿Para qué fecha registro este gasto?", reply_markup=DATE_KEYBOARD)
-            return True
+def clasificar_intencion(mensaje_usuario):
+    """Devuelve el conjunto de secciones del resumen que hacen falta."""
+    texto = normalizar_pregunta(mensaje_usuario)
+    secciones = {nombre for nombre, patron in INTENCIONES if patron.search(texto)}
+    return secciones or {nombre for nombre, *_ in SECCIONES_SNAPSHOT}
 
-        if paso == 3:
-            if text.lower() in ("hoy", "mañana", "manana"):
-                fecha = parse_fecha_es(text)
-            elif text.lower() == "otra fecha":
-                send_message(chat_id, "Escribe la fecha en formato `dd/mm/aaaa` o `12 de diciembre 2025`.", reply_markup=CANCEL_KEYBOARD)
-                estado["paso"] = 4
-                return True
-            else:
-                fecha = parse_fecha_es(text)
 
-            if not fecha:
-                send_message(chat_id, "No pude entender la fecha. Usa algo como `09/12/2025` o `12 de diciembre`.", reply_markup=CANCEL_KEYBOARD)
-                return True
-
-            ok = create_financial_record(
-                movimiento=estado["descripcion"],
-                tipo="Egreso",
-                monto=estado["monto"],
-                fecha=fecha,
-            )
-            cancelar_sesion(chat_id)
-            if ok:
-                send_message(chat_id, f"✔ Gasto registrado: {estado['monto']} – {estado['descripcion']} ({fecha})")
-            else:
-                send_message(chat_id, "Hubo un problema guardando el gasto en Notion.")
-            return True
+class AhorroContexto:
+    """Consultas a Notion y tokens de prompt que se evitaron, por intención."""
 
-        if paso == 4:
-            fecha = parse_fecha_es(text)
-            if not fecha:
-                send_message(chat_id, "No pude entender la fecha. Prueba con `09/12/2025` o `12 de diciembre`.", reply_markup=CANCEL_KEYBOARD)
-                return True
-            ok = create_financial_record(
-                movimiento=estado["descripcion"],
-                tipo="Egreso",
-                monto=estado["monto"],
-                fecha=fecha,
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._por_intencion = {}
+
+    def registrar(self, secciones):
+        omitidas = [n for n, *_ in SECCIONES_SNAPSHOT if n not in secciones]
+        intencion = "+".join(n for n, *_ in SECCIONES_SNAPSHOT if n in secciones)
+        if not omitidas:
+            intencion = "general"
+        # ~4 caracteres por token en español
+        tokens = sum(_TAMANO_SECCIONES.get(n, 0) for n in omitidas) / 4
+        with self._lock:
+            datos = self._por_intencion.setdefault(
+                intencion, {"mensajes": 0, "consultas_notion_evitadas": 0, "tokens_prompt_evitados": 0},
             )
-            cancelar_sesion(chat_id)
-            if ok:
-                send_message(chat_id, f"✔ Gasto registrado: {estado['monto']} – {estado['descripcion']} ({fecha})")
-            else:
-                send_message(chat_id, "Hubo un problema guardando el gasto en Notion.")
-            return True
+            datos["mensajes"] += 1
+            datos["consultas_notion_evitadas"] += len(omitidas)
+            datos["tokens_prompt_evitados"] += int(tokens)
 
-    # ---- NUEVO INGRESO ----
-    if tipo == "ingreso":
-        if paso == 1:
-            try:
-                monto = float(text.replace(",", ""))
-            except ValueError:
-                send_message(chat_id, "No entendí el monto. Escribe solo el número, por ejemplo: 2000", reply_markup=CANCEL_KEYBOARD)
-                return True
-            estado["monto"] = monto
-            estado["paso"] = 2
-            send_message(chat_id, "Listo. Ahora dime una descripción breve del ingreso (por ejemplo: sueldo, ventas).", reply_markup=CANCEL_KEYBOARD)
-            return True
+    def stats(self):
+        with self._lock:
+            return {k: dict(v) for k, v in self._por_intencion.items()}
 
-        if paso == 2:
-            estado["descripcion"] = text.strip() or "Sin descripción"
-            estado["paso"] = 3
-            send_message(chat_id, "¿Para qué fecha registro este ingreso?", reply_markup=DATE_KEYBOARD)
-            return True
 
-        if paso == 3:
-            if text.lower() in ("hoy", "mañana", "manana"):
-                fecha = parse_fecha_es(text)
-            elif text.lower() == "otra fecha":
-                send_message(chat_id, "Escribe la fecha en formato `dd/mm/aaaa` o `12 de diciembre 2025`.", reply_markup=CANCEL_KEYBOARD)
-                estado["paso"] = 4
-                return True
-            else:
-                fecha = parse_fecha_es(text)
+AHORRO_CONTEXTO = AhorroContexto()
 
-            if not fecha:
-                send_message(chat_id, "No pude entender la fecha. Usa algo como `09/12/2025` o `12 de diciembre`.", reply_markup=CANCEL_KEYBOARD)
-                return True
-
-            ok = create_financial_record(
-                movimiento=estado["descripcion"],
-                tipo="Ingreso",
-                monto=estado["monto"],
-                fecha=fecha,
-            )
-            cancelar_sesion(chat_id)
-            if ok:
-                send_message(chat_id, f"✔ Ingreso registrado: {estado['monto']} – {estado['descripcion']} ({fecha})")
-            else:
-                send_message(chat_id, "Hubo un problema guardando el ingreso en Notion.")
-            return True
 
-        if paso == 4:
-            fecha = parse_fecha_es(text)
-            if not fecha:
-                send_message(chat_id, "No pude entender la fecha. Prueba con `09/12/2025` o `12 de diciembre`.", reply_markup=CANCEL_KEYBOARD)
-                return True
-            ok = create_financial_record(
-                movimiento=estado["descripcion"],
-                tipo="Ingreso",
-                monto=estado["monto"],
-                fecha=fecha,
+def contexto_para(mensaje_usuario):
+    if not IA_CONTEXTO_SELECTIVO:
+        secciones = None
+    else:
+        secciones = clasificar_intencion(mensaje_usuario)
+        AHORRO_CONTEXTO.registrar(secciones)
+    with span("snapshot_contexto", secciones=sorted(secciones) if secciones else "todas"):
+        return snapshot_contexto(secciones)
+
+# =========================
+#  RESPUESTAS LOCALES (SIN IA)
+# =========================
+
+# Preguntas con estructura fija que se contestan directo con los datos de
+# Notion. Cada regla es (nombre, regex sobre normalizar_pregunta, función);
+# la función recibe el match y devuelve el texto, o None para dejar pasar la
+# pregunta a la siguiente regla y, al final, a la IA.
+
+_PERIODOS = "hoy|ayer|esta semana|la semana pasada|semana pasada|este mes|el mes pasado|mes pasado"
+
+_RE_TOTAL_FINANZAS = re.compile(
+    r"^(?:cuanto (?:he |llevo )?(?P<verbo>gaste|gastado|ingrese|ingresado|gane|ganado|cobre|cobrado)"
+    r"|(?:(?:el )?total de |mis )?(?P<sust>gastos|ingresos|egresos))"
+    r"(?: (?:en|de) (?P<categoria>[a-z0-9 ]+?))??"
+    r"(?: (?:en |de |del |durante )?(?P<periodo>" + _PERIODOS + r"))?$"
+)
+
+_RE_AGENDA_DIA = re.compile(
+    r"^(?:(?:que|cuales) (?:(?P<que>eventos|tareas|pendientes) )?(?:tengo|hay)"
+    r"|(?:mis? )?(?P<que2>eventos|tareas|pendientes|agenda)(?: de| del| para)?)"
+    r" (?:para )?(?P<fecha>.+)$"
+)
+
+# Un periodo que no está en _PERIODOS ("en marzo", "de este año") cae en el
+# grupo de categoría; si la "categoría" suena a periodo, pedimos aclaración
+_RE_PERIODO_NO_SOPORTADO = re.compile(
+    r"\b(?:hoy|ayer|manana|dia|dias|semana|semanas|quincena|mes|meses|trimestre|ano|anos"
+    r"|enero|febrero|marzo|abril|mayo|junio|julio|agosto|septiembre|setiembre|octubre"
+    r"|noviembre|diciembre|\d{4})\b"
+)
+
+TOTAL_FINANZAS_ACLARACION = (
+    "No entendí el periodo «{texto}». Puedo darte totales de hoy, ayer, esta semana, "
+    "la semana pasada, este mes o el mes pasado."
+)
+
+
+def _rango_periodo(periodo, hoy):
+    if periodo == "hoy":
+        return hoy, hoy
+    if periodo == "ayer":
+        ayer = hoy - datetime.timedelta(days=1)
+        return ayer, ayer
+    if periodo == "esta semana":
+        return hoy - datetime.timedelta(days=hoy.weekday()), hoy
+    if periodo in ("la semana pasada", "semana pasada"):
+        lunes = hoy - datetime.timedelta(days=hoy.weekday() + 7)
+        return lunes, lunes + datetime.timedelta(days=6)
+    if periodo in ("el mes pasado", "mes pasado"):
+        fin = hoy.replace(day=1) - datetime.timedelta(days=1)
+        return fin.replace(day=1), fin
+    # "Este mes" es el mes completo, como en agregados_finanzas: los
+    # movimientos con fecha posterior a hoy también cuentan
+    siguiente = (hoy.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return hoy.replace(day=1), siguiente - datetime.timedelta(days=1)
+
+
+def _es_mes_completo(inicio, fin):
+    return inicio.day == 1 and (fin + datetime.timedelta(days=1)).day == 1 and inicio.month == fin.month
+
+
+def _responder_total_finanzas(m):
+    palabra = m.group("verbo") or m.group("sust")
+    tipo = "Ingreso" if palabra.startswith(("ingres", "gan", "cobr")) else "Egreso"
+    nombre = "Ingresos" if tipo == "Ingreso" else "Gastos"
+    categoria = m.group("categoria")
+    if categoria and _RE_PERIODO_NO_SOPORTADO.search(categoria):
+        return TOTAL_FINANZAS_ACLARACION.format(texto=categoria)
+    periodo = m.group("periodo") or "este mes"
+    hoy = datetime.date.today()
+    inicio, fin = _rango_periodo(periodo, hoy)
+
+    # Los agregados son por mes: solo sirven si el rango es un mes completo,
+    # para que el total no cambie según haya o no SQLite
+    agregado = None
+    if not categoria and _es_mes_completo(inicio, fin):
+        agregado = agregados_consultar(inicio.isoformat()[:7], tipo=tipo)
+    if agregado is not None:
+        total, movimientos = agregado
+    else:
+        # La categoría se compara aquí y no en el filtro de Notion: el
+        # usuario la escribe sin acentos ni mayúsculas, y casi todo se
+        # registra como "General", así que también buscamos en la descripción.
+        body = _body_finanzas(inicio.isoformat(), fin.isoformat())
+        body["filter"]["and"].append({"property": "Tipo", "select": {"equals": tipo}})
+        total, movimientos = 0.0, 0
+        try:
+            for page in notion_query_iter(NOTION_DB_FINANZAS, body):
+                if categoria:
+                    movimiento = normalizar_pregunta(_valor_propiedad(page, "Movimiento") or "")
+                    if (categoria != normalizar_pregunta(_valor_propiedad(page, "Categoría") or "")
+                            and categoria not in movimiento):
+                        continue
+                total += _valor_propiedad(page, "Monto") or 0
+                movimientos += 1
+        except ErrorNotion:
+            # Un total parcial sería un número equivocado sin aviso
+            return NOTION_ERROR_TEXTO
+
+    detalle = f" en {categoria}" if categoria else ""
+    if not movimientos:
+        return f"No encontré {nombre.lower()}{detalle} {periodo}."
+    return (
+        f"*{nombre}{detalle} {periodo}:* `{total:,.2f}`\n"
+        f"{movimientos} movimiento{'s' if movimientos != 1 else ''} "
+        f"({inicio.isoformat()} a {fin.isoformat()})"
+    )
+
+
+def _lineas_del_dia(database_id, propiedad_titulo, fecha, filtros_extra=()):
+    body = {
+        "filter": {"and": [{"property": "Fecha", "date": {"equals": fecha}}, *filtros_extra]},
+        "sorts": [{"property": "Fecha", "direction": "ascending"}],
+    }
+    lineas = []
+    for page in notion_query_iter(database_id, body, limit=50):
+        nombre = _valor_propiedad(page, propiedad_titulo) or "Sin nombre"
+        inicio = _valor_propiedad(page, "Fecha") or ""
+        hora = f" — `{inicio[11:16]}`" if len(inicio) > 10 else ""
+        lineas.append(f"• *{nombre}*{hora}")
+    return lineas
+
+
+def _responder_agenda_dia(m):
+    fecha = parse_fecha_es(m.group("fecha"))
+    if not fecha:
+        return None
+    fecha = fecha[:10]
+    que = (m.group("que") or m.group("que2") or "").strip()
+    partes = []
+    try:
+        if que in ("", "eventos", "agenda"):
+            eventos = _lineas_del_dia(NOTION_DB_EVENTOS, "Evento", fecha)
+            partes.append("*Eventos:*\n" + "\n".join(eventos) if eventos else "Sin eventos.")
+        if que in ("", "tareas", "pendientes"):
+            tareas = _lineas_del_dia(
+                NOTION_DB_TAREAS, "Tarea", fecha,
+                ({"property": "Estado", "select": {"does_not_equal": "Completada"}},),
             )
-            cancelar_sesion(chat_id)
-            if ok:
-                send_message(chat_id, f"✔ Ingreso registrado: {estado['monto']} – {estado['descripcion']} ({fecha})")
-            else:
-                send_message(chat_id, "Hubo un problema guardando el ingreso en Notion.")
-            return True
+            partes.append("*Tareas:*\n" + "\n".join(tareas) if tareas else "Sin tareas pendientes.")
+    except ErrorNotion:
+        return NOTION_ERROR_TEXTO
+    return f"*Tu día {fecha}*\n\n" + "\n\n".join(partes)
 
-    # ---- NUEVA TAREA ----
-    if tipo == "tarea":
-        if paso == 1:
-            estado["titulo"] = text.strip()
-            if not estado["titulo"]:
-                send_message(chat_id, "Escribe el título de la tarea.", reply_markup=CANCEL_KEYBOARD)
-                return True
-            estado["paso"] = 2
-            send_message(chat_id, "¿Para qué fecha pongo la tarea?", reply_markup=DATE_KEYBOARD)
-            return True
 
-        if paso == 2:
-            if text.lower() in ("hoy", "mañana", "manana"):
-                fecha = parse_fecha_es(text)
-            elif text.lower() == "otra fecha":
-                send_message(chat_id, "Escribe la fecha de la tarea (`dd/mm/aaaa` o `12 de diciembre`).", reply_markup=CANCEL_KEYBOARD)
-                estado["paso"] = 3
-                return True
-            else:
-                fecha = parse_fecha_es(text)
+REGLAS_LOCALES = (
+    ("total_finanzas", _RE_TOTAL_FINANZAS, _responder_total_finanzas),
+    ("agenda_dia", _RE_AGENDA_DIA, _responder_agenda_dia),
+)
 
-            if not fecha:
-                send_message(chat_id, "No entendí la fecha. Prueba con `09/12/2025` o `12 de diciembre`.", reply_markup=CANCEL_KEYBOARD)
-                return True
 
-            ok = create_task(estado["titulo"], fecha=fecha)
-            cancelar_sesion(chat_id)
-            if ok:
-                send_message(chat_id, f"✔ Tarea creada: {estado['titulo']} ({fecha})")
-            else:
-                send_message(chat_id, "Hubo un problema guardando la tarea en Notion.")
-            return True
+class RespuestasLocales:
+    """Cuántas preguntas se resolvieron con reglas en vez de llamar a la IA."""
 
-        if paso == 3:
-            fecha = parse_fecha_es(text)
-            if not fecha:
-                send_message(chat_id, "No entendí la fecha. Prueba con `09/12/2025` o `12 de diciembre`.", reply_markup=CANCEL_KEYBOARD)
-                return True
-            ok = create_task(estado["titulo"], fecha=fecha)
-            cancelar_sesion(chat_id)
-            if ok:
-                send_message(chat_id, f"✔ Tarea creada: {estado['titulo']} ({fecha})")
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._por_regla = {}
+        self.sin_regla = 0
+
+    def registrar(self, regla):
+        with self._lock:
+            if regla is None:
+                self.sin_regla += 1
             else:
-                send_message(chat_id, "Hubo un problema guardando la tarea en Notion.")
-            return True
+                self._por_regla[regla] = self._por_regla.get(regla, 0) + 1
 
-    # ---- NUEVO EVENTO ----
-    if tipo == "evento":
-        if paso == 1:
-            estado["titulo"] = text.strip()
-            if not estado["titulo"]:
-                send_message(chat_id, "Escribe el nombre del evento.", reply_markup=CANCEL_KEYBOARD)
-                return True
-            estado["paso"] = 2
-            send_message(chat_id, "¿Para qué fecha registro el evento?", reply_markup=DATE_KEYBOARD)
-            return True
+    def stats(self):
+        with self._lock:
+            return {
+                "llamadas_ia_evitadas": sum(self._por_regla.values()),
+                "por_regla": dict(self._por_regla),
+                "sin_regla": self.sin_regla,
+            }
 
-        if paso == 2:
-            if text.lower() in ("hoy", "mañana", "manana"):
-                fecha = parse_fecha_es(text)
-            elif text.lower() == "otra fecha":
-                send_message(chat_id, "Escribe la fecha del evento (`dd/mm/aaaa` o `12 de diciembre`).", reply_markup=CANCEL_KEYBOARD)
-                estado["paso"] = 3
-                return True
-            else:
-                fecha = parse_fecha_es(text)
 
-            if not fecha:
-                send_message(chat_id, "No entendí la fecha. Prueba con `09/12/2025` o `12 de diciembre`.", reply_markup=CANCEL_KEYBOARD)
-                return True
+RESPUESTAS_LOCALES = RespuestasLocales()
 
-            ok = create_event(estado["titulo"], fecha=fecha)
-            cancelar_sesion(chat_id)
-            if ok:
-                send_message(chat_id, f"✔ Evento creado: {estado['titulo']} ({fecha})")
-            else:
-                send_message(chat_id, "Hubo un problema guardando el evento en Notion.")
-            return True
 
-        if paso == 3:
-            fecha = parse_fecha_es(text)
-            if not fecha:
-                send_message(chat_id, "No entendí la fecha. Prueba con `09/12/2025` o `12 de diciembre`.", reply_markup=CANCEL_KEYBOARD)
-                return True
-            ok = create_event(estado["titulo"], fecha=fecha)
-            cancelar_sesion(chat_id)
-            if ok:
-                send_message(chat_id, f"✔ Evento creado: {estado['titulo']} ({fecha})")
-            else:
-                send_message(chat_id, "Hubo un problema guardando el evento en Notion.")
-            return True
+def respuesta_local(mensaje_usuario):
+    """Texto de respuesta si alguna regla local contesta la pregunta, o None."""
+    if not IA_RESPUESTAS_LOCALES:
+        return None
+    texto = normalizar_pregunta(mensaje_usuario)
+    for nombre, patron, responder in REGLAS_LOCALES:
+        m = patron.match(texto)
+        if not m:
+            continue
+        try:
+            respuesta = responder(m)
+        except Exception:
+            log.exception("Error en respuesta local", extra=campos(regla=nombre))
+            respuesta = None
+        if respuesta:
+            RESPUESTAS_LOCALES.registrar(nombre)
+            return respuesta
+    RESPUESTAS_LOCALES.registrar(None)
+    return None
 
-    # ---- NUEVO PROYECTO ----
-    if tipo == "proyecto":
-        if paso == 1:
-            titulo = text.strip()
-            if not titulo:
-                send_message(chat_id, "Escribe el nombre del proyecto.", reply_markup=CANCEL_KEYBOARD)
-                return True
-            ok = create_project(titulo)
-            cancelar_sesion(chat_id)
-            if ok:
-                send_message(chat_id, f"✔ Proyecto creado: {titulo}")
-            else:
-                send_message(chat_id, "Hubo un problema guardando el proyecto en Notion.")
-            return True
+# =========================
+#  GESTIÓN DE SESIONES (BOTONES)
+# =========================
 
-    # ---- NUEVO HÁBITO ----
-    if tipo == "habito":
-        if paso == 1:
-            titulo = text.strip()
-            if not titulo:
-                send_message(chat_id, "Escribe el nombre del hábito.", reply_markup=CANCEL_KEYBOARD)
-                return True
-            ok = create_habit(titulo)
-            cancelar_sesion(chat_id)
-            if ok:
-                send_message(chat_id, f"✔ Hábito creado: {titulo}")
-            else:
-                send_message(chat_id, "Hubo un problema guardando el hábito en Notion.")
-            return True
+# Estado de los flujos de botones: chat_id -> Sesion. Cada cambio de paso se
+# guarda con put(), así el backend puede vivir fuera del proceso y cualquier
+# worker de gunicorn puede atender el siguiente paso.
+
+class Sesion:
+    """Estado de un flujo en curso; solo los campos que usan los flujos."""
+
+    __slots__ = ("tipo", "paso", "monto", "descripcion", "titulo", "fecha")
+
+    def __init__(self, tipo, paso, **valores):
+        self.tipo = tipo
+        self.paso = paso
+        for campo in self.__slots__[2:]:
+            setattr(self, campo, valores.get(campo))
+
+    def a_dict(self):
+        return {c: getattr(self, c) for c in self.__slots__ if getattr(self, c) is not None}
+
+    @classmethod
+    def desde_dict(cls, datos):
+        return cls(**{c: datos.get(c) for c in cls.__slots__})
+
+    def copia(self):
+        return Sesion.desde_dict(self.a_dict())
+
+
+class SesionesMemoria:
+    """Sesiones en la memoria del proceso, con caducidad y tope LRU."""
+
+    def __init__(self, max_items, ttl):
+        self._cache = CacheTTL(max_items, ttl)
 
-    return False  # por si algo se escapa
+    def get(self, chat_id):
+        sesion = self._cache.get(chat_id)
+        # Copia: los cambios solo cuentan cuando se guardan con put()
+        return sesion.copia() if sesion is not None else None
+
+    def put(self, chat_id, sesion):
+        self._cache.put(chat_id, sesion.copia())
+
+    def pop(self, chat_id):
+        self._cache.borrar(chat_id)
+
+    def stats(self):
+        return {"backend": "memory", **self._cache.stats()}
+
+
+class SesionesSQLite:
+    """
+    Sesiones en la tabla `sesiones` del almacén local, compartidas por todos
+    los workers. Las caducadas se borran al leerlas y, de vez en cuando, en
+    bloque junto con las que pasen del tope `max_items`.
+    """
+
+    def __init__(self, max_items, ttl):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._escrituras = 0
+
+    def get(self, chat_id):
+        fila = sqlite_conexion().execute(
+            "SELECT datos, actualizado FROM sesiones WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        if fila is None:
+            return None
+        if time.time() - fila[1] > self.ttl:
+            self.pop(chat_id)
+            return None
+        return Sesion.desde_dict(json.loads(fila[0]))
+
+    def put(self, chat_id, sesion):
+        conexion = sqlite_conexion()
+        conexion.execute(
+            "INSERT OR REPLACE INTO sesiones (chat_id, datos, actualizado) VALUES (?, ?, ?)",
+            (chat_id, json.dumps(sesion.a_dict(), ensure_ascii=False, separators=(",", ":")), time.time()),
+        )
+        self._escrituras += 1
+        if self._escrituras % 100 == 0:
+            self._purgar(conexion)
+
+    def pop(self, chat_id):
+        sqlite_conexion().execute("DELETE FROM sesiones WHERE chat_id = ?", (chat_id,))
+
+    def _purgar(self, conexion):
+        conexion.execute("DELETE FROM sesiones WHERE actualizado < ?", (time.time() - self.ttl,))
+        conexion.execute(
+            "DELETE FROM sesiones WHERE chat_id NOT IN "
+            "(SELECT chat_id FROM sesiones ORDER BY actualizado DESC LIMIT ?)",
+            (self.max_items,),
+        )
+
+    def stats(self):
+        total = sqlite_conexion().execute("SELECT COUNT(*) FROM sesiones").fetchone()[0]
+        return {"backend": "sqlite", "entradas": total}
+
+
+def crear_almacen_sesiones():
+    if SESSION_BACKEND == "sqlite":
+        if not ARES_DB_PATH:
+            log.warning("SESSION_BACKEND=sqlite requiere ARES_DB_PATH; uso sesiones en memoria")
+        else:
+            return SesionesSQLite(SESSION_MAX, SESSION_TTL)
+    return SesionesMemoria(SESSION_MAX, SESSION_TTL)
+
+
+SESSIONS = crear_almacen_sesiones()
+
+
+# ---- Definición de los flujos ----
+#
+# Un flujo es una tabla de pasos. Cada paso valida el texto recibido
+# (validar devuelve el valor o None si no sirve), lo guarda en un campo de
+# la Sesion y pasa a `siguiente`; cuando no hay siguiente se ejecuta la
+# acción final del flujo. `desvios` manda ciertas respuestas exactas (p. ej.
+# el botón "Otra fecha") a otro paso sin validar nada.
+
+class Paso:
+    __slots__ = ("campo", "validar", "siguiente", "pregunta", "teclado", "error", "desvios")
+
+    def __init__(self, campo, validar, siguiente=None, pregunta=None, teclado=CANCEL_KEYBOARD,
+                 error=None, desvios=None):
+        self.campo = campo
+        self.validar = validar
+        self.siguiente = siguiente
+        self.pregunta = pregunta
+        self.teclado = teclado
+        self.error = error
+        self.desvios = desvios or {}
+
+
+class Flujo:
+    __slots__ = ("inicio", "primer_paso", "pasos", "accion", "exito", "fallo")
+
+    def __init__(self, inicio, primer_paso, pasos, accion, exito, fallo):
+        self.inicio = inicio
+        self.primer_paso = primer_paso
+        self.pasos = pasos
+        self.accion = accion
+        self.exito = exito
+        self.fallo = fallo
+
+
+def _validar_monto(texto):
+    try:
+        return float(texto.replace(",", ""))
+    except ValueError:
+        return None
+
+
+def _validar_texto(texto):
+    return texto.strip() or None
+
+
+def _validar_descripcion(texto):
+    return texto.strip() or "Sin descripción"
+
+
+def _pasos_fecha(pregunta, pregunta_otra, error):
+    """Paso de fecha con botones Hoy/Mañana/Otra fecha y su paso de fecha libre."""
+    return {
+        "fecha": Paso("fecha", parse_fecha_es, pregunta=pregunta, teclado=DATE_KEYBOARD,
+                      error=error, desvios={"otra fecha": "otra_fecha"}),
+        "otra_fecha": Paso("fecha", parse_fecha_es, pregunta=pregunta_otra, error=error),
+    }
+
+
+def _flujo_movimiento(nombre, tipo_notion, ejemplo_monto, ejemplo_descripcion, confirmacion):
+    return Flujo(
+        inicio=f"Vamos a registrar un *{nombre}*.\n\n¿Cuál es el monto del {nombre}?",
+        primer_paso="monto",
+        pasos={
+            "monto": Paso("monto", _validar_monto, "descripcion",
+                          error=f"No entendí el monto. Escribe solo el número, por ejemplo: {ejemplo_monto}"),
+            "descripcion": Paso("descripcion", _validar_descripcion, "fecha",
+                                pregunta=f"{confirmacion} Ahora dime una descripción breve del {nombre} "
+                                         f"(por ejemplo: {ejemplo_descripcion})."),
+            **_pasos_fecha(
+                f"¿Para qué fecha registro este {nombre}?",
+                "Escribe la fecha en formato `dd/mm/aaaa` o `12 de diciembre 2025`.",
+                "No pude entender la fecha. Usa algo como `09/12/2025` o `12 de diciembre`.",
+            ),
+        },
+        accion=lambda s: create_financial_record(
+            movimiento=s.descripcion, tipo=tipo_notion, monto=s.monto, fecha=s.fecha,
+        ),
+        exito=f"✔ {nombre.capitalize()} registrado: {{monto}} – {{descripcion}} ({{fecha}})",
+        fallo=f"Hubo un problema guardando el {nombre} en Notion.",
+    )
+
+
+FLUJOS = {
+    "gasto": _flujo_movimiento("gasto", "Egreso", "250", "gasolina Clio", "Perfecto."),
+    "ingreso": _flujo_movimiento("ingreso", "Ingreso", "2000", "sueldo, ventas", "Listo."),
+    "tarea": Flujo(
+        inicio="Vamos a crear una *tarea*.\n\nEscribe el título de la tarea.",
+        primer_paso="titulo",
+        pasos={
+            "titulo": Paso("titulo", _validar_texto, "fecha", error="Escribe el título de la tarea."),
+            **_pasos_fecha(
+                "¿Para qué fecha pongo la tarea?",
+                "Escribe la fecha de la tarea (`dd/mm/aaaa` o `12 de diciembre`).",
+                "No entendí la fecha. Prueba con `09/12/2025` o `12 de diciembre`.",
+            ),
+        },
+        accion=lambda s: create_task(s.titulo, fecha=s.fecha),
+        exito="✔ Tarea creada: {titulo} ({fecha})",
+        fallo="Hubo un problema guardando la tarea en Notion.",
+    ),
+    "evento": Flujo(
+        inicio="Vamos a crear un *evento*.\n\nEscribe el nombre del evento.",
+        primer_paso="titulo",
+        pasos={
+            "titulo": Paso("titulo", _validar_texto, "fecha", error="Escribe el nombre del evento."),
+            **_pasos_fecha(
+                "¿Para qué fecha registro el evento?",
+                "Escribe la fecha del evento (`dd/mm/aaaa` o `12 de diciembre`).",
+                "No entendí la fecha. Prueba con `09/12/2025` o `12 de diciembre`.",
+            ),
+        },
+        accion=lambda s: create_event(s.titulo, fecha=s.fecha),
+        exito="✔ Evento creado: {titulo} ({fecha})",
+        fallo="Hubo un problema guardando el evento en Notion.",
+    ),
+    "proyecto": Flujo(
+        inicio="Vamos a crear un *proyecto*.\n\nEscribe el nombre del proyecto.",
+        primer_paso="titulo",
+        pasos={"titulo": Paso("titulo", _validar_texto, error="Escribe el nombre del proyecto.")},
+        accion=lambda s: create_project(s.titulo),
+        exito="✔ Proyecto creado: {titulo}",
+        fallo="Hubo un problema guardando el proyecto en Notion.",
+    ),
+    "habito": Flujo(
+        inicio="Vamos a crear un *hábito*.\n\nEscribe el nombre del hábito.",
+        primer_paso="titulo",
+        pasos={"titulo": Paso("titulo", _validar_texto, error="Escribe el nombre del hábito.")},
+        accion=lambda s: create_habit(s.titulo),
+        exito="✔ Hábito creado: {titulo}",
+        fallo="Hubo un problema guardando el hábito en Notion.",
+    ),
+}
+
+
+# ---- Motor ----
+
+def iniciar_sesion(chat_id, tipo):
+    flujo = FLUJOS[tipo]
+    SESSIONS.put(chat_id, Sesion(tipo, flujo.primer_paso))
+    send_message(chat_id, flujo.inicio, reply_markup=CANCEL_KEYBOARD)
+
+
+def cancelar_sesion(chat_id):
+    SESSIONS.pop(chat_id)
+    send_message(chat_id, "Operación cancelada. Volvemos al menú principal.", reply_markup=MAIN_KEYBOARD)
+
+
+def _avanzar(chat_id, sesion, flujo, destino):
+    sesion.paso = destino
+    SESSIONS.put(chat_id, sesion)
+    paso = flujo.pasos[destino]
+    send_message(chat_id, paso.pregunta, reply_markup=paso.teclado)
+
+
+def handle_session(chat_id, text):
+    # Si no hay sesión activa, no hacemos nada
+    sesion = SESSIONS.get(chat_id)
+    if sesion is None:
+        return False
+
+    lower = text.lower().strip()
+    if lower == "cancelar":
+        cancelar_sesion(chat_id)
+        return True
+
+    flujo = FLUJOS.get(sesion.tipo)
+    paso = flujo.pasos.get(sesion.paso) if flujo else None
+    if paso is None:
+        # Sesión de un flujo o paso que ya no existe: se descarta
+        SESSIONS.pop(chat_id)
+        return False
+
+    destino = paso.desvios.get(lower)
+    if destino:
+        _avanzar(chat_id, sesion, flujo, destino)
+        return True
+
+    valor = paso.validar(text)
+    if valor is None:
+        send_message(chat_id, paso.error, reply_markup=CANCEL_KEYBOARD)
+        return True
+    setattr(sesion, paso.campo, valor)
+
+    if paso.siguiente:
+        _avanzar(chat_id, sesion, flujo, paso.siguiente)
+        return True
+
+    ok = flujo.accion(sesion)
+    cancelar_sesion(chat_id)
+    send_message(chat_id, flujo.exito.format(**sesion.a_dict()) if ok else flujo.fallo)
+    return True
 
 # =========================
 #  PARSEO DE COMANDOS DE TEXTO
@@ -831,140 +3376,376 @@ HELP_TEXT = (
 )
 
 
-def manejar_comando_finanzas(texto, chat_id):
-    if texto.startswith("gasto:"):
-        contenido = texto.replace("gasto:", "", 1).strip()
-        partes = contenido.split(" ", 1)
-        if not partes:
-            send_message(chat_id, "Formato: `gasto: 150 tacos`")
-            return True
-        monto = partes[0].replace(",", "")
-        descripcion = partes[1] if len(partes) > 1 else "Sin descripción"
-        try:
-            monto_num = float(monto)
-        except ValueError:
-            send_message(chat_id, "No entendí el monto. Usa algo como: `gasto: 150 tacos`")
-            return True
-        ok = create_financial_record(movimiento=descripcion, tipo="Egreso", monto=monto_num)
-        if ok:
-            send_message(chat_id, f"✔ Gasto registrado: {monto_num} – {descripcion}")
-        else:
-            send_message(chat_id, "Hubo un problema guardando el gasto en Notion.")
-        return True
+def _cmd_movimiento(chat_id, contenido, tipo, nombre, ejemplo):
+    partes = contenido.split(" ", 1)
+    if not partes:
+        send_message(chat_id, f"Formato: `{ejemplo}`")
+        return
+    monto = partes[0].replace(",", "")
+    descripcion = partes[1] if len(partes) > 1 else "Sin descripción"
+    try:
+        monto_num = float(monto)
+    except ValueError:
+        send_message(chat_id, f"No entendí el monto. Usa algo como: `{ejemplo}`")
+        return
+    ok = create_financial_record(movimiento=descripcion, tipo=tipo, monto=monto_num)
+    if ok:
+        send_message(chat_id, f"✔ {nombre.capitalize()} registrado: {monto_num} – {descripcion}")
+    else:
+        send_message(chat_id, f"Hubo un problema guardando el {nombre} en Notion.")
 
-    if texto.startswith("ingreso:"):
-        contenido = texto.replace("ingreso:", "", 1).strip()
-        partes = contenido.split(" ", 1)
-        if not partes:
-            send_message(chat_id, "Formato: `ingreso: 9000 sueldo`")
-            return True
-        monto = partes[0].replace(",", "")
-        descripcion = partes[1] if len(partes) > 1 else "Sin descripción"
-        try:
-            monto_num = float(monto)
-        except ValueError:
-            send_message(chat_id, "No entendí el monto. Usa algo como: `ingreso: 9000 sueldo`")
-            return True
-        ok = create_financial_record(movimiento=descripcion, tipo="Ingreso", monto=monto_num)
-        if ok:
-            send_message(chat_id, f"✔ Ingreso registrado: {monto_num} – {descripcion}")
-        else:
-            send_message(chat_id, "Hubo un problema guardando el ingreso en Notion.")
-        return True
 
-    if "estado finanzas" in texto or "balance este mes" in texto:
-        send_message(chat_id, resumen_finanzas_mes())
-        return True
+def cmd_gasto(chat_id, contenido):
+    _cmd_movimiento(chat_id, contenido, "Egreso", "gasto", "gasto: 150 tacos")
 
-    if "ingresos este mes" in texto or texto == "ingresos":
-        send_message(chat_id, resumen_finanzas_mes())
-        return True
 
-    if "gastos este mes" in texto or texto == "gastos":
-        send_message(chat_id, resumen_finanzas_mes())
-        return True
+def cmd_ingreso(chat_id, contenido):
+    _cmd_movimiento(chat_id, contenido, "Ingreso", "ingreso", "ingreso: 9000 sueldo")
 
-    return False
 
+def cmd_tarea(chat_id, descripcion):
+    if not descripcion:
+        send_message(chat_id, "Formato: `tarea: descripción de la tarea`")
+        return
+    titulo, fecha = extraer_fecha(descripcion)
+    ok = create_task(titulo, fecha=fecha)
+    if ok:
+        send_message(chat_id, f"✔ Tarea creada: {titulo}" + (f" ({fecha})" if fecha else ""))
+    else:
+        send_message(chat_id, "Hubo un problema guardando la tarea en Notion.")
 
-def manejar_comando_tareas(texto, chat_id):
-    if texto.startswith("tarea:"):
-        descripcion = texto.replace("tarea:", "", 1).strip()
-        if not descripcion:
-            send_message(chat_id, "Formato: `tarea: descripción de la tarea`")
-            return True
-        ok = create_task(descripcion)
-        if ok:
-            send_message(chat_id, f"✔ Tarea creada: {descripcion}")
-        else:
-            send_message(chat_id, "Hubo un problema guardando la tarea en Notion.")
-        return True
 
-    if "tareas hoy" in texto or "tareas atrasadas" in texto:
-        send_message(chat_id, listar_tareas_hoy())
-        return True
+def cmd_evento(chat_id, descripcion):
+    if not descripcion:
+        send_message(chat_id, "Formato rápido: `evento: junta kaizen viernes 16:00`")
+        return
+    titulo, fecha = extraer_fecha(descripcion)
+    ok = create_event(titulo, fecha=fecha or hoy_iso())
+    if ok:
+        send_message(chat_id, f"✔ Evento creado: {titulo} ({fecha})" if fecha else f"✔ Evento creado (hoy): {titulo}")
+    else:
+        send_message(chat_id, "Hubo un problema guardando el evento en Notion.")
 
-    return False
 
+def cmd_proyecto(chat_id, nombre):
+    if not nombre:
+        send_message(chat_id, "Formato: `proyecto: nombre del proyecto`")
+        return
+    ok = create_project(nombre)
+    if ok:
+        send_message(chat_id, f"✔ Proyecto creado: {nombre}")
+    else:
+        send_message(chat_id, "Hubo un problema guardando el proyecto en Notion.")
 
-def manejar_comando_eventos(texto, chat_id):
-    if texto.startswith("evento:"):
-        descripcion = texto.replace("evento:", "", 1).strip()
-        if not descripcion:
-            send_message(chat_id, "Formato rápido: `evento: junta kaizen viernes 16:00`")
-            return True
-        ok = create_event(descripcion, fecha=hoy_iso())
-        if ok:
-            send_message(chat_id, f"✔ Evento creado (hoy): {descripcion}")
-        else:
-            send_message(chat_id, "Hubo un problema guardando el evento en Notion.")
-        return True
 
-    if "eventos hoy" in texto or "agenda" in texto:
-        send_message(chat_id, listar_eventos_hoy_y_proximos(3))
-        return True
+def cmd_habito(chat_id, nombre):
+    if not nombre:
+        send_message(chat_id, "Formato: `hábito: descripción del hábito`")
+        return
+    ok = create_habit(nombre)
+    if ok:
+        send_message(chat_id, f"✔ Hábito creado: {nombre}")
+    else:
+        send_message(chat_id, "Hubo un problema guardando el hábito en Notion.")
 
-    return False
 
+def cmd_ayuda(chat_id, _):
+    send_message(chat_id, "Hola Manuel, soy Ares. Te ayudo a manejar tus finanzas, tareas, eventos, proyectos y hábitos.")
+    send_message(chat_id, HELP_TEXT)
+    show_main_menu(chat_id)
 
-def manejar_comando_proyectos(texto, chat_id):
-    if texto.startswith("proyecto:"):
-        nombre = texto.replace("proyecto:", "", 1).strip()
-        if not nombre:
-            send_message(chat_id, "Formato: `proyecto: nombre del proyecto`")
-            return True
-        ok = create_project(nombre)
-        if ok:
-            send_message(chat_id, f"✔ Proyecto creado: {nombre}")
-        else:
-            send_message(chat_id, "Hubo un problema guardando el proyecto en Notion.")
-        return True
 
-    if "proyectos activos" in texto:
-        send_message(chat_id, listar_proyectos_activos(20))
-        return True
+def responder_con(generar, *args):
+    """Handler que responde con el texto de `generar(*args)`."""
+    def handler(chat_id, _):
+        try:
+            texto = generar(*args)
+        except ErrorNotion:
+            texto = NOTION_ERROR_TEXTO
+        send_message(chat_id, texto)
+    return handler
 
-    return False
 
+def iniciar_flujo(tipo):
+    return lambda chat_id, _: iniciar_sesion(chat_id, tipo)
 
-def manejar_comando_habitos(texto, chat_id):
-    if texto.startswith("hábito:") or texto.startswith("habito:"):
-        nombre = texto.split(":", 1)[1].strip()
-        if not nombre:
-            send_message(chat_id, "Formato: `hábito: descripción del hábito`")
-            return True
-        ok = create_habit(nombre)
-        if ok:
-            send_message(chat_id, f"✔ Hábito creado: {nombre}")
+
+# =========================
+#  ENRUTADOR DE MENSAJES
+# =========================
+
+class Router:
+    """
+    Tabla de rutas de los mensajes de texto. Todo se busca sobre el texto
+    normalizado (normalizar_pregunta: minúsculas, sin acentos, sin emojis ni
+    signos), así "📋 Resumen general" y "resumen general" son la misma ruta.
+
+    - exactas: el mensaje completo es la clave (botones, consultas rápidas).
+    - prefijos: "clave: contenido"; la clave es la palabra antes de ":".
+    - patrones: expresiones regulares, unidas en una sola al compilar.
+
+    resolver() devuelve (nombre_ruta, handler, contenido) o None; el orden
+    de prioridad es prefijos, exactas, patrones. Las rutas exactas y los
+    patrones son frases cortas: un mensaje más largo que LARGO_MAX_FRASE va
+    directo a la IA sin normalizarse.
+    """
+
+    LARGO_MAX_FRASE = 40
+    LARGO_MAX_CLAVE = 20
+
+    def __init__(self):
+        self.exactas = {}
+        self.prefijos = {}
+        self._patrones = []
+        self._regex = None
+
+    def exacta(self, nombre, textos, handler):
+        for texto in textos:
+            # También la forma en minúsculas, para acertar sin normalizar
+            self.exactas[texto.lower()] = (nombre, handler)
+            self.exactas[normalizar_pregunta(texto)] = (nombre, handler)
+
+    def prefijo(self, nombre, claves, handler):
+        for clave in claves:
+            self.prefijos[clave.lower()] = (nombre, handler)
+            self.prefijos[normalizar_pregunta(clave)] = (nombre, handler)
+
+    def patron(self, nombre, regex, handler):
+        self._patrones.append((nombre, regex, handler))
+
+    def compilar(self):
+        if self._patrones:
+            self._regex = re.compile("|".join(
+                f"(?P<r{n}>{regex})" for n, (_, regex, _) in enumerate(self._patrones)
+            ))
+        return self
+
+    def resolver(self, texto):
+        lower = texto.lower().strip()
+        dos_puntos = lower.find(":")
+        if 0 < dos_puntos <= self.LARGO_MAX_CLAVE:
+            clave = lower[:dos_puntos].strip()
+            ruta = self.prefijos.get(clave) or self.prefijos.get(normalizar_pregunta(clave))
+            if ruta:
+                return ruta[0], ruta[1], lower[dos_puntos + 1:].strip()
+
+        ruta = self.exactas.get(lower)
+        if ruta:
+            return ruta[0], ruta[1], lower
+        if len(lower) > self.LARGO_MAX_FRASE:
+            return None
+
+        # Texto ASCII sin signos: normalizar solo junta espacios, y nos
+        # ahorramos el NFKD y la regex de normalizar_pregunta
+        if lower.isascii() and lower.replace(" ", "").isalnum():
+            normalizado = " ".join(lower.split())
         else:
-            send_message(chat_id, "Hubo un problema guardando el hábito en Notion.")
-        return True
+            normalizado = normalizar_pregunta(lower)
+        ruta = self.exactas.get(normalizado)
+        if ruta:
+            return ruta[0], ruta[1], lower
+
+        if self._regex is not None:
+            m = self._regex.fullmatch(normalizado)
+            if m:
+                nombre, _, handler = self._patrones[int(m.lastgroup[1:])]
+                return nombre, handler, lower
+        return None
+
 
-    if "hábitos activos" in texto or "habitos activos" in texto:
-        send_message(chat_id, listar_habitos_activos(20))
+def crear_router():
+    router = Router()
+
+    router.exacta("ayuda", ["/start", "ayuda", "/help", "help"], cmd_ayuda)
+
+    # Botones del menú principal
+    router.exacta("boton_gasto", ["➕ Nuevo gasto"], iniciar_flujo("gasto"))
+    router.exacta("boton_ingreso", ["➕ Nuevo ingreso"], iniciar_flujo("ingreso"))
+    router.exacta("boton_tarea", ["📝 Nueva tarea"], iniciar_flujo("tarea"))
+    router.exacta("boton_evento", ["📅 Nuevo evento"], iniciar_flujo("evento"))
+    router.exacta("boton_proyecto", ["📂 Nuevo proyecto"], iniciar_flujo("proyecto"))
+    router.exacta("boton_habito", ["✨ Nuevo hábito"], iniciar_flujo("habito"))
+    router.exacta("resumen_finanzas", ["📊 Resumen finanzas"], responder_con(resumen_finanzas_mes))
+    router.exacta("resumen_general", ["📋 Resumen general"], responder_con(snapshot_contexto))
+
+    # Comandos "clave: contenido"
+    router.prefijo("gasto", ["gasto"], cmd_gasto)
+    router.prefijo("ingreso", ["ingreso"], cmd_ingreso)
+    router.prefijo("tarea", ["tarea"], cmd_tarea)
+    router.prefijo("evento", ["evento"], cmd_evento)
+    router.prefijo("proyecto", ["proyecto"], cmd_proyecto)
+    router.prefijo("habito", ["hábito"], cmd_habito)
+
+    # Consultas rápidas: frases completas, para no desviar a Notion
+    # preguntas que solo las mencionan (p. ej. "organiza mi agenda").
+    router.exacta("finanzas", [
+        "estado finanzas", "balance este mes", "ingresos este mes", "ingresos",
+        "gastos este mes", "gastos",
+    ], responder_con(resumen_finanzas_mes))
+    router.patron("tareas_hoy", r"(mis )?tareas (de )?(hoy|atrasadas)", responder_con(listar_tareas_hoy))
+    router.patron("eventos_hoy", r"(mis )?(eventos (de )?hoy|agenda)", responder_con(listar_eventos_hoy_y_proximos, 3))
+    router.patron("proyectos_activos", r"(mis )?proyectos activos", responder_con(listar_proyectos_activos, 20))
+    router.patron("habitos_activos", r"(mis )?habitos activos", responder_con(listar_habitos_activos, 20))
+
+    return router.compilar()
+
+
+ROUTER = crear_router()
+
+# =========================
+#  COLA DE UPDATES (MODO ASÍNCRONO)
+# =========================
+
+class ColaUpdates:
+    """
+    Cola acotada de updates de Telegram atendida por `workers` hilos.
+
+    Cada chat tiene su propia fila: los updates de un mismo chat se procesan
+    de uno en uno y en orden de llegada (los flujos de SESSIONS dependen de
+    ello), mientras que chats distintos avanzan en paralelo. `_listos`
+    contiene los chats con trabajo pendiente que ningún hilo está atendiendo.
+
+    Los hilos se arrancan con el primer update de cada proceso, así que la
+    cola funciona igual con `gunicorn --preload` que sin él. Si ya hay
+    `max_pendientes` updates esperando, o la cola se está drenando para
+    apagar el proceso, `encolar` lo rechaza y devuelve False.
+    """
+
+    def __init__(self, procesar, workers, max_pendientes):
+        self.procesar = procesar
+        self.workers = workers
+        self.max_pendientes = max_pendientes
+        self._por_chat = {}  # chat_id -> deque de (encolado_en, update)
+        self._listos = queue.Queue()
+        self._pendientes = 0
+        self._en_curso = 0
+        self._lock = threading.Lock()
+        self._vacia = threading.Condition(self._lock)
+        self._cerrada = False
+        self._pid = None
+        self.encolados = 0
+        self.procesados = 0
+        self.descartados = 0
+        self.errores = 0
+        self._espera_total = 0.0
+        self._espera_max = 0.0
+
+    def _arrancar(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for n in range(self.workers):
+                hilo = threading.Thread(
+                    target=self._worker,
+                    name=f"updates-{n}",
+                    daemon=True,
+                )
+                hilo.start()
+
+    def encolar(self, chat_id, update):
+        if self._pid != os.getpid():
+            self._arrancar()
+        with self._lock:
+            if self._cerrada or self._pendientes >= self.max_pendientes:
+                self.descartados += 1
+                return False
+            self._pendientes += 1
+            self.encolados += 1
+            fila = self._por_chat.get(chat_id)
+            if fila is None:
+                # Nadie atiende este chat: lo marcamos como listo
+                fila = self._por_chat[chat_id] = deque()
+                self._listos.put(chat_id)
+            fila.append((time.monotonic(), update))
         return True
 
-    return False
+    def _worker(self):
+        while True:
+            chat_id = self._listos.get()
+            with self._lock:
+                encolado_en, update = self._por_chat[chat_id].popleft()
+                self._pendientes -= 1
+                self._en_curso += 1
+                espera = time.monotonic() - encolado_en
+                self._espera_total += espera
+                self._espera_max = max(self._espera_max, espera)
+            try:
+                self.procesar(update)
+            except Exception:
+                with self._lock:
+                    self.errores += 1
+                log.exception("Error procesando update en segundo plano")
+            finally:
+                with self._lock:
+                    self.procesados += 1
+                    self._en_curso -= 1
+                    if self._por_chat[chat_id]:
+                        # Quedan mensajes del chat: vuelve al final de la fila
+                        self._listos.put(chat_id)
+                    else:
+                        del self._por_chat[chat_id]
+                    if not self._pendientes and not self._en_curso:
+                        self._vacia.notify_all()
+
+    def drenar(self, timeout):
+        """
+        Deja de aceptar updates y espera hasta `timeout` segundos a que se
+        procesen los que ya estaban en la cola. Devuelve cuántos quedaron
+        sin procesar (0 si se vació a tiempo).
+        """
+        limite = time.monotonic() + timeout
+        with self._lock:
+            self._cerrada = True
+            if self._pid != os.getpid():
+                # Este proceso nunca arrancó hilos: lo heredado no es suyo
+                return 0
+            while self._pendientes or self._en_curso:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                self._vacia.wait(restante)
+            return self._pendientes + self._en_curso
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "pendientes": self._pendientes,
+                "chats_activos": len(self._por_chat),
+                "encolados": self.encolados,
+                "procesados": self.procesados,
+                "descartados": self.descartados,
+                "errores": self.errores,
+                "espera_media_s": round(self._espera_total / self.procesados, 4) if self.procesados else 0.0,
+                "espera_max_s": round(self._espera_max, 4),
+            }
+
+
+class CandadosPorChat:
+    """
+    Un Lock por chat_id, creado al vuelo y liberado cuando nadie lo usa.
+    Sirve en modo síncrono (gunicorn con hilos) para que dos requests del
+    mismo chat no pisen su sesión.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._candados = {}  # chat_id -> [Lock, usuarios]
+
+    @contextmanager
+    def para(self, chat_id):
+        with self._lock:
+            entrada = self._candados.setdefault(chat_id, [threading.Lock(), 0])
+            entrada[1] += 1
+        try:
+            with entrada[0]:
+                yield
+        finally:
+            with self._lock:
+                entrada[1] -= 1
+                if not entrada[1]:
+                    del self._candados[chat_id]
 
 # =========================
 #  WEBHOOK TELEGRAM
@@ -975,92 +3756,283 @@ def home():
     return "Ares1409 webhook OK", 200
 
 
-@app.route("/", methods=["POST"])
-def webhook():
-    data = request.get_json(force=True, silent=True) or {}
-    print("Update:", json.dumps(data, ensure_ascii=False))
+@app.route("/stats", methods=["GET"])
+def stats():
+    return {
+        "notion_cache": NOTION_CACHE.stats(),
+        "webhook_cola": COLA_UPDATES.stats(),
+        "updates_vistos": UPDATES_VISTOS.stats(),
+        "espejo": espejo_stats(),
+        "sesiones": SESSIONS.stats(),
+        "notion_limitador": LIMITADOR_NOTION.stats(),
+        "telegram_cola": COLA_TELEGRAM.stats(),
+        "ia_uso": USO_IA.stats(),
+        "ia_respuestas_cache": RESPUESTAS_IA.stats(),
+        "ia_contexto": AHORRO_CONTEXTO.stats(),
+        "ia_respuestas_locales": RESPUESTAS_LOCALES.stats(),
+        "fechas_cache": _parse_fecha.cache_info()._asdict(),
+    }, 200
+
+
+def _lineas_estado():
+    """Contadores que ya existen en /stats, en formato de Prometheus."""
+    valores = [
+        ("ares_notion_cache_hits_total", "counter", NOTION_CACHE.hits),
+        ("ares_notion_cache_misses_total", "counter", NOTION_CACHE.misses),
+        ("ares_updates_duplicados_total", "counter", UPDATES_VISTOS.duplicados),
+        ("ares_ia_llamadas_total", "counter", USO_IA.llamadas),
+        ("ares_ia_input_tokens_total", "counter", USO_IA.input_tokens),
+        ("ares_ia_cached_tokens_total", "counter", USO_IA.cached_tokens),
+        ("ares_ia_output_tokens_total", "counter", USO_IA.output_tokens),
+        ("ares_ia_costo_usd_total", "counter", round(USO_IA.costo_usd, 6)),
+        ("ares_ia_llamadas_evitadas_total", "counter", RESPUESTAS_LOCALES.stats()["llamadas_ia_evitadas"]),
+        ("ares_ia_respuestas_cache_hits_total", "counter", RESPUESTAS_IA.hits),
+        ("ares_telegram_enviados_total", "counter", COLA_TELEGRAM.enviados),
+        ("ares_telegram_reintentos_total", "counter", COLA_TELEGRAM.reintentos),
+        ("ares_webhook_cola_pendientes", "gauge", COLA_UPDATES.stats().get("pendientes", 0)),
+    ]
+    lineas = []
+    for nombre, tipo, valor in valores:
+        lineas += [f"# TYPE {nombre} {tipo}", f"{nombre} {valor}"]
+    return lineas
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return exponer_metricas(_lineas_estado()), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+def chat_id_de_update(data):
+    message = data.get("message") or data.get("edited_message")
+    if not isinstance(message, dict):
+        return None
+    return (message.get("chat") or {}).get("id")
 
+
+def procesar_update(data):
     message = data.get("message") or data.get("edited_message")
     if not message:
-        return "OK"
+        return
 
     chat_id = message["chat"]["id"]
     message_id = message.get("message_id")
     text = (message.get("text") or "").strip()
 
+    # La ruta se anota antes de ejecutarla: si algo falla, logs y métricas
+    # saben dónde.
+
     # Primero, manejar sesiones activas (flujos de botones)
     if text:
-        if handle_session(chat_id, text):
-            return "OK"
+        anotar_contexto(ruta="sesion")
+        with span("handle_session"):
+            if handle_session(chat_id, text):
+                return
 
     if not text:
+        anotar_contexto(ruta="sin_texto")
         send_message(chat_id, "Solo entiendo mensajes de texto por ahora. 🙂")
-        return "OK"
+        return
+
+    ruta = ROUTER.resolver(text)
+    if ruta:
+        nombre, handler, contenido = ruta
+        anotar_contexto(ruta=nombre)
+        with span("ruta", ruta=nombre):
+            handler(chat_id, contenido)
+        return
+
+    # Preguntas que se pueden contestar sin IA
+    anotar_contexto(ruta="respuesta_local")
+    with span("respuesta_local"):
+        respuesta = respuesta_local(text)
+    if respuesta:
+        send_message(chat_id, respuesta, reply_to=message_id, reply_markup=MAIN_KEYBOARD)
+        return
 
-    lower = text.lower().strip()
+    # IA por defecto
+    if IA_STREAMING:
+        anotar_contexto(ruta="ia_streaming")
+        with span("consultar_ia_streaming"):
+            if consultar_ia_streaming(text, chat_id, reply_to=message_id):
+                return
+    anotar_contexto(ruta="ia")
+    with span("consultar_ia"):
+        respuesta_ia = consultar_ia(text)
+    send_message(chat_id, respuesta_ia, reply_to=message_id, reply_markup=MAIN_KEYBOARD)
 
-    # /start o ayuda
-    if lower in ("/start", "ayuda", "/help", "help"):
-        send_message(chat_id, "Hola Manuel, soy Ares. Te ayudo a manejar tus finanzas, tareas, eventos, proyectos y hábitos.")
-        send_message(chat_id, HELP_TEXT)
-        show_main_menu(chat_id)
-        return "OK"
 
-    # Botones del menú principal
-    if lower.endswith("nuevo gasto"):
-        SESSIONS[chat_id] = {"tipo": "gasto", "paso": 1}
-        send_message(chat_id, "Vamos a registrar un *gasto*.\n\n¿Cuál es el monto del gasto?", reply_markup=CANCEL_KEYBOARD)
-        return "OK"
+def atender_update(data):
+    """procesar_update con los campos del update en logs y métricas, y su duración."""
+    update_id, chat_id = data.get("update_id"), chat_id_de_update(data)
+    with contexto_log(update_id=update_id, chat_id=chat_id), traza("update", update_id=update_id):
+        inicio = time.perf_counter()
+        try:
+            procesar_update(data)
+        except Exception:
+            RUTA_ERRORES.inc(_CONTEXTO_LOG.get().get("ruta", "ninguna"))
+            raise
+        finally:
+            duracion = time.perf_counter() - inicio
+            RUTA_SEGUNDOS.observar(duracion, _CONTEXTO_LOG.get().get("ruta", "ninguna"))
+            log.info("update procesado", extra=campos(duracion_ms=round(duracion * 1000, 2)))
+
+
+# ---- Updates repetidos ----
+# registrar(update_id) devuelve False si el update ya se vio dentro de la
+# ventana; olvidar() lo quita para que un reintento tras un error sí se
+# procese.
+
+class UpdatesVistosMemoria:
+    def __init__(self, max_items, ventana):
+        self._vistos = CacheTTL(max_items, ventana)
+        self._lock = threading.Lock()
+        self.duplicados = 0
+
+    def registrar(self, update_id):
+        if self._vistos.put_nuevo(update_id, True):
+            return True
+        with self._lock:
+            self.duplicados += 1
+        return False
 
-    if lower.endswith("nuevo ingreso"):
-        SESSIONS[chat_id] = {"tipo": "ingreso", "paso": 1}
-        send_message(chat_id, "Vamos a registrar un *ingreso*.\n\n¿Cuál es el monto del ingreso?", reply_markup=CANCEL_KEYBOARD)
-        return "OK"
+    def olvidar(self, update_id):
+        self._vistos.borrar(update_id)
+
+    def stats(self):
+        datos = self._vistos.stats()
+        with self._lock:
+            duplicados = self.duplicados
+        return {"backend": "memory", "entradas": datos["entradas"], "duplicados": duplicados}
+
+
+class UpdatesVistosSQLite:
+    def __init__(self, max_items, ventana):
+        self.max_items = max_items
+        self.ventana = ventana
+        self._lock = threading.Lock()
+        self.duplicados = 0
+        self._escrituras = 0
+
+    def registrar(self, update_id):
+        conexion = sqlite_conexion()
+        ahora = time.time()
+        cursor = conexion.execute(
+            "INSERT INTO updates_vistos (update_id, visto) VALUES (?, ?) "
+            "ON CONFLICT(update_id) DO UPDATE SET visto = excluded.visto WHERE visto < ?",
+            (update_id, ahora, ahora - self.ventana),
+        )
+        with self._lock:
+            if cursor.rowcount == 0:
+                self.duplicados += 1
+                return False
+            self._escrituras += 1
+            limpiar = self._escrituras % 100 == 0
+        if limpiar:
+            conexion.execute("DELETE FROM updates_vistos WHERE visto < ?", (ahora - self.ventana,))
+            conexion.execute(
+                "DELETE FROM updates_vistos WHERE update_id NOT IN "
+                "(SELECT update_id FROM updates_vistos ORDER BY visto DESC LIMIT ?)",
+                (self.max_items,),
+            )
+        return True
 
-    if lower.endswith("nueva tarea"):
-        SESSIONS[chat_id] = {"tipo": "tarea", "paso": 1}
-        send_message(chat_id, "Vamos a crear una *tarea*.\n\nEscribe el título de la tarea.", reply_markup=CANCEL_KEYBOARD)
-        return "OK"
+    def olvidar(self, update_id):
+        sqlite_conexion().execute("DELETE FROM updates_vistos WHERE update_id = ?", (update_id,))
 
-    if lower.endswith("nuevo evento"):
-        SESSIONS[chat_id] = {"tipo": "evento", "paso": 1}
-        send_message(chat_id, "Vamos a crear un *evento*.\n\nEscribe el nombre del evento.", reply_markup=CANCEL_KEYBOARD)
-        return "OK"
+    def stats(self):
+        total = sqlite_conexion().execute("SELECT COUNT(*) FROM updates_vistos").fetchone()[0]
+        with self._lock:
+            duplicados = self.duplicados
+        # `duplicados` es de este proceso; la tabla es compartida
+        return {"backend": "sqlite", "entradas": total, "duplicados": duplicados}
 
-    if lower.endswith("nuevo proyecto"):
-        SESSIONS[chat_id] = {"tipo": "proyecto", "paso": 1}
-        send_message(chat_id, "Vamos a crear un *proyecto*.\n\nEscribe el nombre del proyecto.", reply_markup=CANCEL_KEYBOARD)
-        return "OK"
 
-    if lower.endswith("nuevo hábito") or lower.endswith("nuevo habito"):
-        SESSIONS[chat_id] = {"tipo": "habito", "paso": 1}
-        send_message(chat_id, "Vamos a crear un *hábito*.\n\nEscribe el nombre del hábito.", reply_markup=CANCEL_KEYBOARD)
-        return "OK"
+def crear_updates_vistos():
+    if UPDATE_DEDUP_SQLITE:
+        if not ARES_DB_PATH:
+            log.warning("UPDATE_DEDUP_SQLITE=1 requiere ARES_DB_PATH; deduplico en memoria")
+        else:
+            return UpdatesVistosSQLite(UPDATE_DEDUP_MAX, UPDATE_DEDUP_WINDOW)
+    return UpdatesVistosMemoria(UPDATE_DEDUP_MAX, UPDATE_DEDUP_WINDOW)
 
-    if lower.endswith("resumen finanzas"):
-        send_message(chat_id, resumen_finanzas_mes())
-        return "OK"
 
-    if lower.endswith("resumen general"):
-        send_message(chat_id, snapshot_contexto())
-        return "OK"
+UPDATES_VISTOS = crear_updates_vistos()
+COLA_UPDATES = ColaUpdates(atender_update, WEBHOOK_WORKERS, WEBHOOK_QUEUE_MAX)
+CANDADOS_CHAT = CandadosPorChat()
 
-    # Comandos de texto tipo "gasto: 150 tacos"
-    manejado = (
-        manejar_comando_finanzas(lower, chat_id)
-        or manejar_comando_tareas(lower, chat_id)
-        or manejar_comando_eventos(lower, chat_id)
-        or manejar_comando_proyectos(lower, chat_id)
-        or manejar_comando_habitos(lower, chat_id)
-    )
+# =========================
+#  ARRANQUE Y APAGADO (GUNICORN)
+# =========================
+
+def precargar():
+    """
+    Trabajo de arranque para el master de gunicorn con preload (ver
+    gunicorn.conf.py): lo que se importa aquí lo heredan los workers por
+    copy-on-write en vez de importarlo cada uno. No abre conexiones ni
+    arranca hilos; eso sigue ocurriendo en cada worker al primer uso.
+    """
+    importar_openai()
 
-    if manejado:
+
+_APAGADO_LOCK = threading.Lock()
+
+
+def apagar(timeout=None):
+    """
+    Vacía las colas en memoria antes de que termine el proceso. Se llama
+    desde el hook worker_exit de gunicorn.conf.py y, por si no hay gunicorn,
+    desde atexit; la segunda llamada ya no encuentra nada pendiente.
+    """
+    limite = time.monotonic() + (SHUTDOWN_DRAIN_TIMEOUT if timeout is None else timeout)
+    with _APAGADO_LOCK:
+        # Primero los updates: al procesarse encolan sus respuestas
+        perdidos = COLA_UPDATES.drenar(limite - time.monotonic())
+        if perdidos:
+            log.error("updates sin procesar al apagar", extra=campos(updates=perdidos))
+        perdidos = COLA_TELEGRAM.drenar(max(0.0, limite - time.monotonic()))
+        if perdidos:
+            log.error("mensajes a Telegram sin enviar al apagar", extra=campos(mensajes=perdidos))
+
+
+atexit.register(apagar)
+
+
+@app.route("/", methods=["POST"])
+def webhook():
+    data = request.get_json(force=True, silent=True) or {}
+    if LOG_UPDATES_MUESTRA and random.random() < LOG_UPDATES_MUESTRA:
+        log.info("update recibido", extra=campos(update=redactar_update(data) if LOG_REDACTAR else data))
+
+    chat_id = chat_id_de_update(data)
+    if chat_id is None:
         return "OK"
 
-    # IA por defecto
-    respuesta_ia = consultar_ia(text)
-    send_message(chat_id, respuesta_ia, reply_to=message_id, reply_markup=MAIN_KEYBOARD)
+    update_id = data.get("update_id")
+    if update_id is not None and not UPDATES_VISTOS.registrar(update_id):
+        log.info("update repetido, se ignora", extra=campos(update_id=update_id, chat_id=chat_id))
+        return "OK"
+
+    if not WEBHOOK_ASYNC:
+        try:
+            with CANDADOS_CHAT.para(chat_id):
+                atender_update(data)
+        except Exception:
+            # Telegram lo reintentará; ese reintento sí debe procesarse
+            if update_id is not None:
+                UPDATES_VISTOS.olvidar(update_id)
+            raise
+        return "OK"
 
+    # Modo asíncrono: solo validamos y encolamos; Telegram recibe el OK de
+    # inmediato y los workers hacen el trabajo pesado.
+    if not COLA_UPDATES.encolar(chat_id, data):
+        # Cola llena o worker apagándose: sin 2xx Telegram lo reintenta, y
+        # el reintento no debe tomarse por repetido
+        log.warning("cola de updates no disponible, se pide reintento",
+                    extra=campos(update_id=update_id, chat_id=chat_id))
+        if update_id is not None:
+            UPDATES_VISTOS.olvidar(update_id)
+        return "cola llena, reintenta", 503
     return "OK"
 
 